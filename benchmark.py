@@ -0,0 +1,257 @@
+"""
+Throughput Benchmark - both requirements pipelines against the offline mock server
+- Synthetic single-column workbooks (default 100 / 1,000 / 10,000 requirements) with compound,
+  vague, placeholder and duplicate rows
+- Every run gets its own process and working directory: no shared cache or journal, and the
+  peak memory reading belongs to that run alone
+- Reports rows/sec, API calls per row and peak memory (max RSS) per script and size
+- No API key and no cost: all calls go to mock_llm_server.py
+"""
+
+import pandas as pd
+from mock_llm_server import MockLLMServer
+import argparse
+import json
+import os
+import random
+import shlex
+import subprocess
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Windows: no peak-memory reading
+    resource = None
+
+# ==================== CONFIGURATION ====================
+
+SIZES = [100, 1000, 10000]
+SCRIPTS = ["neutralization", "processing"]
+WORK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_runs")
+RESULTS_FILE = "benchmark_results.json"  # Inside WORK_DIR
+
+# Mock server behaviour for the runs (see mock_llm_server.py)
+LATENCY_DISTRIBUTION = "lognormal"
+LATENCY_MEDIAN_SECONDS = 0.2
+LATENCY_SIGMA = 0.5
+RATE_LIMIT_ERROR_RATE = 0.01
+OVERLOADED_ERROR_RATE = 0.005
+
+# Synthetic workbook mix
+COMPOUND_SHARE = 0.35  # Rows joining 2-3 capabilities with "and" (split path)
+DUPLICATE_SHARE = 0.10  # Verbatim or reworded copies of an earlier row
+TEMPLATE_SHARE = 0.05  # Copies of an earlier row with renamed placeholders
+RANDOM_SEED = 7
+
+# ==================== SYNTHETIC WORKBOOKS ====================
+
+SUBJECTS = ["The system", "The operator console", "The data logger", "The [SUBSYSTEM_NAME]", "The user interface",
+            "The control unit", "The backup service", "The reporting module", "The gateway", "The maintenance tool"]
+ACTIONS = ["display the {noun} status", "log every {noun} event to [LOG_TARGET]", "respond fast to {noun} requests",
+           "be user-friendly for {noun} configuration", "store large {noun} archives", "provide adequate {noun} feedback",
+           "recover quickly after a {noun} fault", "export {noun} reports in [EXPORT_FORMAT]", "be reliable during {noun} updates",
+           "notify the operator of {noun} alarms within [ALARM_DELAY]", "validate {noun} input", "encrypt {noun} data at rest",
+           "synchronise {noun} clocks with [TIME_SOURCE]", "support efficient {noun} queries", "archive {noun} logs after [RETENTION_PERIOD]"]
+QUALIFIERS = ["primary", "secondary", "remote", "local", "redundant", "legacy", "external", "internal", "mobile", "embedded",
+              "critical", "auxiliary"]
+NOUNS = ["sensor", "pump", "valve", "battery", "network", "database", "camera", "motor", "user account", "firmware", "antenna",
+         "display", "printer", "door lock", "heater", "fan", "cooling loop", "power supply", "license", "audit trail"]
+MODALS = ["shall", "should", "must", "will"]
+
+def synthetic_requirement(rng):
+    """One customer requirement: 1 capability, or 2-3 joined by "and" (COMPOUND_SHARE)"""
+    count = rng.choice([2, 2, 3]) if rng.random() < COMPOUND_SHARE else 1
+    actions = [
+        rng.choice(ACTIONS).format(noun=f"{rng.choice(QUALIFIERS)} {rng.choice(NOUNS)}")
+        for _ in range(count)
+    ]
+    return f"{rng.choice(SUBJECTS)} {rng.choice(MODALS)} {' and '.join(actions)}."
+
+def synthetic_requirements(size, seed=RANDOM_SEED):
+    """`size` requirements with DUPLICATE_SHARE copies and TEMPLATE_SHARE placeholder variants"""
+    rng = random.Random(seed + size)
+    rows = []
+    for _ in range(size):
+        roll = rng.random()
+        if rows and roll < DUPLICATE_SHARE:
+            original = rng.choice(rows)
+            rows.append(original if rng.random() < 0.5 else original.replace(" shall ", " must ").replace(" the ", " each "))
+        elif rows and roll < DUPLICATE_SHARE + TEMPLATE_SHARE and "[" in rows[-1]:
+            rows.append(rows[-1].replace("]", f"_{rng.randint(2, 9)}]", 1))
+        else:
+            rows.append(synthetic_requirement(rng))
+    return rows
+
+def write_workbook(size, directory):
+    """Input workbook for `size` rows (column A only, like the customer exports); reused when present"""
+    path = os.path.join(directory, f"synthetic_requirements_{size}.xlsx")
+    if not os.path.exists(path):
+        pd.DataFrame({"Requirement": synthetic_requirements(size)}).to_excel(path, index=False)
+    return path
+
+# ==================== PIPELINE RUNS ====================
+
+def peak_memory_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024  # bytes on macOS, KiB on Linux
+
+def run_child(script, input_file, run_dir, base_url, concurrency, pipeline_args):
+    """Run one pipeline in this process and write its timing to run_dir/result.json"""
+    os.chdir(run_dir)
+    output_file = os.path.join(run_dir, "output.xlsx")
+    if script == "neutralization":
+        import requirements_neutralization as pipeline
+        pipeline.API_KEY = "mock-key"
+        pipeline.API_BASE_URL = base_url
+        pipeline.INPUT_FILE = input_file
+        pipeline.OUTPUT_FILE = output_file
+        pipeline.OUTPUT_FORMATS = ["xlsx"]
+        pipeline.BATCH_POLL_SECONDS = 1  # Mock batches end after their first poll
+        pipeline.JOURNAL_FILE = os.path.join(run_dir, "requirements_journal.jsonl")
+        pipeline.METRICS_FILE = os.path.join(run_dir, "requirements_metrics.json")
+        pipeline.PROMETHEUS_FILE = os.path.join(run_dir, "requirements_metrics.prom")
+        pipeline.CASSETTE_REPORT_FILE = os.path.join(run_dir, "requirements_cassette_mismatches.json")
+        # CACHE_FILE too: shard workers open the cache from the settings they are given
+        pipeline.CACHE_FILE = os.path.join(run_dir, "response_cache.sqlite")
+        pipeline.RESPONSE_CACHE = pipeline.ResponseCache(pipeline.CACHE_FILE)
+        # Start from the limits the mock advertises instead of the default API tier
+        from mock_llm_server import ADVERTISED_RPM, ADVERTISED_INPUT_TPM, ADVERTISED_OUTPUT_TPM
+        pipeline.RATE_LIMITER = pipeline.RateLimiter(ADVERTISED_RPM, ADVERTISED_INPUT_TPM, ADVERTISED_OUTPUT_TPM)
+        sys.argv = [pipeline.__file__] + (["--concurrency", str(concurrency)] if concurrency else []) + pipeline_args
+    else:
+        import requirements_processing as pipeline
+        pipeline.API_KEY = "mock-key"
+        pipeline.API_BASE_URL = base_url
+        pipeline.INPUT_FILE = input_file
+        pipeline.OUTPUT_FILE = output_file
+        pipeline.CACHE_FILE = os.path.join(run_dir, "response_cache.sqlite")
+        pipeline.cache = pipeline.ResponseCache(pipeline.CACHE_FILE)
+        pipeline.METRICS_FILE = os.path.join(run_dir, "requirements_metrics.json")
+        pipeline.PROMETHEUS_FILE = os.path.join(run_dir, "requirements_metrics.prom")
+        if concurrency:
+            pipeline.MAX_CONCURRENCY = concurrency
+        sys.argv = [pipeline.__file__]
+
+    start = time.perf_counter()
+    pipeline.main()
+    seconds = time.perf_counter() - start
+
+    rows = len(pd.read_excel(input_file).dropna(subset=["Requirement"]))
+    output = pd.read_excel(output_file) if os.path.exists(output_file) else pd.DataFrame(columns=["Sub_Requirement_Text"])
+    result = {
+        "script": script,
+        "rows": rows,
+        "seconds": round(seconds, 3),
+        "rows_per_second": round(rows / seconds, 2) if seconds else None,
+        "output_rows": len(output),
+        "error_rows": int(output["Sub_Requirement_Text"].astype(str).str.startswith("ERROR").sum()),
+        "peak_memory_mb": round(peak_memory_mb(), 1) if resource is not None else None,
+    }
+    with open(os.path.join(run_dir, "result.json"), "w", encoding="utf-8") as f:
+        json.dump(result, f)
+
+def run_benchmark(server, script, size, input_file, concurrency, pipeline_args):
+    """One pipeline run in a subprocess; returns its result with the server's call counts added"""
+    run_dir = os.path.join(WORK_DIR, f"{script}_{size}_{time.strftime('%Y%m%d_%H%M%S')}")
+    os.makedirs(run_dir, exist_ok=True)
+    command = [sys.executable, os.path.abspath(__file__), "--child", script, "--input", input_file, "--run-dir", run_dir,
+               "--base-url", server.base_url, f"--pipeline-args={shlex.join(pipeline_args)}"]
+    if concurrency:
+        command += ["--concurrency", str(concurrency)]
+    server.reset_stats()
+    with open(os.path.join(run_dir, "pipeline.log"), "w", encoding="utf-8") as log:
+        completed = subprocess.run(command, stdout=log, stderr=subprocess.STDOUT,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+    stats = server.snapshot()
+    result_path = os.path.join(run_dir, "result.json")
+    if completed.returncode != 0 or not os.path.exists(result_path):
+        return {"script": script, "rows": size, "failed": True, "log": os.path.join(run_dir, "pipeline.log")}
+    with open(result_path, encoding="utf-8") as f:
+        result = json.load(f)
+    if result["rows"] and result["error_rows"] == result["rows"]:
+        # Every row failed: the timing measures error handling, not the pipeline
+        return {"script": script, "rows": size, "failed": True, "log": os.path.join(run_dir, "pipeline.log")}
+    result.update({
+        "api_calls": stats["calls"],
+        "calls_per_row": round(stats["calls"] / result["rows"], 3) if result["rows"] else None,
+        "injected_429": stats["rate_limited"],
+        "injected_529": stats["overloaded"],
+        "calls_by_stage": stats["stages"],
+        "run_dir": run_dir,
+    })
+    return result
+
+def print_results(results):
+    print("\n" + "=" * 80)
+    print(f"{'Script':<16}{'Rows':>8}{'Seconds':>10}{'Rows/s':>10}{'Calls/row':>11}{'Peak MB':>10}{'Errors':>8}")
+    print("-" * 80)
+    for result in results:
+        if result.get("failed"):
+            print(f"{result['script']:<16}{result['rows']:>8}   FAILED - see {result['log']}")
+            continue
+        peak = f"{result['peak_memory_mb']:.1f}" if result["peak_memory_mb"] is not None else "n/a"
+        print(f"{result['script']:<16}{result['rows']:>8}{result['seconds']:>10.1f}{result['rows_per_second']:>10.2f}"
+              f"{result['calls_per_row']:>11.2f}{peak:>10}{result['error_rows']:>8}")
+    print("=" * 80)
+
+# ==================== MAIN ====================
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark both requirements pipelines against the offline mock server")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="rows per synthetic workbook")
+    parser.add_argument("--scripts", nargs="+", choices=SCRIPTS, default=SCRIPTS)
+    parser.add_argument("--concurrency", type=int, default=None, help="override each script's MAX_CONCURRENCY")
+    parser.add_argument("--pipeline-args", default="",
+                        help='extra requirements_neutralization.py options, e.g. --pipeline-args="--fused --pack"')
+    parser.add_argument("--latency", choices=["fixed", "uniform", "lognormal", "exponential"], default=LATENCY_DISTRIBUTION)
+    parser.add_argument("--median-seconds", type=float, default=LATENCY_MEDIAN_SECONDS)
+    parser.add_argument("--rate-limit-error-rate", type=float, default=RATE_LIMIT_ERROR_RATE)
+    parser.add_argument("--overloaded-error-rate", type=float, default=OVERLOADED_ERROR_RATE)
+    # Internal: one pipeline run inside the subprocess
+    parser.add_argument("--child", choices=SCRIPTS, help=argparse.SUPPRESS)
+    parser.add_argument("--input", help=argparse.SUPPRESS)
+    parser.add_argument("--run-dir", help=argparse.SUPPRESS)
+    parser.add_argument("--base-url", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    pipeline_args = shlex.split(args.pipeline_args)
+    if args.child:
+        run_child(args.child, args.input, args.run_dir, args.base_url, args.concurrency, pipeline_args)
+        return
+
+    os.makedirs(WORK_DIR, exist_ok=True)
+    server = MockLLMServer(port=0, latency=args.latency, median_seconds=args.median_seconds,
+                           rate_limit_error_rate=args.rate_limit_error_rate,
+                           overloaded_error_rate=args.overloaded_error_rate).start()
+    print(f"Mock server on {server.base_url}: {args.latency} latency, median {args.median_seconds}s, "
+          f"{args.rate_limit_error_rate:.1%} 429s, {args.overloaded_error_rate:.1%} 529s")
+    results = []
+    try:
+        for size in args.sizes:
+            input_file = write_workbook(size, WORK_DIR)
+            for script in args.scripts:
+                print(f"\n{script}: {size} rows...")
+                result = run_benchmark(server, script, size, input_file, args.concurrency, pipeline_args)
+                results.append(result)
+                if result.get("failed"):
+                    print(f"   FAILED - see {result['log']}")
+                else:
+                    print(f"   {result['rows_per_second']:.2f} rows/s, {result['calls_per_row']:.2f} calls/row, "
+                          f"peak {result['peak_memory_mb']} MB, {result['error_rows']} error rows")
+    finally:
+        server.stop()
+
+    print_results(results)
+    results_path = os.path.join(WORK_DIR, RESULTS_FILE)
+    with open(results_path, "w", encoding="utf-8") as f:
+        json.dump({"settings": {key: value for key, value in vars(args).items() if value is not None and key != "child"},
+                   "results": results}, f, indent=2)
+    print(f"Results: {results_path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,597 @@
+"""
+Mock LLM Server - offline stand-in for the Anthropic Messages API
+- Answers /v1/messages (plain and streamed) and the Message Batches endpoints
+- Canned JSON answers that follow the output formats of both requirements scripts
+  (text prompts and forced tool calls), derived from the requirement in the user message
+- Configurable latency distribution and 429 / 529 error injection
+- Optional placeholder loss in generated requirements, to exercise placeholder repair
+- Reports usage, rate-limit headers and simulated prompt-cache reads/writes like the real API
+- Counts calls per stage so benchmarks can report calls per requirement
+
+Point a script at it with API_BASE_URL = "http://127.0.0.1:<port>" (any API_KEY works), or run
+it in-process with MockLLMServer(...).start() and mock_client(server).
+"""
+
+from anthropic import AsyncAnthropic
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+
+# ==================== CONFIGURATION ====================
+
+HOST = "127.0.0.1"
+PORT = 8765
+
+# Latency per call: "fixed" (median), "uniform" (0.5x-1.5x median), "lognormal" (median, sigma)
+# or "exponential" (mean = median); plus a per-output-token generation time
+LATENCY_DISTRIBUTION = "lognormal"
+LATENCY_MEDIAN_SECONDS = 0.8
+LATENCY_SIGMA = 0.5
+SECONDS_PER_OUTPUT_TOKEN = 0.0
+STREAM_CHUNK_CHARACTERS = 32
+
+# Error injection: share of calls answered with 429 rate_limit_error / 529 overloaded_error
+RATE_LIMIT_ERROR_RATE = 0.0
+OVERLOADED_ERROR_RATE = 0.0
+RETRY_AFTER_SECONDS = 1
+
+# Share of generated requirement texts that come back with one [PLACEHOLDER] dropped
+PLACEHOLDER_LOSS_RATE = 0.0
+
+# Limits advertised in the anthropic-ratelimit-* response headers
+ADVERTISED_RPM = 4000
+ADVERTISED_INPUT_TPM = 2000000
+ADVERTISED_OUTPUT_TPM = 400000
+
+# Message Batches: polls before a batch reports "ended"
+BATCH_POLLS_UNTIL_ENDED = 1
+
+RANDOM_SEED = 42
+
+# ==================== CANNED ANSWERS ====================
+
+# (marker at the start of the stage instructions, stage); first match wins
+STAGE_MARKERS = [
+    ("TASK: Analyze", "analyze"),
+    ("TASK: Decide", "fused"),
+    ("TASK: Split", "split"),
+    ("TASK: An earlier answer", "repair"),
+    ("TASK: The rewritten requirement in the user message lost", "repair_placeholders"),
+    ("TASK: The rewritten requirement in the user message still breaks", "repair_rules"),
+    ("TASK: Transform", "improve"),
+    # requirements_processing.py
+    ("Analyze if requirement must SPLIT", "short_analyze"),
+    ("Transform to INCOSE", "short_improve"),
+    ("Split into the requested", "short_split"),
+]
+
+TOOL_STAGES = {
+    "record_split_analysis": "analyze",
+    "record_improved_requirement": "improve",
+    "record_split_requirements": "split",
+    "record_fused_result": "fused",
+    "record_improved_requirements": "packed",
+    "record_capability_requirement": "capability",
+    "record_missing_fields": "repair",
+    "record_repaired_requirement": "repair_placeholders",
+    "record_revised_requirement": "repair_rules",
+}
+
+COMPOUND_SEPARATORS = re.compile(r"\s+and\s+|\s*;\s*", re.IGNORECASE)
+MODAL_PREFIX = re.compile(r"^[^.]*?\b(shall|should|must|will|can)\s+(be\s+able\s+to\s+)?", re.IGNORECASE)
+VAGUE_TERMS = {"fast": "within 2.0 ± 0.5 seconds", "quickly": "within 2.0 ± 0.5 seconds", "easy": "within 30 ± 5 seconds",
+               "user-friendly": "within 30 ± 5 seconds", "reliable": "with ≥99.5% availability", "adequate": "with ≥95% accuracy",
+               "large": "up to 1000 ± 50 records", "efficient": "using ≤50% CPU"}
+
+# Mechanical fixes for the rule findings the repair_rules stage is asked about
+RULE_FIXES = [
+    (re.compile(r"\s*\([^)]*\)"), ""),
+    (re.compile(r",?\s*(?:etc\.?|and so on)", re.IGNORECASE), ""),
+    (re.compile(r"\band/or\b"), "or"),
+    (re.compile(r"/"), " per "),
+    (re.compile(r"\bshall\s+not\b", re.IGNORECASE), "shall avoid to"),
+    (re.compile(r"\b100\s?%"), "≥99.9%"),
+    (re.compile(r"\s*\b(?:always|never)\b", re.IGNORECASE), ""),
+    (re.compile(r"\b(?:[Ii]t|[Tt]hey|[Tt]hem|[Tt]his)\b"), "the system"),
+    (re.compile(r"\b(?:[Ii]ts|[Tt]heir)\b"), "the system's"),
+]
+
+def stage_of(params):
+    """Stage of a request, from the forced tool or the stage instructions in the system prompt"""
+    tool_name = (params.get("tool_choice") or {}).get("name")
+    if tool_name:
+        return TOOL_STAGES.get(tool_name, "improve")
+    system = params.get("system") or ""
+    instructions = system[-1]["text"] if isinstance(system, list) and system else str(system)
+    for marker, stage in STAGE_MARKERS:
+        if instructions.startswith(marker):
+            if stage == "improve" and "PACKED INPUT" in instructions:
+                return "packed"
+            if stage == "improve" and "CAPABILITY INPUT" in instructions:
+                return "capability"
+            return stage
+    return "improve"
+
+def user_text(params):
+    content = params["messages"][0]["content"]
+    if isinstance(content, list):
+        return "".join(block.get("text", "") for block in content)
+    return content
+
+def requirement_of(message):
+    """Requirement text of a user message in either script's message format"""
+    message = message.split("\n\nPARTIAL ANSWER:")[0]
+    for marker in ("ORIGINAL REQUIREMENT:", "REQ:"):
+        if marker in message:
+            message = message.rsplit(marker, 1)[1]
+            break
+    return re.split(r"\n(?:IDENTIFIED )?CAPABILITIES:", message)[0].strip()
+
+def capabilities_of(requirement, count=None):
+    """One clause per capability; padded or merged to `count` when the caller fixed it"""
+    parts = [part.strip(" .") for part in COMPOUND_SEPARATORS.split(requirement) if part.strip(" .")] or [requirement]
+    if count:
+        if len(parts) > count:
+            parts = parts[:count - 1] + [" and ".join(parts[count - 1:])]
+        parts += [f"{parts[-1]} (part {number})" for number in range(len(parts) + 1, count + 1)]
+    return parts[:10]
+
+def improve_text(clause):
+    """'The system shall ...' form of a clause, vague terms replaced, placeholders kept"""
+    body = MODAL_PREFIX.sub("", clause.strip(" .")).strip()
+    removed, tolerances = [], []
+    for term, replacement in VAGUE_TERMS.items():
+        if re.search(rf"\b{re.escape(term)}\b", body, re.IGNORECASE):
+            body = re.sub(rf"\b{re.escape(term)}\b", replacement, body, flags=re.IGNORECASE)
+            removed.append(f"{term} → {replacement}")
+            tolerances.append(f"{term}: {replacement}")
+    return f"The system shall {body}.", removed, tolerances
+
+def improved_record(clause):
+    text, removed, tolerances = improve_text(clause)
+    placeholders = re.findall(r"\[[^\]]+\]", clause)
+    return {
+        "requirement_type": "Performance" if tolerances else "Functional",
+        "improved_requirement": text,
+        "verification_method": "Test",
+        "placeholders_preserved": placeholders,
+        "incose_rules_applied": ["R1: Structured format", "R2: Active voice"] + (["R7: Removed vague terms"] if removed else []),
+        "vague_terms_removed": removed,
+        "tolerances_added": tolerances,
+        "escape_clauses_removed": [],
+        "improvements_summary": "Restated in R1 form" + (" with measurable criteria" if removed else ""),
+    }
+
+def sub_requirement(number, clause):
+    record = improved_record(clause)
+    return {
+        "sub_id": str(number),
+        "requirement_type": record["requirement_type"],
+        "requirement_text": record["improved_requirement"],
+        "verification_method": record["verification_method"],
+        "placeholders_used": record["placeholders_preserved"],
+        "incose_rules_applied": ["R1", "R2", "R18"],
+        "vague_terms_removed": record["vague_terms_removed"],
+        "tolerances_added": record["tolerances_added"],
+        "improvements_summary": record["improvements_summary"],
+    }
+
+def analysis(requirement):
+    capabilities = capabilities_of(requirement)
+    return {
+        "should_split": len(capabilities) > 1,
+        "reasoning": f"R18: {len(capabilities)} capabilities",
+        "number_of_atomic_requirements": len(capabilities),
+        "identified_capabilities": capabilities,
+        "placeholders_found": re.findall(r"\[[^\]]+\]", requirement),
+    }
+
+def short_record(number, clause):
+    record = improved_record(clause)
+    return {
+        "id": str(number), "type": record["requirement_type"], "requirement": record["improved_requirement"],
+        "verification": record["verification_method"], "placeholders": record["placeholders_preserved"],
+        "rules": ["R1", "R2"], "vague_removed": record["vague_terms_removed"], "tolerances": record["tolerances_added"],
+        "summary": record["improvements_summary"],
+    }
+
+def canned_answer(stage, message):
+    """JSON-ready answer for one stage, in the format its prompt asks for"""
+    requirement = requirement_of(message)
+    if stage == "analyze":
+        return analysis(requirement)
+    if stage == "fused":
+        result = analysis(requirement)
+        result["requirements"] = [sub_requirement(i, clause) for i, clause in enumerate(result["identified_capabilities"], 1)]
+        return result
+    if stage in ("split", "short_split"):
+        count = re.search(r"Split into (\d+)", message)
+        clauses = capabilities_of(requirement, int(count.group(1)) if count else None)
+        make = sub_requirement if stage == "split" else short_record
+        return [make(i, clause) for i, clause in enumerate(clauses, 1)]
+    if stage == "packed":
+        return [
+            {"key": key, **improved_record(requirement_of(block))}
+            for key, block in re.findall(r"KEY: (\S+)\n(.*?)(?=\n\nKEY: |\Z)", message, re.DOTALL)
+        ]
+    if stage == "repair":
+        record = improved_record(requirement)
+        sub = sub_requirement(1, requirement)
+        return [
+            {"record": int(number), "fields": {field: record.get(field, sub.get(field, "")) for field in re.split(r",\s*", fields)}}
+            for number, fields in re.findall(r"^- record (\d+): (.+?) \(record starts", message, re.MULTILINE)
+        ]
+    if stage == "capability":
+        fields = re.search(r"CAPABILITY:\n(.*?)\n\nPLACEHOLDERS FOR THIS REQUIREMENT:\n(.*)", message, re.DOTALL)
+        capability, placeholders = fields.groups() if fields else (requirement, "")
+        record = improved_record(capability)
+        missing = [p for p in re.findall(r"\[[^\]]+\]", placeholders) if p not in record["improved_requirement"]]
+        if missing:
+            record["improved_requirement"] = f"{record['improved_requirement'].rstrip('.')} for {' and '.join(missing)}."
+            record["placeholders_preserved"] += missing
+        return record
+    if stage == "repair_placeholders":
+        rewritten = re.search(r"REWRITTEN REQUIREMENT:\n(.*?)\n\nPLACEHOLDERS TO RESTORE:\n(.*?)\n\nALTERED PLACEHOLDERS:\n(.*)", message, re.DOTALL)
+        text, missing, altered = rewritten.groups() if rewritten else (requirement, "", "")
+        for placeholder in altered.splitlines():
+            text = text.replace(placeholder, "")
+        restore = [line for line in missing.splitlines() if line.startswith("[")]
+        if restore:
+            text = f"{text.strip().rstrip('.')} for {' and '.join(restore)}."
+        return {"requirement_text": " ".join(text.split())}
+    if stage == "repair_rules":
+        rewritten = re.search(r"REWRITTEN REQUIREMENT:\n(.*?)\n\nFINDINGS:", message, re.DOTALL)
+        text = rewritten.group(1) if rewritten else requirement
+        for pattern, replacement in RULE_FIXES:
+            text = pattern.sub(replacement, text)
+        return {"requirement_text": " ".join(text.split())}
+    if stage == "short_analyze":
+        result = analysis(requirement)
+        return {"should_split": result["should_split"], "num": result["number_of_atomic_requirements"],
+                "capabilities": result["identified_capabilities"], "placeholders": result["placeholders_found"]}
+    if stage == "short_improve":
+        return {key: value for key, value in short_record(1, requirement).items() if key != "id"}
+    return improved_record(requirement)
+
+def tool_input(answer, tool):
+    """Wrap a bare JSON array answer into the tool's single array property"""
+    if not isinstance(answer, list):
+        return answer
+    properties = tool.get("input_schema", {}).get("properties", {})
+    field = next((name for name, schema in properties.items() if schema.get("type") == "array"), "items")
+    return {field: answer}
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+# ==================== SERVER ====================
+
+class ConcurrentHTTPServer(ThreadingHTTPServer):
+    """Listen backlog sized for a client's full concurrency (the default of 5 drops bursts of new connections)"""
+    request_queue_size = 256
+
+class MockLLMServer:
+    """Threaded HTTP server with the Messages and Message Batches endpoints"""
+
+    def __init__(self, host=HOST, port=PORT, latency=LATENCY_DISTRIBUTION, median_seconds=LATENCY_MEDIAN_SECONDS,
+                 sigma=LATENCY_SIGMA, seconds_per_output_token=SECONDS_PER_OUTPUT_TOKEN,
+                 rate_limit_error_rate=RATE_LIMIT_ERROR_RATE, overloaded_error_rate=OVERLOADED_ERROR_RATE,
+                 seed=RANDOM_SEED, placeholder_loss_rate=PLACEHOLDER_LOSS_RATE):
+        self.latency = latency
+        self.median_seconds = median_seconds
+        self.sigma = sigma
+        self.seconds_per_output_token = seconds_per_output_token
+        self.rate_limit_error_rate = rate_limit_error_rate
+        self.overloaded_error_rate = overloaded_error_rate
+        self.placeholder_loss_rate = placeholder_loss_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.batches = {}
+        self.cached_prefixes = set()
+        self.reset_stats()
+        self.httpd = ConcurrentHTTPServer((host, port), self.handler_class())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {"calls": 0, "batch_requests": 0, "rate_limited": 0, "overloaded": 0,
+                          "input_tokens": 0, "output_tokens": 0, "placeholders_dropped": 0, "stages": {}}
+
+    def snapshot(self):
+        with self.lock:
+            return json.loads(json.dumps(self.stats))
+
+    # ---- latency and errors ----
+
+    def draw(self, kind):
+        with self.lock:
+            if kind == "latency":
+                if self.latency == "fixed":
+                    return self.median_seconds
+                if self.latency == "uniform":
+                    return self.random.uniform(0.5 * self.median_seconds, 1.5 * self.median_seconds)
+                if self.latency == "exponential":
+                    return self.random.expovariate(1.0 / self.median_seconds) if self.median_seconds > 0 else 0.0
+                return self.random.lognormvariate(0.0, self.sigma) * self.median_seconds
+            return self.random.random()
+
+    def injected_error(self):
+        """(status, error type) for an injected failure, or None"""
+        roll = self.draw("error")
+        if roll < self.rate_limit_error_rate:
+            self.count("rate_limited")
+            return 429, "rate_limit_error"
+        if roll < self.rate_limit_error_rate + self.overloaded_error_rate:
+            self.count("overloaded")
+            return 529, "overloaded_error"
+        return None
+
+    def lose_placeholders(self, answer):
+        """Drop the first placeholder of generated requirement texts at PLACEHOLDER_LOSS_RATE"""
+        if isinstance(answer, list):
+            return [self.lose_placeholders(item) for item in answer]
+        if not isinstance(answer, dict):
+            return answer
+        answer = {key: self.lose_placeholders(value) if key == "requirements" else value for key, value in answer.items()}
+        for field in ("improved_requirement", "requirement_text", "requirement"):
+            placeholder = re.search(r"\[[^\]]+\]", str(answer.get(field, "")))
+            if placeholder and self.placeholder_loss_rate and self.draw("error") < self.placeholder_loss_rate:
+                answer[field] = " ".join(answer[field].replace(placeholder.group(0), "", 1).split())
+                self.count("placeholders_dropped")
+        return answer
+
+    def count(self, field, amount=1):
+        with self.lock:
+            self.stats[field] += amount
+
+    # ---- messages ----
+
+    def usage(self, params, output_text):
+        """Usage block; the system prefix up to its last cache_control is a cache write once, a read after"""
+        system = params.get("system") or []
+        blocks = system if isinstance(system, list) else [{"type": "text", "text": system}]
+        cached_upto = max((i + 1 for i, block in enumerate(blocks) if block.get("cache_control")), default=0)
+        prefix = json.dumps(blocks[:cached_upto]) + json.dumps(params.get("tools", []))
+        prefix_tokens = estimate_tokens(prefix) if cached_upto else 0
+        digest = hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+        with self.lock:
+            cache_hit = digest in self.cached_prefixes
+            self.cached_prefixes.add(digest)
+        uncached = "".join(block.get("text", "") for block in blocks[cached_upto:]) + json.dumps(params["messages"])
+        return {
+            "input_tokens": estimate_tokens(uncached) + (0 if cached_upto else estimate_tokens(prefix)),
+            "output_tokens": estimate_tokens(output_text),
+            "cache_creation_input_tokens": 0 if cache_hit else prefix_tokens,
+            "cache_read_input_tokens": prefix_tokens if cache_hit else 0,
+        }
+
+    def message(self, params):
+        """Complete Message for one request; honours prefill and max_tokens like the real API"""
+        stage = stage_of(params)
+        answer = canned_answer(stage, user_text(params))
+        if not stage.startswith("repair"):
+            answer = self.lose_placeholders(answer)
+        with self.lock:
+            self.stats["calls"] += 1
+            self.stats["stages"][stage] = self.stats["stages"].get(stage, 0) + 1
+        max_tokens = params.get("max_tokens", 1024)
+        tool_name = (params.get("tool_choice") or {}).get("name")
+        if tool_name:
+            tool = next((tool for tool in params.get("tools", []) if tool.get("name") == tool_name), {})
+            tool_args = tool_input(answer, tool)
+            text = json.dumps(tool_args, ensure_ascii=False)
+            stop_reason = "max_tokens" if estimate_tokens(text) > max_tokens else "tool_use"
+            content = [{"type": "tool_use", "id": f"toolu_{next(self.ids):06d}", "name": tool_name,
+                        "input": tool_args if stop_reason == "tool_use" else {}}]
+        else:
+            full = json.dumps(answer, ensure_ascii=False, indent=2)
+            prefill = params["messages"][-1]["content"] if params["messages"][-1]["role"] == "assistant" else ""
+            text = full[len(prefill):] if full.startswith(prefill) else full
+            stop_reason = "end_turn"
+            if estimate_tokens(text) > max_tokens:
+                text, stop_reason = text[:max_tokens * 4], "max_tokens"
+            content = [{"type": "text", "text": text}]
+        usage = self.usage(params, text)
+        with self.lock:
+            self.stats["input_tokens"] += usage["input_tokens"]
+            self.stats["output_tokens"] += usage["output_tokens"]
+        return {"id": f"msg_{next(self.ids):06d}", "type": "message", "role": "assistant", "model": params.get("model", "mock"),
+                "content": content, "stop_reason": stop_reason, "stop_sequence": None, "usage": usage}
+
+    def stream_events(self, message):
+        """SSE events for a Message, one delta per STREAM_CHUNK_CHARACTERS"""
+        block = message["content"][0]
+        if block["type"] == "text":
+            text, start, delta = block["text"], {"type": "text", "text": ""}, ("text_delta", "text")
+        else:
+            text, start, delta = json.dumps(block["input"], ensure_ascii=False), dict(block, input={}), ("input_json_delta", "partial_json")
+        yield "message_start", {"type": "message_start", "message": dict(
+            message, content=[], stop_reason=None, usage=dict(message["usage"], output_tokens=1))}
+        yield "content_block_start", {"type": "content_block_start", "index": 0, "content_block": start}
+        for i in range(0, len(text), STREAM_CHUNK_CHARACTERS):
+            yield "content_block_delta", {"type": "content_block_delta", "index": 0,
+                                          "delta": {"type": delta[0], delta[1]: text[i:i + STREAM_CHUNK_CHARACTERS]}}
+        yield "content_block_stop", {"type": "content_block_stop", "index": 0}
+        yield "message_delta", {"type": "message_delta", "delta": {"stop_reason": message["stop_reason"], "stop_sequence": None},
+                                "usage": {"output_tokens": message["usage"]["output_tokens"]}}
+        yield "message_stop", {"type": "message_stop"}
+
+    # ---- batches ----
+
+    def create_batch(self, body):
+        batch_id = f"msgbatch_{next(self.ids):06d}"
+        with self.lock:
+            self.batches[batch_id] = {"requests": body["requests"], "polls": 0, "results": None,
+                                      "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+            self.stats["batch_requests"] += len(body["requests"])
+        return self.batch_object(batch_id)
+
+    def batch_object(self, batch_id):
+        batch = self.batches[batch_id]
+        ended = batch["polls"] >= BATCH_POLLS_UNTIL_ENDED
+        if ended and batch["results"] is None:
+            batch["results"] = [
+                {"custom_id": request["custom_id"], "result": {"type": "succeeded", "message": self.message(request["params"])}}
+                for request in batch["requests"]
+            ]
+        count = len(batch["requests"])
+        return {
+            "id": batch_id, "type": "message_batch", "processing_status": "ended" if ended else "in_progress",
+            "request_counts": {"processing": 0 if ended else count, "succeeded": count if ended else 0,
+                               "errored": 0, "canceled": 0, "expired": 0},
+            "created_at": batch["created_at"], "expires_at": batch["created_at"], "ended_at": batch["created_at"] if ended else None,
+            "archived_at": None, "cancel_initiated_at": None,
+            "results_url": f"{self.base_url}/v1/messages/batches/{batch_id}/results" if ended else None,
+        }
+
+    def handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, status, obj, headers=None, content_type="application/json"):
+                body = obj if isinstance(obj, bytes) else json.dumps(obj).encode("utf-8")
+                self.send_response(status)
+                self.send_header("content-type", content_type)
+                self.send_header("content-length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, str(value))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def rate_limit_headers(self):
+                return {
+                    "anthropic-ratelimit-requests-limit": ADVERTISED_RPM,
+                    "anthropic-ratelimit-requests-remaining": ADVERTISED_RPM,
+                    "anthropic-ratelimit-input-tokens-limit": ADVERTISED_INPUT_TPM,
+                    "anthropic-ratelimit-input-tokens-remaining": ADVERTISED_INPUT_TPM,
+                    "anthropic-ratelimit-output-tokens-limit": ADVERTISED_OUTPUT_TPM,
+                    "anthropic-ratelimit-output-tokens-remaining": ADVERTISED_OUTPUT_TPM,
+                }
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("content-length", 0))) or b"{}")
+                if self.path.startswith("/v1/messages/batches"):
+                    self.send_json(200, server.create_batch(body))
+                    return
+                if not self.path.startswith("/v1/messages"):
+                    self.send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+                    return
+                time.sleep(server.draw("latency"))
+                error = server.injected_error()
+                if error:
+                    status, error_type = error
+                    headers = self.rate_limit_headers()
+                    if status == 429:
+                        headers.update({"retry-after": RETRY_AFTER_SECONDS, "anthropic-ratelimit-requests-remaining": 0})
+                    self.send_json(status, {"type": "error", "error": {"type": error_type, "message": "Injected by mock server"}}, headers)
+                    return
+                message = server.message(body)
+                generation_seconds = server.seconds_per_output_token * message["usage"]["output_tokens"]
+                if not body.get("stream"):
+                    time.sleep(generation_seconds)
+                    self.send_json(200, message, self.rate_limit_headers())
+                    return
+                events = list(server.stream_events(message))
+                self.send_response(200)
+                self.send_header("content-type", "text/event-stream")
+                self.send_header("cache-control", "no-cache")
+                self.send_header("connection", "close")
+                for name, value in self.rate_limit_headers().items():
+                    self.send_header(name, str(value))
+                self.end_headers()
+                self.close_connection = True
+                try:
+                    for name, data in events:
+                        self.wfile.write(f"event: {name}\ndata: {json.dumps(data)}\n\n".encode("utf-8"))
+                        self.wfile.flush()
+                        time.sleep(generation_seconds / len(events))
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # client aborted the stream early
+
+            def do_GET(self):
+                parts = self.path.split("?")[0].strip("/").split("/")
+                if len(parts) < 4 or parts[3] not in server.batches:
+                    self.send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+                    return
+                with server.lock:
+                    batch = server.batches[parts[3]]
+                    if parts[-1] != "results":
+                        batch["polls"] += 1
+                batch_object = server.batch_object(parts[3])
+                if parts[-1] == "results":
+                    lines = "".join(json.dumps(result) + "\n" for result in batch["results"] or [])
+                    self.send_json(200, lines.encode("utf-8"), content_type="application/binary")
+                else:
+                    self.send_json(200, batch_object)
+
+        return Handler
+
+def mock_client(server, **kwargs):
+    """AsyncAnthropic client pointed at a running MockLLMServer"""
+    return AsyncAnthropic(api_key="mock-key", base_url=server.base_url, max_retries=kwargs.pop("max_retries", 0), **kwargs)
+
+# ==================== MAIN ====================
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline stand-in for the Anthropic Messages API")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--latency", choices=["fixed", "uniform", "lognormal", "exponential"], default=LATENCY_DISTRIBUTION)
+    parser.add_argument("--median-seconds", type=float, default=LATENCY_MEDIAN_SECONDS)
+    parser.add_argument("--sigma", type=float, default=LATENCY_SIGMA, help="lognormal spread")
+    parser.add_argument("--seconds-per-output-token", type=float, default=SECONDS_PER_OUTPUT_TOKEN)
+    parser.add_argument("--rate-limit-error-rate", type=float, default=RATE_LIMIT_ERROR_RATE, help="share of calls answered with 429")
+    parser.add_argument("--overloaded-error-rate", type=float, default=OVERLOADED_ERROR_RATE, help="share of calls answered with 529")
+    parser.add_argument("--seed", type=int, default=RANDOM_SEED)
+    parser.add_argument("--placeholder-loss-rate", type=float, default=PLACEHOLDER_LOSS_RATE,
+                        help="share of generated requirement texts with one placeholder dropped")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    server = MockLLMServer(args.host, args.port, args.latency, args.median_seconds, args.sigma, args.seconds_per_output_token,
+                           args.rate_limit_error_rate, args.overloaded_error_rate, args.seed, args.placeholder_loss_rate)
+    print(f"Mock Messages API on {server.base_url} (set API_BASE_URL to this; Ctrl+C to stop)")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(server.snapshot(), indent=2))
+        server.httpd.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -7,12 +7,30 @@ Requirements Processor - COMPLETE 42 INCOSE RULES + ISO 29148
 - Properly extracts vague terms removed and tolerances added
 """
 
+import numpy as np
 import pandas as pd
-from anthropic import Anthropic
+from anthropic import AsyncAnthropic, DefaultAsyncHttpxClient
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Font, NamedStyle
+import argparse
+import asyncio
+import csv
+import difflib
+import gzip
+import hashlib
+import importlib
+import itertools
+import json
+import multiprocessing
 import os
+import random
+import sys
 import time
+import zlib
 from datetime import datetime
 import re
+import sqlite3
 
 # ==================== CONFIGURATION ====================
 
@@ -24,7 +42,129 @@ OUTPUT_FILE = f"/Users/kataschiller/Py/Requirements_Projekt/second_output_requir
 
 # API settings
 MODEL = "claude-sonnet-4-20250514"
-MAX_TOKENS = 20000
+MAX_TOKENS = 20000  # Ceiling; each call asks for a per-stage budget below it
+
+# Per-stage output budgets (max_tokens), sized from the requirement length and planned split count.
+# Output-token rate limits are charged by max_tokens up front, so tight budgets leave room for more
+# calls in parallel; a response cut off at its budget is continued, not retried from scratch
+ANALYZE_OUTPUT_TOKENS = 600
+REQUIREMENT_OUTPUT_TOKENS = 1200  # Per improved or split-off requirement, plus its own text length
+MAX_CONTINUATIONS = 3
+
+# Concurrency settings
+MAX_CONCURRENCY = 8  # Requirements in flight at once (1 = sequential processing)
+
+# Rate limit settings (per-minute budgets of your API tier; synced from response headers)
+RATE_LIMIT_RPM = 50
+RATE_LIMIT_INPUT_TPM = 30000
+RATE_LIMIT_OUTPUT_TPM = 8000
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+
+# Processing mode: "interactive" (concurrent Messages API calls) or "batch" (Message Batches API,
+# lowest cost per requirement, results typically within minutes to hours)
+PROCESSING_MODE = "interactive"
+BATCH_POLL_SECONDS = 60
+API_BASE_URL = None  # Override to point the client at a local stand-in endpoint for testing
+
+# Fused mode: one call per requirement returns the split decision and the final requirement(s);
+# falls back to the two-stage analyze → improve/split path when the fused response is invalid
+FUSED_STAGES = False
+
+# Packed mode: several atomic requirements share one improve call (keyed JSON array response);
+# packs that fail to parse are bisected and retried
+PACK_IMPROVE = False
+PACK_MAX_REQUIREMENTS = 10
+PACK_MAX_INPUT_TOKENS = 3000  # Requirement text per pack; the rules prefix is sent once per call either way
+PACK_LINGER_SECONDS = 0.2  # Interactive mode: how long an open pack waits for more atomic requirements
+
+# Fan-out mode: a split into at least FAN_OUT_MIN_CAPABILITIES capabilities runs one improve-style
+# call per capability, concurrently, instead of one long split call (a failed capability is
+# retried on its own; only when every capability fails does it fall back to the split call)
+FAN_OUT_SPLITS = False
+FAN_OUT_MIN_CAPABILITIES = 3
+
+# Local R18 pre-classifier: clearly atomic / clearly compound requirements skip the analyze call.
+# Scores: 0 = no combinator, enumeration, "/", linking clause or second modal verb
+PRECLASSIFY_ATOMICITY = False
+PRECLASSIFY_ATOMIC_MAX_SCORE = 0
+PRECLASSIFY_COMPOUND_MIN_SCORE = 5
+
+# Local R7-R10 scanner (vague terms, escape clauses, open-ended clauses, "be able to");
+# VAGUE_TERMS_FILE may hold extra terms in a Term / Vague_Term column (optional Rule column)
+SCAN_VAGUE_TERMS = True
+VAGUE_TERMS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vague.xlsx")
+
+# Sharded mode (--shards N): worker processes with their own part of the workbook, API key and
+# rate limiter; keys are assigned round-robin (empty = API_KEY for every shard, limits split between them)
+SHARD_COUNT = 1
+SHARD_STRATEGY = "range"  # "range" (contiguous rows) or "hash" (duplicates stay in one shard)
+SHARD_API_KEYS = []
+SHARD_PROGRESS_SECONDS = 30
+
+# Input: .xlsx, .csv, .jsonl or .parquet (first column / first JSON field holds the requirement).
+# With --stream-input rows are read lazily, INPUT_CHUNK_ROWS at a time, and processed as they
+# arrive: first results within seconds and no full table in memory. Near-duplicate and template
+# grouping need the whole set and are skipped (repeated text is answered from the response cache)
+STREAM_INPUT = False
+INPUT_CHUNK_ROWS = 500
+
+# Output formats written while processing: any of "xlsx" (OUTPUT_FILE), "csv", "parquet"
+OUTPUT_FORMATS = ["xlsx"]
+
+# Near-duplicate clustering (R30): reworded copies of a requirement are sent to the API once
+DEDUPLICATE_REQUIREMENTS = True
+DUPLICATE_SIMILARITY = 0.9  # Jaccard similarity of character shingles needed to count as a duplicate
+
+# Placeholder templates: rows that differ only in [PLACEHOLDER] names are processed once
+SHARE_PLACEHOLDER_TEMPLATES = True
+
+# Placeholder masking: [PLACEHOLDER] names go to the model as short tokens [P1], [P2], ... and
+# are put back afterwards. A sub-requirement that lost or altered one gets a narrow repair call.
+MASK_PLACEHOLDERS = True
+
+# Local rule check of every generated requirement_text (R9, R16, R17, R21, R24, R26); only the
+# sub-requirements with findings are sent back, in a repair call that lists those findings
+CHECK_RULES = True
+
+# Structured output: each stage answers through a tool whose JSON schema matches the field names
+# below; answers missing required fields get a narrow repair call instead of a full re-request
+USE_TOOL_OUTPUT = True
+
+# Streamed responses are checked as they arrive: malformed output aborts the call early,
+# and every sub-requirement of a split array is validated the moment it closes
+STREAM_RESPONSES = True
+
+# Checkpoint journal: every finished requirement is appended here; run with --resume to continue
+JOURNAL_FILE = os.path.join(os.path.dirname(OUTPUT_FILE), "requirements_journal.jsonl")
+
+# Diff mode: rows whose input text (case and whitespace normalized) is unchanged from this
+# earlier output workbook keep its sub-requirements; only new or changed rows are sent
+# to the API (or pass --previous-output)
+PREVIOUS_OUTPUT_FILE = None
+
+# Response cache (set CACHE_FILE = None to disable)
+CACHE_FILE = os.path.join(os.path.dirname(OUTPUT_FILE), "response_cache.sqlite")
+CACHE_MAX_AGE_DAYS = 30
+CACHE_MAX_SIZE_MB = 500
+
+# Record/replay: API exchanges are written to (record) or answered from (replay) a gzip cassette,
+# keyed by a hash of the request. "replay" never calls the API and lists the rows that would need
+# fresh calls; "replay_or_record" calls the API only for requests the cassette cannot answer
+CASSETTE_MODE = None  # None, "record", "replay" or "replay_or_record"
+CASSETTE_FILE = os.path.join(os.path.dirname(OUTPUT_FILE), "requirements_cassette.jsonl.gz")
+CASSETTE_REPORT_FILE = os.path.join(os.path.dirname(OUTPUT_FILE), "requirements_cassette_mismatches.json")
+
+# Per-call metrics, written at the end of every run (set to None to skip a file)
+METRICS_FILE = os.path.join(os.path.dirname(OUTPUT_FILE), "requirements_metrics.json")
+PROMETHEUS_FILE = os.path.join(os.path.dirname(OUTPUT_FILE), "requirements_metrics.prom")
+
+# Pricing in USD per million tokens (MODEL); cache writes/reads are billed relative to input
+PRICE_INPUT_PER_MTOK = 3.00
+PRICE_OUTPUT_PER_MTOK = 15.00
+CACHE_WRITE_PRICE_FACTOR = 1.25
+CACHE_READ_PRICE_FACTOR = 0.10
+BATCH_PRICE_FACTOR = 0.50
 
 # ==================== COMPLETE 42 INCOSE RULES ====================
 
@@ -217,19 +357,13 @@ ALL placeholders in format [PLACEHOLDER_NAME] from original requirement MUST be
 """
 
 # ==================== ENHANCED PROMPTS WITH PLACEHOLDER PRESERVATION ====================
+# The rules and the stage instructions are sent as cached system blocks (prompt caching),
+# so only the user message below changes from one requirement to the next.
 
-ANALYZE_SPLIT_PROMPT = """You are an expert in Requirements Engineering according to ISO 29148 and all 42 INCOSE Guide rules.
+SYSTEM_PROMPT = """You are an expert in Requirements Engineering according to ISO 29148 and all 42 INCOSE Guide rules.
+""" + COMPLETE_INCOSE_RULES
 
-TASK: Analyze whether this requirement MUST be split or is already ATOMIC.
-
-ORIGINAL REQUIREMENT:
-{customer_req}
-
-{incose_rules}
-
-CRITICAL: Identify and preserve ALL placeholders in format [PLACEHOLDER_NAME]
-
-DECISION LOGIC (R18 - Single Thought Sentence):
+SPLIT_DECISION_LOGIC = """DECISION LOGIC (R18 - Single Thought Sentence):
 
 DO NOT SPLIT when:
 - Describes ONE coherent capability
@@ -242,30 +376,9 @@ MUST SPLIT when:
 - Each action can be verified independently
 - Contains enumeration of different items (R22)
 - Multiple unrelated conditions or scenarios
+"""
 
-OUTPUT FORMAT (JSON):
-{{
-  "should_split": true|false,
-  "reasoning": "Detailed justification referencing R18",
-  "number_of_atomic_requirements": 1-10,
-  "identified_capabilities": ["Capability 1", "Capability 2", ...],
-  "placeholders_found": ["[PLACEHOLDER_1]", "[PLACEHOLDER_2]", ...]
-}}
-
-Respond ONLY with valid JSON."""
-
-IMPROVE_REQUIREMENT_PROMPT = """You are an expert in Requirements Engineering according to ISO 29148 and all 42 INCOSE Guide rules.
-
-TASK: Transform this requirement into ISO 29148 + INCOSE compliant requirement.
-
-ORIGINAL REQUIREMENT:
-{customer_req}
-
-{incose_rules}
-
-CRITICAL: PRESERVE ALL PLACEHOLDERS [LIKE_THIS] FROM ORIGINAL IN YOUR OUTPUT
-
-COMPREHENSIVE INCOSE IMPROVEMENT CHECKLIST:
+INCOSE_CHECKLIST = """COMPREHENSIVE INCOSE IMPROVEMENT CHECKLIST:
 
 **Structure (R1):** [WHEN condition], [ENTITY] shall [ACTION] [OBJECT] [PERFORMANCE ± tolerance]
 **Voice (R2):** Active - "The [System_X] shall..." not passive
@@ -295,7 +408,29 @@ COMPREHENSIVE INCOSE IMPROVEMENT CHECKLIST:
 **Ranges (R33):** Provide tolerances: X ± Y - DOCUMENT ALL TOLERANCES ADDED
 **Measurable (R34-R35):** Specific metrics, not "fast" or "soon"
 **Consistency (R36-R40):** Consistent terms, acronyms, decimals
+"""
+
+ANALYZE_SPLIT_PROMPT = """TASK: Analyze whether the requirement in the user message MUST be split or is already ATOMIC.
+
+CRITICAL: Identify and preserve ALL placeholders in format [PLACEHOLDER_NAME]
+
+""" + SPLIT_DECISION_LOGIC + """
+OUTPUT FORMAT (JSON):
+{
+  "should_split": true|false,
+  "reasoning": "Detailed justification referencing R18",
+  "number_of_atomic_requirements": 1-10,
+  "identified_capabilities": ["Capability 1", "Capability 2", ...],
+  "placeholders_found": ["[PLACEHOLDER_1]", "[PLACEHOLDER_2]", ...]
+}
 
+Respond ONLY with valid JSON."""
+
+IMPROVE_REQUIREMENT_PROMPT = """TASK: Transform the requirement in the user message into ISO 29148 + INCOSE compliant requirement.
+
+CRITICAL: PRESERVE ALL PLACEHOLDERS [LIKE_THIS] FROM ORIGINAL IN YOUR OUTPUT
+
+""" + INCOSE_CHECKLIST + """
 CRITICAL OUTPUT REQUIREMENTS:
 1. "vague_terms_removed": List EVERY vague/subjective term replaced with its specific measurable replacement
    Format: ["original_vague_term → specific_measurable_replacement", ...]
@@ -306,7 +441,7 @@ CRITICAL OUTPUT REQUIREMENTS:
    Example: ["response time: 2.0 ± 0.5 seconds", "accuracy: ≥95%", "capacity: 1000 ± 50 users"]
 
 OUTPUT FORMAT (JSON):
-{{
+{
   "requirement_type": "Functional|Performance|Interface|Safety|Security|etc.",
   "improved_requirement": "Complete INCOSE-compliant requirement with ALL [PLACEHOLDERS] preserved",
   "verification_method": "Test|Inspection|Analysis|Demonstration",
@@ -316,28 +451,18 @@ OUTPUT FORMAT (JSON):
   "tolerances_added": ["metric: value ± tolerance units", ...],
   "escape_clauses_removed": ["clause1", "clause2", ...],
   "improvements_summary": "Brief description of all transformations"
-}}
+}
 
 VERIFY: All [PLACEHOLDERS] from input appear in improved_requirement
 
 Respond ONLY with valid JSON."""
 
-SPLIT_REQUIREMENT_PROMPT = """You are an expert in Requirements Engineering according to ISO 29148 and all 42 INCOSE Guide rules.
-
-TASK: Split this requirement into {num_requirements} atomic, INCOSE-compliant requirements.
-
-ORIGINAL REQUIREMENT:
-{customer_req}
-
-IDENTIFIED CAPABILITIES:
-{capabilities}
-
-{incose_rules}
+SPLIT_REQUIREMENT_PROMPT = """TASK: Split the requirement in the user message into the requested number of atomic, INCOSE-compliant requirements.
 
 CRITICAL: DISTRIBUTE PLACEHOLDERS [LIKE_THIS] APPROPRIATELY TO EACH SUB-REQUIREMENT
 
 SPLITTING RULES (R18):
-- Create exactly {num_requirements} independent requirements
+- Create exactly the requested number of independent requirements
 - Each = ONE capability from identified list
 - Each follows R1 structure
 - Apply ALL 42 INCOSE rules to each sub-requirement
@@ -349,7 +474,7 @@ CRITICAL OUTPUT REQUIREMENTS FOR EACH SUB-REQUIREMENT:
 
 OUTPUT FORMAT (JSON array):
 [
-  {{
+  {
     "sub_id": "1",
     "requirement_type": "Functional|Performance|etc.",
     "requirement_text": "Complete INCOSE-compliant requirement with relevant [PLACEHOLDERS]",
@@ -359,7 +484,7 @@ OUTPUT FORMAT (JSON array):
     "vague_terms_removed": ["original → replacement", ...],
     "tolerances_added": ["metric: value ± tolerance", ...],
     "improvements_summary": "Brief summary"
-  }},
+  },
   ...
 ]
 
@@ -367,223 +492,2279 @@ VERIFY: All original [PLACEHOLDERS] distributed across sub-requirements
 
 Respond ONLY with valid JSON array."""
 
+FUSED_REQUIREMENT_PROMPT = """TASK: Decide whether the requirement in the user message must be split (R18), then deliver the final ISO 29148 + INCOSE compliant requirement(s) in the same response.
+
+CRITICAL: PRESERVE ALL PLACEHOLDERS [LIKE_THIS] FROM ORIGINAL - DISTRIBUTE THEM TO THE SUB-REQUIREMENTS THEY BELONG TO
+
+""" + SPLIT_DECISION_LOGIC + """
+If the requirement is ATOMIC, "requirements" holds exactly ONE improved requirement.
+If it MUST be split, "requirements" holds exactly one requirement per identified capability.
+
+""" + INCOSE_CHECKLIST + """
+CRITICAL OUTPUT REQUIREMENTS FOR EACH REQUIREMENT:
+1. "vague_terms_removed": List EVERY vague term replaced with measurable criteria
+2. "tolerances_added": List EVERY quantitative metric with tolerance
+
+OUTPUT FORMAT (JSON):
+{
+  "should_split": true|false,
+  "reasoning": "Detailed justification referencing R18",
+  "number_of_atomic_requirements": 1-10,
+  "identified_capabilities": ["Capability 1", "Capability 2", ...],
+  "requirements": [
+    {
+      "sub_id": "1",
+      "requirement_type": "Functional|Performance|Interface|Safety|Security|etc.",
+      "requirement_text": "Complete INCOSE-compliant requirement with relevant [PLACEHOLDERS]",
+      "verification_method": "Test|Inspection|Analysis|Demonstration",
+      "placeholders_used": ["[PLACEHOLDER_X]", ...],
+      "incose_rules_applied": ["R1", "R2", "R7", ...],
+      "vague_terms_removed": ["original → replacement", ...],
+      "tolerances_added": ["metric: value ± tolerance", ...],
+      "improvements_summary": "Brief summary"
+    },
+    ...
+  ]
+}
+
+VERIFY: len(requirements) == number_of_atomic_requirements and all original [PLACEHOLDERS] appear
+
+Respond ONLY with valid JSON."""
+
+PACKED_IMPROVE_PROMPT = IMPROVE_REQUIREMENT_PROMPT + """
+
+PACKED INPUT: The user message may contain SEVERAL requirements, each introduced by "KEY: <key>".
+Transform every requirement independently, exactly as described above.
+Return a JSON array with one object per key, each in the output format above plus its "key":
+[
+  {"key": "R1", "requirement_type": "...", "improved_requirement": "...", ...},
+  {"key": "R2", ...}
+]
+
+Respond ONLY with the valid JSON array."""
+
+CAPABILITY_REQUIREMENT_PROMPT = IMPROVE_REQUIREMENT_PROMPT + """
+
+CAPABILITY INPUT: The user message names ONE capability of the original requirement. Transform only that
+capability into one atomic requirement (R18); the other capabilities get their own requirements.
+Use the placeholders listed for this requirement - not every placeholder of the original."""
+
+REPAIR_FIELDS_PROMPT = """TASK: An earlier answer about the requirement in the user message left out required fields.
+
+Supply ONLY the missing fields named in the user message, for each listed record, consistent with the partial answer
+and with all 42 INCOSE rules. Preserve ALL placeholders [LIKE_THIS] exactly.
+
+Respond by calling the tool."""
+
+REPAIR_PLACEHOLDERS_PROMPT = """TASK: The rewritten requirement in the user message lost or altered placeholders of the original requirement.
+
+Put every listed placeholder back into the rewritten requirement exactly as written (same brackets, spelling and case),
+where it belongs according to the original. An altered placeholder (misspelled, renamed or re-cased) is replaced by the
+placeholder it stands for. Change nothing else.
+
+OUTPUT FORMAT (JSON):
+{
+  "requirement_text": "The rewritten requirement with the placeholders restored"
+}
+
+Respond ONLY with valid JSON."""
+
+REPAIR_RULES_PROMPT = """TASK: The rewritten requirement in the user message still breaks the INCOSE rules listed under FINDINGS.
+
+Revise it so that every finding is resolved as the rule asks, keeping its meaning, its measurable values and tolerances,
+and ALL placeholders [LIKE_THIS] exactly. Change nothing else.
+
+OUTPUT FORMAT (JSON):
+{
+  "requirement_text": "The revised requirement"
+}
+
+Respond ONLY with valid JSON."""
+
+REQUIREMENT_MESSAGE = """ORIGINAL REQUIREMENT:
+{customer_req}"""
+
+SPLIT_REQUIREMENT_MESSAGE = """Split into {num_requirements} atomic requirements.
+
+ORIGINAL REQUIREMENT:
+{customer_req}
+
+IDENTIFIED CAPABILITIES:
+{capabilities}"""
+
+CAPABILITY_REQUIREMENT_MESSAGE = """Requirement {number} of {num_requirements}.
+
+ORIGINAL REQUIREMENT:
+{customer_req}
+
+CAPABILITY:
+{capability}
+
+PLACEHOLDERS FOR THIS REQUIREMENT:
+{placeholders}"""
+
+REPAIR_PLACEHOLDERS_MESSAGE = """ORIGINAL REQUIREMENT:
+{customer_req}
+
+REWRITTEN REQUIREMENT:
+{requirement_text}
+
+PLACEHOLDERS TO RESTORE:
+{missing}
+
+ALTERED PLACEHOLDERS:
+{altered}"""
+
+REPAIR_RULES_MESSAGE = """ORIGINAL REQUIREMENT:
+{customer_req}
+
+REWRITTEN REQUIREMENT:
+{requirement_text}
+
+FINDINGS:
+{findings}"""
+
+REPAIR_FIELDS_MESSAGE = """{original_message}
+
+PARTIAL ANSWER:
+{partial_answer}
+
+MISSING FIELDS:
+{missing}"""
+
 # ==================== UTILITY FUNCTIONS ====================
 
 def extract_placeholders(text):
     """Extract all placeholders [LIKE_THIS] from text"""
     return re.findall(r'\[([^\]]+)\]', text)
 
+def missing_placeholders(original_text, generated_text):
+    """Placeholders of the original missing from the generated text, in original order"""
+    generated_placeholders = set(extract_placeholders(generated_text))
+    return [name for name in dict.fromkeys(extract_placeholders(original_text)) if name not in generated_placeholders]
+
 def verify_placeholders_preserved(original_text, generated_text):
     """Verify all placeholders from original are in generated text"""
-    original_placeholders = set(extract_placeholders(original_text))
-    generated_placeholders = set(extract_placeholders(generated_text))
-    
-    missing = original_placeholders - generated_placeholders
+    missing = missing_placeholders(original_text, generated_text)
     
     if missing:
-        print(f"WARNING: Missing placeholders: {missing}")
+        print(f"WARNING: Missing placeholders: {set(missing)}")
         return False
     return True
 
 def init_claude_client():
     """Initialize Claude API Client"""
-    if API_KEY == "" or API_KEY == "YOUR_API_KEY_HERE":
+    replaying = CASSETTE is not None and CASSETTE.mode == "replay"
+    if not replaying and (API_KEY == "" or API_KEY == "YOUR_API_KEY_HERE"):
         raise ValueError("ERROR: Please insert your Claude API Key in the script!")
-    return Anthropic(api_key=API_KEY)
+    # Retries are handled by call_claude so they go through the shared rate limiter
+    http_client = DefaultAsyncHttpxClient(transport=CASSETTE) if CASSETTE is not None else None
+    return AsyncAnthropic(api_key=API_KEY or "cassette-replay", base_url=API_BASE_URL, max_retries=0, http_client=http_client)
+
+# ==================== INPUT READERS ====================
+# Requirements are read lazily, row by row: Excel through openpyxl's read-only iter_rows,
+# CSV/JSONL/Parquet through their own incremental readers. Only the first column (JSONL: the
+# first field of each object) is read. Category numbering counts every data row, empty ones
+# included, so IDs match the row numbers of the input file.
+
+def iter_excel_values(filepath):
+    workbook = load_workbook(filepath, read_only=True, data_only=True)
+    try:
+        for row in workbook.active.iter_rows(min_row=2, max_col=1, values_only=True):
+            yield row[0] if row else None
+    finally:
+        workbook.close()
+
+def iter_csv_values(filepath):
+    with open(filepath, newline="", encoding="utf-8-sig") as f:
+        reader = csv.reader(f)
+        next(reader, None)  # Header
+        for row in reader:
+            yield row[0] if row and row[0] != "" else None
+
+def iter_jsonl_values(filepath):
+    with open(filepath, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield next(iter(record.values()), None) if isinstance(record, dict) else record
+
+def iter_parquet_values(filepath):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("ERROR: Parquet input requires pyarrow (pip install pyarrow)")
+    parquet_file = pq.ParquetFile(filepath)
+    first_column = parquet_file.schema_arrow.names[0]
+    for batch in parquet_file.iter_batches(batch_size=INPUT_CHUNK_ROWS, columns=[first_column]):
+        yield from batch.column(0).to_pylist()
+
+INPUT_READERS = {
+    ".xlsx": iter_excel_values,
+    ".xlsm": iter_excel_values,
+    ".csv": iter_csv_values,
+    ".jsonl": iter_jsonl_values,
+    ".parquet": iter_parquet_values,
+}
+
+def iter_input_values(filepath):
+    """First-column value of every data row of an .xlsx, .csv, .jsonl or .parquet file (None when empty)"""
+    reader = INPUT_READERS.get(os.path.splitext(filepath)[1].lower())
+    if reader is None:
+        raise ValueError(f"ERROR: Unsupported input file type '{filepath}' (use {', '.join(INPUT_READERS)})")
+    if not os.path.exists(filepath):
+        raise FileNotFoundError(f"ERROR: File '{filepath}' not found!")
+    for value in reader(filepath):
+        yield None if value is None or (isinstance(value, float) and np.isnan(value)) else value
+
+def iter_requirements(filepath):
+    """(Category, customer_req) for every non-empty row, read lazily"""
+    for i, value in enumerate(iter_input_values(filepath)):
+        if value is not None:
+            yield f'REQ_{i+1:03d}', value
 
 def load_excel(filepath):
-    """Load Excel file with single column of requirements"""
+    """Load the requirements file (single column: .xlsx, .csv, .jsonl or .parquet) as Category / customer_req rows"""
+    row_count = 0
+    records = []
+    for i, value in enumerate(iter_input_values(filepath)):
+        row_count += 1
+        if value is not None:
+            records.append((f'REQ_{i+1:03d}', value))
+    print(f"Input loaded: {row_count} rows found")
+    print("   Column A → customer_req")
+    
+    # Rows without text are dropped; their Category numbers stay unused
+    df = pd.DataFrame(records, columns=['Category', 'customer_req'])
+    print(f"   {len(df)} requirements with text (filtered {row_count - len(df)} empty rows)")
+    return df
+
+# ==================== RATE LIMITING ====================
+
+class TokenBucket:
+    """Per-minute budget that refills continuously"""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.available = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.capacity / 60.0)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until `amount` units are available (0 if available now)"""
+        self.refill()
+        amount = min(amount, self.capacity)
+        if self.available >= amount:
+            return 0.0
+        return (amount - self.available) * 60.0 / self.capacity
+
+    def take(self, amount):
+        self.available -= min(amount, self.capacity)
+
+    def give_back(self, amount):
+        # A negative amount charges usage above the reservation against the budget
+        self.available = min(self.capacity, self.available + amount)
+
+    def sync(self, limit, remaining):
+        """Adopt the server's view of this budget from the rate-limit headers"""
+        self.refill()
+        if limit:
+            self.capacity = float(limit)
+        if remaining is not None:
+            self.available = min(self.available, self.capacity, float(remaining))
+
+class RateLimiter:
+    """Shared limiter for requests, input tokens and output tokens per minute"""
+
+    def __init__(self, requests_per_minute, input_tokens_per_minute, output_tokens_per_minute):
+        self.buckets = {
+            "requests": TokenBucket(requests_per_minute),
+            "input-tokens": TokenBucket(input_tokens_per_minute),
+            "output-tokens": TokenBucket(output_tokens_per_minute),
+        }
+        self.paused_until = 0.0
+
+    async def acquire(self, input_tokens, output_tokens):
+        """Wait until the call fits into every budget, then reserve it"""
+        amounts = {"requests": 1, "input-tokens": input_tokens, "output-tokens": output_tokens}
+        while True:
+            wait = max(
+                [self.paused_until - time.monotonic()]
+                + [bucket.wait_time(amounts[name]) for name, bucket in self.buckets.items()]
+            )
+            if wait <= 0:
+                for name, bucket in self.buckets.items():
+                    bucket.take(amounts[name])
+                return
+            # Re-check periodically: settle() can hand capacity back before `wait` elapses
+            await asyncio.sleep(min(wait, 1.0))
+
+    def settle(self, reserved_input_tokens, used_input_tokens, reserved_output_tokens, used_output_tokens):
+        """Correct a reservation once the response reports actual usage"""
+        self.buckets["input-tokens"].give_back(reserved_input_tokens - used_input_tokens)
+        self.buckets["output-tokens"].give_back(reserved_output_tokens - used_output_tokens)
+
+    def update_from_headers(self, headers):
+        """Read anthropic-ratelimit-* and retry-after headers from a response"""
+        if not headers:
+            return
+        for name, bucket in self.buckets.items():
+            limit = headers.get(f"anthropic-ratelimit-{name}-limit")
+            remaining = headers.get(f"anthropic-ratelimit-{name}-remaining")
+            if limit or remaining:
+                bucket.sync(limit, remaining)
+        retry_after = parse_retry_after(headers)
+        if retry_after:
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+    def backoff_delay(self, attempt, retry_after=None):
+        """Exponential backoff with full jitter, never shorter than retry-after"""
+        delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+        return max(delay, retry_after or 0.0)
+
+def parse_retry_after(headers):
+    """Seconds from a retry-after header, None if absent"""
     try:
-        df = pd.read_excel(filepath)
-        print(f"Excel loaded: {len(df)} rows found")
-        
-        # Single column input: first column is customer_req
-        if len(df.columns) >= 1:
-            df['customer_req'] = df.iloc[:, 0]  # Column A = index 0
-            print(f"   Column A ('{df.columns[0]}') → customer_req")
+        return float(headers.get("retry-after")) if headers and headers.get("retry-after") else None
+    except ValueError:
+        return None
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token) used for rate-limit reservations"""
+    return len(text) // 4 + 1
+
+RATE_LIMITER = RateLimiter(RATE_LIMIT_RPM, RATE_LIMIT_INPUT_TPM, RATE_LIMIT_OUTPUT_TPM)
+
+# Run totals from response.usage, reported at the end of processing
+TOKEN_USAGE = {
+    "input_tokens": 0,
+    "output_tokens": 0,
+    "cache_creation_input_tokens": 0,
+    "cache_read_input_tokens": 0,
+}
+
+# ==================== RESPONSE CACHE ====================
+
+class ResponseCache:
+    """On-disk SQLite cache of model responses, keyed by a hash of model + prompt + max_tokens"""
+
+    def __init__(self, path, max_age_days=30, max_size_mb=500):
+        self.path = path
+        self.max_age_seconds = max_age_days * 86400
+        self.max_size_bytes = max_size_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self.conn = None
+
+    @staticmethod
+    def make_key(model, prompt, max_tokens):
+        payload = json.dumps([model, prompt, max_tokens], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _connect(self):
+        # Opened lazily so importing the script never touches the disk
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                "size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self.evict()
+        return self.conn
+
+    def get(self, key):
+        """Cached response text for key, or None"""
+        if not self.path:
+            return None
+        try:
+            conn = self._connect()
+            row = conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or time.time() - row[1] > self.max_age_seconds:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+            conn.commit()
+        except sqlite3.Error as e:
+            self.disable(e)
+            return None
+        self.hits += 1
+        return row[0]
+
+    def put(self, key, response_text):
+        if not self.path:
+            return
+        now = time.time()
+        try:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, response_text, len(response_text.encode("utf-8")), now, now)
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            self.disable(e)
+
+    def disable(self, error):
+        """Stop using a cache file that fails (locked, corrupt, unwritable); calls go to the API"""
+        print(f"WARNING: Response cache {self.path} disabled for this run - {error}")
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except sqlite3.Error:
+                pass
+        self.conn = None
+        self.path = None
+
+    def evict(self):
+        """Drop entries past max age, then least recently used ones until under max size"""
+        conn = self.conn
+        conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age_seconds,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total > self.max_size_bytes:
+            for key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                total -= size
+                if total <= self.max_size_bytes:
+                    break
+        conn.commit()
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups * 100 if lookups else 0.0
+        return f"Response cache: {self.hits} hits, {self.misses} misses ({rate:.1f}% hit rate)"
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.evict()
+                self.conn.close()
+            except sqlite3.Error as e:
+                self.disable(e)
+            self.conn = None
+
+RESPONSE_CACHE = ResponseCache(CACHE_FILE, CACHE_MAX_AGE_DAYS, CACHE_MAX_SIZE_MB)
+
+# ==================== RECORD / REPLAY ====================
+# The cassette holds raw API exchanges (status, content type and body - streamed events and
+# batch results included) keyed by a hash of method, path and canonical request body, so a
+# replay works against any base URL. Requests it cannot answer in replay mode are collected
+# for the mismatch report instead of being sent.
+
+CASSETTE = None  # CassetteTransport while a cassette mode is active
+
+def cassette_key(method, path, body):
+    """Hash of one request: method, path and canonical JSON body (host and headers excluded)"""
+    try:
+        canonical = json.dumps(json.loads(body), sort_keys=True, ensure_ascii=False) if body else ""
+    except ValueError:
+        canonical = body.decode("utf-8", "replace")
+    return hashlib.sha256(f"{method} {path}\n{canonical}".encode("utf-8")).hexdigest()
+
+def describe_request(params):
+    """(stage, user message text) of one Messages request body"""
+    system = params.get("system") or []
+    instructions = system[-1].get("text", "") if isinstance(system, list) and system else str(system)
+    content = (params.get("messages") or [{}])[0].get("content", "")
+    if isinstance(content, list):
+        content = "".join(block.get("text", "") for block in content if isinstance(block, dict))
+    return STAGE_NAMES.get(instructions, instructions.split("\n")[0][:60]), content
+
+def load_httpx():
+    """The httpx package the installed SDK is built on (newer releases ship it as httpx2).
+    Imported only when a cassette is opened, so the scripts run without it otherwise."""
+    return importlib.import_module(DefaultAsyncHttpxClient.__mro__[1].__module__.split(".")[0])
+
+class CassetteTransport:
+    """httpx transport that records API exchanges to a gzip cassette or replays them by request hash
+
+    "record" calls the API and stores every successful exchange (a re-recorded request replaces
+    the old one), "replay" never calls the API, "replay_or_record" calls it only for requests the
+    cassette cannot answer. Recorded streams are buffered whole, so a malformed stream is not cut
+    short while recording.
+    """
+
+    def __init__(self, path, mode):
+        self.httpx = load_httpx()
+        self.path = path
+        self.mode = mode
+        self.entries = {}
+        self.known_params = set()  # Request hashes of single messages, batch entries included
+        self.batch_keys = {}  # Batch id -> key of the request that created it
+        self.hits = 0
+        self.recorded = 0
+        self.misses = []
+        self.live = None
+        self.file = None
+        if mode != "record":
+            self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    self.add(json.loads(line))
+        except (EOFError, gzip.BadGzipFile, json.JSONDecodeError):
+            print(f"WARNING: Cassette {self.path} ends in a damaged record - using the {len(self.entries)} before it")
+        print(f"Cassette: {len(self.entries)} recorded exchanges loaded from {self.path}")
+
+    def add(self, entry):
+        self.entries[entry["key"]] = entry
+        self.known_params.add(entry["key"])
+        self.known_params.update(entry.get("batch_params", []))
+
+    def write(self, entry):
+        self.add(entry)
+        if self.file is None:
+            self.file = gzip.open(self.path, "at", encoding="utf-8")
+        self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.recorded += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def missed_requests(self, path, body):
+        """Mismatch entries for a request the cassette cannot answer (one per unknown batch entry)"""
+        params = json.loads(body) if body else {}
+        if path.endswith("/messages/batches"):
+            unknown = [
+                (request["custom_id"], request["params"]) for request in params.get("requests", [])
+                if cassette_key("POST", "/v1/messages", json.dumps(request["params"])) not in self.known_params
+            ]
+        elif path.endswith("/messages"):
+            unknown = [(None, params)]
         else:
-            raise ValueError("Excel file must have at least 1 column with requirements")
+            unknown = []
+        return [
+            {"custom_id": custom_id, "stage": stage, "message": message}
+            for custom_id, (stage, message) in ((custom_id, describe_request(p)) for custom_id, p in unknown)
+        ]
+
+    async def handle_async_request(self, request):
+        body = await request.aread()
+        path = request.url.raw_path.decode("ascii")
+        key = cassette_key(request.method, path, body)
+        entry = self.entries.get(key) if self.mode != "record" else None
+        if entry is not None:
+            self.hits += 1
+            return self.httpx.Response(entry["status"], headers={"content-type": entry["content_type"]},
+                                  content=entry["body"].encode("utf-8"))
+        if self.mode == "replay":
+            # call_claude retries a failed request: list each missing request once
+            self.misses.extend(miss for miss in self.missed_requests(path, body) if miss not in self.misses)
+            return self.httpx.Response(404, json={"type": "error", "error": {
+                "type": "not_found_error", "message": f"{request.method} {path} is not in the cassette (replay mode)"}})
         
-        # Create sequential Category IDs
-        df['Category'] = [f'REQ_{i+1:03d}' for i in range(len(df))]
-        
-        # Drop rows where customer_req is empty
-        original_count = len(df)
-        df = df[df['customer_req'].notna()]
-        print(f"   {len(df)} requirements with text (filtered {original_count - len(df)} empty rows)")
-        
-        return df
-    except FileNotFoundError:
-        raise FileNotFoundError(f"ERROR: File '{filepath}' not found!")
+        if self.live is None:
+            self.live = self.httpx.AsyncHTTPTransport()
+        response = await self.live.handle_async_request(request)
+        content = await response.aread()
+        await response.aclose()
+        # Body is already decoded: drop the headers describing the wire encoding
+        headers = [(name, value) for name, value in response.headers.multi_items()
+                   if name.lower() not in ("content-encoding", "content-length", "transfer-encoding")]
+        if response.status_code < 400:
+            entry = {"key": key, "method": request.method, "path": path, "status": response.status_code,
+                     "content_type": response.headers.get("content-type", "application/json"),
+                     "body": content.decode("utf-8")}
+            if path.endswith("/messages/batches") and request.method == "POST":
+                entry["batch_params"] = [
+                    cassette_key("POST", "/v1/messages", json.dumps(item["params"])) for item in json.loads(body)["requests"]
+                ]
+                self.batch_keys[json.loads(content).get("id")] = entry
+            self.write(entry)
+            # A batch polled to completion replays as already ended: no poll waits on replay
+            batch_id = path.rstrip("/").rsplit("/", 1)[-1]
+            if request.method == "GET" and batch_id in self.batch_keys:
+                self.write({**self.batch_keys[batch_id], "body": entry["body"]})
+        return self.httpx.Response(response.status_code, headers=headers, content=content)
+
+    async def aclose(self):
+        if self.live is not None:
+            await self.live.aclose()
+            self.live = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    def summary(self):
+        return (f"Cassette ({self.mode}): {self.hits} replayed, {self.recorded} recorded, "
+                f"{len(self.misses)} requests not in the cassette")
+
+def open_cassette(path, mode):
+    """Install a CassetteTransport for every client created from here on; None turns it off"""
+    global CASSETTE, RESPONSE_CACHE, RATE_LIMITER
+    CASSETTE = CassetteTransport(path, mode) if mode else None
+    if CASSETTE is not None:
+        # Every call has to reach the cassette: cache hits would hide both hits and misses
+        RESPONSE_CACHE = ResponseCache(None)
+    if mode == "replay":
+        # Replayed calls cost nothing: only the local rate limits would slow them down
+        RATE_LIMITER = RateLimiter(10 ** 9, 10 ** 12, 10 ** 12)
+    return CASSETTE
+
+def cassette_mismatch_report(df, misses, duplicates=None, templates=None, report_path=None):
+    """{Category: [stages]} of the rows whose requests the cassette could not answer; printed and written as JSON
+
+    Misses are matched to rows by their requirement message, so packed and batched requests
+    count for every row they carry; duplicates and template members share their representative's entry.
+    """
+    rows = {}
+    for _, row in df.iterrows():
+        message = REQUIREMENT_MESSAGE.format(customer_req=row['customer_req']) + "\n"
+        stages = sorted({miss["stage"] for miss in misses if message in miss["message"] + "\n"})
+        if stages:
+            for category, _, _ in fan_out_results(row['Category'], row['customer_req'], [], duplicates, templates):
+                rows[category] = stages
+    print(f"\nCassette mismatch report: {len(rows)} rows need fresh calls")
+    for category, stages in rows.items():
+        print(f"   {category}: {', '.join(stages)}")
+    if report_path:
+        write_text_atomically(report_path, json.dumps({"rows": rows, "requests": misses}, ensure_ascii=False, indent=2))
+        print(f"   Report: {report_path}")
+    return rows
+
+def read_output_file(filepath):
+    """Output rows from an .xlsx, .csv or .parquet file written by this script"""
+    extension = os.path.splitext(filepath)[1].lower()
+    if extension == ".csv":
+        return pd.read_csv(filepath, keep_default_na=False)
+    if extension == ".parquet":
+        return pd.read_parquet(filepath)
+    return pd.read_excel(filepath, keep_default_na=False)
+
+def compare_outputs(reference_file, output_file):
+    """Categories whose Sub_Requirement_Text list differs between a reference output and this run's"""
+    texts = []
+    for filepath in (reference_file, output_file):
+        df = read_output_file(filepath)
+        texts.append(df.groupby('Category', sort=False)['Sub_Requirement_Text'].apply(lambda t: [str(v) for v in t]).to_dict())
+    reference, current = texts
+    changed = [category for category in dict.fromkeys(list(reference) + list(current))
+               if reference.get(category) != current.get(category)]
+    identical = sum(1 for category in reference if reference[category] == current.get(category))
+    print(f"\nOutput comparison with {reference_file}: {identical} identical, {len(changed)} changed or missing")
+    for category in changed[:50]:
+        print(f"   {category}: {reference.get(category)} → {current.get(category)}")
+    if len(changed) > 50:
+        print(f"   ... and {len(changed) - 50} more")
+    return changed
+
+# ==================== CALL METRICS ====================
+# One record per API call (interactive, batch entry or cache hit). Summaries give
+# p50/p95/p99 wall time per stage and the cost per requirement; JSON and Prometheus
+# textfile exports let runs be compared after prompt changes.
+
+STAGE_NAMES = {
+    ANALYZE_SPLIT_PROMPT: "analyze",
+    IMPROVE_REQUIREMENT_PROMPT: "improve",
+    SPLIT_REQUIREMENT_PROMPT: "split",
+    FUSED_REQUIREMENT_PROMPT: "fused",
+    PACKED_IMPROVE_PROMPT: "improve_packed",
+    CAPABILITY_REQUIREMENT_PROMPT: "capability",
+    REPAIR_FIELDS_PROMPT: "repair",
+    REPAIR_PLACEHOLDERS_PROMPT: "repair_placeholders",
+    REPAIR_RULES_PROMPT: "repair_rules",
+}
+
+CALL_METRICS = []
+
+def call_cost(tokens, source):
+    """USD cost of one call's token counts"""
+    cost = (
+        tokens["input_tokens"] * PRICE_INPUT_PER_MTOK
+        + tokens["output_tokens"] * PRICE_OUTPUT_PER_MTOK
+        + tokens["cache_creation_input_tokens"] * PRICE_INPUT_PER_MTOK * CACHE_WRITE_PRICE_FACTOR
+        + tokens["cache_read_input_tokens"] * PRICE_INPUT_PER_MTOK * CACHE_READ_PRICE_FACTOR
+    ) / 1_000_000
+    return cost * BATCH_PRICE_FACTOR if source == "batch" else cost
+
+def record_call(instructions, source, tally=None, wall_seconds=None, ttft_seconds=None,
+                retries=0, stop_reason=None, continuations=0, parsed=True, stage=None):
+    """Append one call record; source is "interactive", "batch" or "cache".
+
+    `tally` holds the call's token counts (keyed like TOKEN_USAGE) and its rate-limiter wait;
+    `stage` names the stage of instructions not in STAGE_NAMES (requirements_processing.py).
+    """
+    tally = tally or {}
+    tokens = {field: tally.get(field, 0) for field in TOKEN_USAGE}
+    CALL_METRICS.append({
+        "stage": stage or STAGE_NAMES.get(instructions, "other"),
+        "source": source,
+        "wall_seconds": wall_seconds,
+        "queue_seconds": tally.get("queue_seconds"),
+        "ttft_seconds": ttft_seconds,
+        **tokens,
+        "retries": retries,
+        "continuations": continuations,
+        "stop_reason": stop_reason,
+        "parsed": parsed,
+        "cost_usd": call_cost(tokens, source),
+    })
+
+def usage_tokens(usage):
+    """Token counts of one response's usage object, keyed like TOKEN_USAGE"""
+    return {field: getattr(usage, field, None) or 0 for field in TOKEN_USAGE}
+
+def stage_metrics():
+    """{stage: aggregated counts, tokens, cost and wall-time percentiles}"""
+    stages = {}
+    for call in CALL_METRICS:
+        stage = stages.setdefault(call["stage"], {
+            "calls": 0, "cache_hits": 0, "retries": 0, "continuations": 0, "parse_failures": 0, "cost_usd": 0.0,
+            "stop_reasons": {}, "wall_seconds": [], **dict.fromkeys(TOKEN_USAGE, 0),
+        })
+        if call["source"] == "cache":
+            stage["cache_hits"] += 1
+            continue
+        stage["calls"] += 1
+        stage["retries"] += call["retries"]
+        stage["continuations"] += call["continuations"]
+        stage["parse_failures"] += not call["parsed"]
+        stage["cost_usd"] += call["cost_usd"]
+        stage["stop_reasons"][str(call["stop_reason"])] = stage["stop_reasons"].get(str(call["stop_reason"]), 0) + 1
+        for field in TOKEN_USAGE:
+            stage[field] += call[field]
+        if call["wall_seconds"] is not None:
+            stage["wall_seconds"].append(call["wall_seconds"])
+    for stage in stages.values():
+        walls = stage.pop("wall_seconds")
+        stage["wall_seconds_sum"] = float(sum(walls))
+        stage["wall_seconds_count"] = len(walls)
+        p50, p95, p99 = np.percentile(walls, [50, 95, 99]) if walls else (None, None, None)
+        stage.update(p50_seconds=p50, p95_seconds=p95, p99_seconds=p99)
+    return stages
+
+def metrics_summary(stages, requirements):
+    lines = []
+    for name, stage in stages.items():
+        timing = (
+            f"p50 {stage['p50_seconds']:.2f}s, p95 {stage['p95_seconds']:.2f}s, p99 {stage['p99_seconds']:.2f}s"
+            if stage["p50_seconds"] is not None else "no interactive timings"
+        )
+        lines.append(
+            f"   {name}: {stage['calls']} calls ({stage['cache_hits']} cached), {timing}, "
+            f"{stage['retries']} retries, {stage['continuations']} continuations, {stage['parse_failures']} parse failures"
+        )
+    total_cost = sum(stage["cost_usd"] for stage in stages.values())
+    per_requirement = total_cost / requirements if requirements else 0.0
+    lines.append(f"Cost: ${total_cost:.4f} total, ${per_requirement:.5f} per requirement ({requirements} requirements)")
+    return "\n".join(["Call metrics:"] + lines)
+
+def write_text_atomically(path, text):
+    # Readers (e.g. the node_exporter textfile collector) never see a half-written file
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+def prometheus_text(stages, requirements):
+    """Prometheus text exposition of the stage aggregates"""
+    lines = []
+    
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{val}"' for key, val in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+    
+    # Summary: quantiles, _sum and _count per stage
+    lines.append("# HELP requirements_api_call_seconds Wall time of interactive API calls by stage")
+    lines.append("# TYPE requirements_api_call_seconds summary")
+    for name, stage in stages.items():
+        if stage["p50_seconds"] is not None:
+            for quantile, key in (("0.5", "p50_seconds"), ("0.95", "p95_seconds"), ("0.99", "p99_seconds")):
+                lines.append(f'requirements_api_call_seconds{{stage="{name}",quantile="{quantile}"}} {stage[key]}')
+        lines.append(f'requirements_api_call_seconds_sum{{stage="{name}"}} {stage["wall_seconds_sum"]}')
+        lines.append(f'requirements_api_call_seconds_count{{stage="{name}"}} {stage["wall_seconds_count"]}')
+    metric("requirements_api_calls_total", "counter", "API calls by stage and source", [
+        ({"stage": name, "source": source}, stage[key])
+        for name, stage in stages.items() for source, key in (("api", "calls"), ("cache", "cache_hits"))
+    ])
+    metric("requirements_api_tokens_total", "counter", "Tokens by stage and kind", [
+        ({"stage": name, "kind": field}, stage[field]) for name, stage in stages.items() for field in TOKEN_USAGE
+    ])
+    metric("requirements_api_retries_total", "counter", "Retried API attempts by stage",
+           [({"stage": name}, stage["retries"]) for name, stage in stages.items()])
+    metric("requirements_api_continuations_total", "counter", "Continuations of responses cut off at max_tokens",
+           [({"stage": name}, stage["continuations"]) for name, stage in stages.items()])
+    metric("requirements_api_parse_failures_total", "counter", "API calls whose response never parsed",
+           [({"stage": name}, stage["parse_failures"]) for name, stage in stages.items()])
+    metric("requirements_api_stop_reasons_total", "counter", "API responses by stop_reason", [
+        ({"stage": name, "stop_reason": reason}, count)
+        for name, stage in stages.items() for reason, count in stage["stop_reasons"].items()
+    ])
+    total_cost = sum(stage["cost_usd"] for stage in stages.values())
+    metric("requirements_cost_usd_total", "counter", "Estimated API cost of the run in USD", [({}, total_cost)])
+    metric("requirements_processed_total", "counter", "Requirements that received a result in the run", [({}, requirements)])
+    metric("requirements_cost_per_requirement_usd", "gauge", "Estimated API cost per processed requirement",
+           [({}, total_cost / requirements if requirements else 0.0)])
+    return "\n".join(lines) + "\n"
+
+def write_metrics(requirements, json_path=METRICS_FILE, prometheus_path=PROMETHEUS_FILE, model=MODEL):
+    """Print the call metrics summary and export it (failures to write are reported, not raised)"""
+    stages = stage_metrics()
+    print(metrics_summary(stages, requirements))
+    total_cost = sum(stage["cost_usd"] for stage in stages.values())
+    try:
+        if json_path:
+            write_text_atomically(json_path, json.dumps({
+                "finished": datetime.now().isoformat(timespec="seconds"),
+                "model": model,
+                "requirements": requirements,
+                "cost_usd": total_cost,
+                "cost_per_requirement_usd": total_cost / requirements if requirements else 0.0,
+                "stages": stages,
+                "placeholders": PLACEHOLDER_STATS,
+                "rule_checks": RULE_CHECK_STATS,
+                "calls": CALL_METRICS,
+            }, indent=2))
+        if prometheus_path:
+            write_text_atomically(prometheus_path, prometheus_text(stages, requirements))
+    except OSError as e:
+        print(f"WARNING: Could not write metrics: {e}")
+
+# ==================== LOCAL PRE-CLASSIFICATION (R18) ====================
+# Plain text signals settle many split decisions without an analyze call: requirements
+# with no compound signal at all go straight to improve, requirements with many go
+# straight to split, and only the ones in between are sent to the model.
+
+COMBINATOR_PATTERN = re.compile(r'\b(?:and|or|then|as well as|plus)\b', re.IGNORECASE)
+LINKING_PATTERN = re.compile(
+    r'\b(?:so|without|while|ensuring|indicating|in order to|that can|to avoid|to prevent|'
+    r'even|if|when|whenever|after|before|unless)\b', re.IGNORECASE
+)
+ENUMERATION_PATTERN = re.compile(r'e\.g\.|\bsuch as\b|\bincluding\b|\betc\b', re.IGNORECASE)
+SLASH_PATTERN = re.compile(r'(?<!\d)/(?!\d)')
+MODAL_PATTERN = re.compile(r'\b(?:shall|must|should|will|want|needs? to|has to|have to)\b', re.IGNORECASE)
+CLAUSE_SPLIT_PATTERN = re.compile(r'\s*(?:[,;]|\b(?:and|or|then|as well as|plus)\b|(?<=[.!?])\s)\s*', re.IGNORECASE)
+
+PRECLASSIFY_STATS = {"atomic": 0, "compound": 0, "ambiguous": 0}
+
+def atomicity_score(customer_req):
+    """0 = no compound signal; combinators, linking clauses, enumerations, '/' and extra modal verbs add to it"""
+    text = str(customer_req)
+    return (
+        2 * len(COMBINATOR_PATTERN.findall(text))
+        + len(LINKING_PATTERN.findall(text))
+        + text.count(',') + 2 * text.count(';')
+        + 2 * len(ENUMERATION_PATTERN.findall(text))
+        + 2 * len(SLASH_PATTERN.findall(text))
+        + 2 * max(0, len(MODAL_PATTERN.findall(text)) - 1)
+    )
 
-def analyze_requirement(client, customer_req, max_retries=3):
-    """Analyze if requirement should be split (R18)"""
-    prompt = ANALYZE_SPLIT_PROMPT.format(
+def preclassify_requirement(customer_req):
+    """Local R18 decision → ("atomic"|"compound"|"ambiguous", analysis tuple or None)
+
+    The analysis tuple has the same shape analyze_requirement returns; for compound
+    requirements the clause fragments stand in for the identified capabilities.
+    """
+    text = str(customer_req)
+    score = atomicity_score(text)
+    placeholders = extract_placeholders(text)
+    
+    if score <= PRECLASSIFY_ATOMIC_MAX_SCORE:
+        return "atomic", (False, 1, [text], placeholders)
+    if score >= PRECLASSIFY_COMPOUND_MIN_SCORE:
+        fragments = [f for f in CLAUSE_SPLIT_PATTERN.split(text) if f and len(f.split()) >= 2]
+        num_reqs = min(10, max(2, len(fragments)))
+        return "compound", (True, num_reqs, fragments[:num_reqs], placeholders)
+    return "ambiguous", None
+
+def preclassify_summary():
+    skipped = PRECLASSIFY_STATS["atomic"] + PRECLASSIFY_STATS["compound"]
+    return (
+        f"Pre-classifier: {PRECLASSIFY_STATS['atomic']} atomic, {PRECLASSIFY_STATS['compound']} compound "
+        f"({skipped} analyze calls skipped), {PRECLASSIFY_STATS['ambiguous']} sent to analyze"
+    )
+
+def print_run_summary(requirements):
+    """Cache, token, pre-classifier and per-call metrics for the finished run"""
+    print(RESPONSE_CACHE.summary())
+    print(usage_summary())
+    if PRECLASSIFY_ATOMICITY:
+        print(preclassify_summary())
+    if PLACEHOLDER_STATS["expected"] or PLACEHOLDER_STATS["repair_calls"]:
+        print(placeholder_summary())
+    if CHECK_RULES:
+        print(rule_check_summary())
+    if FAN_OUT_SPLITS:
+        print(fan_out_summary())
+    write_metrics(requirements, METRICS_FILE, PROMETHEUS_FILE)
+
+# ==================== VAGUE-TERM SCANNER (R7-R10) ====================
+# One compiled, case-insensitive alternation over every known phrase (longest first),
+# run vectorized over the whole input column before any API call. Findings do not change
+# the prompt: the R7-R10 text (~150 tokens) is part of the cached system prefix, so a
+# shorter prompt for clean rows would save only cache reads and add a second prefix to write.
+
+# Common subjective terms seen in customer workbooks, on top of the R7 list in the rules.
+# Only words that are vague in any context: "well", "high", "clear" or "secure" also have
+# ordinary meanings ("as well as", "shall clear the alarm list") and are left to the model.
+EXTRA_VAGUE_TERMS = [
+    "easy", "easily", "quick", "quickly", "smoothly", "user friendly", "intuitive", "intuitively",
+    "efficient", "efficiently", "lightweight", "sufficient", "sufficiently", "properly",
+    "without problems", "as soon as possible", "state of the art", "seamless", "seamlessly",
+]
+
+# Rule sections of COMPLETE_INCOSE_RULES whose phrase lists the scanner picks up
+SCANNED_RULES = ["R7", "R8", "R9", "R10"]
+
+def rule_phrases(rule_id):
+    """Quoted phrases listed under "Avoid:", "Eliminate:" or "Remove" in one rule of COMPLETE_INCOSE_RULES"""
+    section = re.search(rf'^{rule_id} – .*?(?=^R\d+ – |^\*\*)', COMPLETE_INCOSE_RULES, re.MULTILINE | re.DOTALL)
+    phrases = []
+    for line in (section.group(0) if section else "").splitlines():
+        if re.match(r'- (Avoid|Eliminate|Remove)\b', line):
+            # "Remove "shall be able to" → use direct "shall"": only the part before the arrow
+            phrases.extend(re.findall(r'"([^"]+)"', line.split("→")[0]))
+    if rule_id == "R10":
+        # Customer text says "should be able to" / "want to be able to": match the infinitive itself
+        phrases = [re.sub(r'^shall ', '', phrase) for phrase in phrases]
+    return phrases
+
+def load_vague_terms(filepath):
+    """Extra R7 terms from a term-list workbook (a column named Term or Vague_Term, optional Rule column)"""
+    if not filepath or not os.path.exists(filepath):
+        return {}
+    df = pd.read_excel(filepath)
+    term_columns = [c for c in df.columns if str(c).strip().lower() in ("term", "vague_term", "vague_terms")]
+    if not term_columns:
+        print(f"   {os.path.basename(filepath)} has no Term column - using rule phrase lists only")
+        return {}
+    rules = df['Rule'] if 'Rule' in df.columns else pd.Series("R7", index=df.index)
+    return {
+        str(term).strip().lower(): str(rule).strip()
+        for term, rule in zip(df[term_columns[0]], rules)
+        if pd.notna(term) and str(term).strip()
+    }
+
+def build_vague_scanner(filepath=None):
+    """(compiled pattern, {lower-case phrase: rule ID}) for every scanned phrase"""
+    phrase_rules = {term: "R7" for term in EXTRA_VAGUE_TERMS}
+    phrase_rules.update(load_vague_terms(filepath))
+    for rule_id in SCANNED_RULES:
+        for phrase in rule_phrases(rule_id):
+            phrase_rules[phrase.lower()] = rule_id
+    alternatives = "|".join(re.escape(phrase) for phrase in sorted(phrase_rules, key=len, reverse=True))
+    return re.compile(rf'(?<!\w)(?:{alternatives})(?!\w)', re.IGNORECASE), phrase_rules
+
+VAGUE_SCANNER = None
+
+def scan_vague_terms(requirements):
+    """Per-row findings for a Series of requirement texts: lists of (rule ID, phrase as written)"""
+    global VAGUE_SCANNER
+    if VAGUE_SCANNER is None:
+        VAGUE_SCANNER = build_vague_scanner(VAGUE_TERMS_FILE)
+    pattern, phrase_rules = VAGUE_SCANNER
+    matches = requirements.astype(str).str.findall(pattern)
+    return matches.map(lambda found: [(phrase_rules[m.lower()], m) for m in found])
+
+def scan_summary(findings):
+    counts = {}
+    for row_findings in findings:
+        for rule_id, _ in row_findings:
+            counts[rule_id] = counts.get(rule_id, 0) + 1
+    clean = sum(1 for row_findings in findings if not row_findings)
+    per_rule = ", ".join(f"{rule_id}: {counts[rule_id]}" for rule_id in sorted(counts, key=lambda r: int(r[1:])))
+    return f"Vague-term scan: {len(findings) - clean} rows with findings ({per_rule or 'none'}), {clean} clean"
+
+def record_vague_candidates(requirements, findings):
+    """Local scan findings go in their own column; Vague_Terms_Removed keeps what the model documented"""
+    if findings:
+        requirements[0]['vague_term_candidates'] = [f"{phrase} ({rule_id})" for rule_id, phrase in findings]
+    return requirements
+
+# ==================== NEAR-DUPLICATE CLUSTERING (R30) ====================
+# Character shingles of every requirement are MinHashed and LSH-bucketed, so only rows
+# that share a bucket are compared; candidates are confirmed on exact Jaccard similarity.
+# Rows whose numbers or placeholders differ are never merged.
+
+SHINGLE_SIZE = 5
+MINHASH_PERMUTATIONS = 128
+LSH_BANDS = 16  # 16 bands x 8 rows: pairs above ~0.7 similarity almost always share a bucket
+MINHASH_PRIME = (1 << 31) - 1
+NUMBER_PATTERN = re.compile(r'\d+(?:[.,]\d+)*')
+
+def normalize_requirement(customer_req):
+    return " ".join(str(customer_req).lower().split())
+
+def shingle_set(text):
+    """Overlapping SHINGLE_SIZE-character substrings of a normalized requirement"""
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+def minhash_signature(shingles, coefficients):
+    """MINHASH_PERMUTATIONS minimum hash values of a shingle set"""
+    a, b = coefficients
+    hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+    return ((a[:, None] * hashes[None, :] + b[:, None]) % MINHASH_PRIME).min(axis=1)
+
+def find_duplicates(df, threshold=DUPLICATE_SIMILARITY):
+    """{duplicate Category: representative Category} for exact and near-duplicate rows of df
+
+    The representative of each cluster is its first row in input order.
+    """
+    categories = list(df['Category'])
+    originals = [str(req) for req in df['customer_req']]
+    texts = [normalize_requirement(req) for req in originals]
+    parent = list(range(len(texts)))
+    
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    
+    def join(i, j):
+        ri, rj = root(i), root(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+    
+    # Placeholders keep their case: [Device] and [DEVICE] may name different things
+    guards = [(NUMBER_PATTERN.findall(text), sorted(extract_placeholders(original))) for text, original in zip(texts, originals)]
+    
+    # Exact duplicates (after whitespace/case normalization)
+    first_seen = {}
+    for i, text in enumerate(texts):
+        key = (text, str(guards[i]))
+        if key in first_seen:
+            join(first_seen[key], i)
+        else:
+            first_seen[key] = i
+    exact = len(texts) - len(first_seen)
+    
+    # Near duplicates among the distinct texts
+    unique = list(first_seen.values())
+    shingles = {i: shingle_set(texts[i]) for i in unique}
+    rng = np.random.default_rng(29148)
+    coefficients = (
+        rng.integers(1, MINHASH_PRIME, MINHASH_PERMUTATIONS, dtype=np.uint64),
+        rng.integers(0, MINHASH_PRIME, MINHASH_PERMUTATIONS, dtype=np.uint64),
+    )
+    rows_per_band = MINHASH_PERMUTATIONS // LSH_BANDS
+    buckets = {}
+    for i in unique:
+        signature = minhash_signature(shingles[i], coefficients)
+        for band in range(LSH_BANDS):
+            key = (band, signature[band * rows_per_band:(band + 1) * rows_per_band].tobytes())
+            buckets.setdefault(key, []).append(i)
+    
+    compared = set()
+    for members in buckets.values():
+        for pos, i in enumerate(members):
+            for j in members[pos + 1:]:
+                if (i, j) in compared:
+                    continue
+                compared.add((i, j))
+                if guards[i] != guards[j]:
+                    continue
+                similarity = len(shingles[i] & shingles[j]) / len(shingles[i] | shingles[j])
+                if similarity >= threshold:
+                    join(i, j)
+    
+    duplicates = {categories[i]: categories[root(i)] for i in range(len(texts)) if root(i) != i}
+    clusters = len(set(duplicates.values()))
+    print(f"Near-duplicate clustering: {len(duplicates)} duplicates in {clusters} clusters "
+          f"({exact} exact, {len(duplicates) - exact} near) - not sent to the API")
+    return duplicates
+
+def group_duplicates(df, duplicates):
+    """{representative Category: [(duplicate Category, duplicate customer_req), ...]}"""
+    groups = {}
+    for _, row in df.iterrows():
+        if row['Category'] in duplicates:
+            groups.setdefault(duplicates[row['Category']], []).append((row['Category'], row['customer_req']))
+    return groups
+
+def fan_out_duplicates(duplicates, category, customer_req, output_rows):
+    """(Category, customer_req, output rows) for a representative and each of its duplicates
+
+    Duplicates get copies of the representative's rows with their own Category and
+    Customer_Req, and Duplicate_Of pointing at the representative.
+    """
+    members = [(category, customer_req, output_rows)]
+    for duplicate_category, duplicate_req in (duplicates or {}).get(category, []):
+        members.append((duplicate_category, duplicate_req, [
+            {**output_row, 'Category': duplicate_category, 'Customer_Req': duplicate_req, 'Duplicate_Of': category}
+            for output_row in output_rows
+        ]))
+    return members
+
+# ==================== PLACEHOLDER TEMPLATES ====================
+# "[SYSTEM_A] shall respond quickly" and "[SYSTEM_B] shall respond quickly" share the
+# template "[SLOT_1] shall respond quickly". Each shared template is processed once and
+# every row gets the result with its own placeholder names put back mechanically.
+
+PLACEHOLDER_SLOT = "[SLOT_{}]"
+SLOT_PATTERN = re.compile(r'\[SLOT_(\d+)\]')
+
+def canonicalize_placeholders(customer_req, slot=PLACEHOLDER_SLOT):
+    """(template, placeholder names in slot order): each distinct placeholder becomes a numbered slot"""
+    text = str(customer_req)
+    names = list(dict.fromkeys(extract_placeholders(text)))
+    template = re.sub(r'\[([^\]]+)\]', lambda m: slot.format(names.index(m.group(1)) + 1), text)
+    return template, names
+
+def fill_slots(text, names):
+    """Put placeholder names back into the slots of a generated text"""
+    if not isinstance(text, str):
+        return text
+    return SLOT_PATTERN.sub(
+        lambda m: f"[{names[int(m.group(1)) - 1]}]" if 0 < int(m.group(1)) <= len(names) else m.group(0), text
+    )
+
+def group_templates(df):
+    """(df with one template row per shared template, {representative Category: [(Category, customer_req, names), ...]})
+
+    Only templates shared by two or more rows are canonicalized; every other row keeps
+    its original text, placeholder names included, for the model to read.
+    """
+    canonical = [canonicalize_placeholders(req) for req in df['customer_req']]
+    by_template = {}
+    for (template, names), category, customer_req in zip(canonical, df['Category'], df['customer_req']):
+        if names:
+            by_template.setdefault(template, []).append((category, customer_req, names))
+    templates = {members[0][0]: members for members in by_template.values() if len(members) > 1}
+    
+    shared = {category for members in templates.values() for category, _, _ in members[1:]}
+    df = df[~df['Category'].isin(shared)].copy()
+    for template, members in by_template.items():
+        if members[0][0] in templates:
+            df.loc[df['Category'] == members[0][0], 'customer_req'] = template
+    
+    print(f"Placeholder templates: {sum(len(m) for m in templates.values())} rows share {len(templates)} templates "
+          f"- {len(shared)} not sent to the API")
+    return df, templates
+
+def fan_out_template(templates, category, output_rows):
+    """(Category, customer_req, output rows) for each row sharing the template processed as `category`"""
+    if category not in (templates or {}):
+        return None
+    return [
+        (member_category, member_req, [
+            {**{column: fill_slots(value, names) for column, value in output_row.items()},
+             'Category': member_category, 'Customer_Req': member_req}
+            for output_row in output_rows
+        ])
+        for member_category, member_req, names in templates[category]
+    ]
+
+def fan_out_results(category, customer_req, output_rows, duplicates=None, templates=None):
+    """Every (Category, customer_req, output rows) that one processed row's result covers"""
+    members = fan_out_template(templates, category, output_rows) or [(category, customer_req, output_rows)]
+    return [
+        shared
+        for member_category, member_req, member_rows in members
+        for shared in fan_out_duplicates(duplicates, member_category, member_req, member_rows)
+    ]
+
+# ==================== PLACEHOLDER MASKING ====================
+# Placeholder names go to the model as [P1], [P2], ... (fewer tokens, nothing to misspell) and
+# are put back into every field of the answer. Each sub-requirement is then checked: one that
+# lost a placeholder or carries an altered one gets a narrow repair call for its text alone.
+
+PLACEHOLDER_TOKEN = "[P{}]"
+TOKEN_PATTERN = re.compile(r'\[\s*P\s*(\d+)\s*\]')
+# Tokens the model left unresolvable: out of range, or with a bracket dropped ("[P1", "P1]")
+TOKEN_ARTEFACT_PATTERN = re.compile(r'\[\s*P\s*\d+\s*\]|\[P\d+\b(?!\s*\])|(?<!\[)\bP\d+\]')
+
+PLACEHOLDER_STATS = {"expected": 0, "lost": 0, "altered": 0, "repair_calls": 0, "repaired": 0, "unrepaired": 0}
+
+def mask_placeholders(customer_req):
+    """(text with each distinct placeholder as a [P<n>] token, placeholder names in token order)"""
+    return canonicalize_placeholders(customer_req, PLACEHOLDER_TOKEN)
+
+def unmask_value(value, names):
+    """Placeholder names put back into a string (or each string of a list) of an answer"""
+    if isinstance(value, list):
+        return [unmask_value(item, names) for item in value]
+    if not isinstance(value, str):
+        return value
+    return TOKEN_PATTERN.sub(
+        lambda m: f"[{names[int(m.group(1)) - 1]}]" if 0 < int(m.group(1)) <= len(names) else m.group(0), value
+    )
+
+def unmask_requirements(requirements, names):
+    for req in requirements:
+        for field, value in req.items():
+            req[field] = unmask_value(value, names)
+    return requirements
+
+def altered_placeholders(text, expected, lost):
+    """Placeholders of a generated text that stand for something else: leftover tokens, and, when
+    the text lost placeholders, any placeholder the original does not have"""
+    artefacts = TOKEN_ARTEFACT_PATTERN.findall(text)
+    unknown = [f"[{name}]" for name in extract_placeholders(text) if name not in expected] if lost else []
+    return list(dict.fromkeys(artefacts + unknown))
+
+def placeholder_owner(customer_req, name, texts, expected):
+    """Index of the sub-requirement a lost placeholder belongs to: the one carrying a look-alike,
+    else the one sharing most words with the clause of the original the placeholder is in"""
+    look_alikes = [
+        (difflib.SequenceMatcher(None, name.lower(), other.lower()).ratio(), i)
+        for i, text in enumerate(texts) for other in extract_placeholders(text) if other not in expected
+    ]
+    if look_alikes and max(look_alikes)[0] >= 0.6:
+        return max(look_alikes)[1]
+    clause = next((c for c in CLAUSE_SPLIT_PATTERN.split(customer_req) if f"[{name}]" in c), customer_req)
+    context = set(re.findall(r'\w+', clause.lower()))
+    return max(range(len(texts)), key=lambda i: len(context & set(re.findall(r'\w+', texts[i].lower()))))
+
+def placeholder_problems(customer_req, requirements):
+    """{index: (lost placeholder names, altered placeholders)} for the sub-requirements to repair
+
+    A single requirement must keep every placeholder; split requirements must keep them
+    between them, and a lost one is charged to the sub-requirement it belongs to.
+    """
+    expected = list(dict.fromkeys(extract_placeholders(customer_req)))
+    texts = [str(req['requirement_text']) for req in requirements]
+    lost = {}
+    for name in missing_placeholders(customer_req, "\n".join(texts)):
+        lost.setdefault(0 if len(texts) == 1 else placeholder_owner(customer_req, name, texts, expected), []).append(name)
+    problems = {}
+    for i, text in enumerate(texts):
+        altered = altered_placeholders(text, expected, lost.get(i))
+        if lost.get(i) or altered:
+            problems[i] = (lost.get(i, []), altered)
+    return problems
+
+async def repair_placeholders(client, customer_req, req, lost, altered):
+    """Ask for one sub-requirement's text with its placeholders restored; True when the repair took"""
+    PLACEHOLDER_STATS["repair_calls"] += 1
+    
+    def parse_repair(text):
+        repaired = str(parse_json_response(text)['requirement_text'])
+        missing = [name for name in lost if f"[{name}]" not in repaired]
+        if missing or any(placeholder in repaired for placeholder in altered):
+            raise ValueError(f"Repair still misses {', '.join(missing) or 'nothing'}, keeps {', '.join(altered)}")
+        return repaired
+    
+    message = REPAIR_PLACEHOLDERS_MESSAGE.format(
         customer_req=customer_req,
-        incose_rules=COMPLETE_INCOSE_RULES
+        requirement_text=req['requirement_text'],
+        missing="\n".join(f"[{name}]" for name in lost) or "(none)",
+        altered="\n".join(altered) or "(none)"
+    )
+    try:
+        req['requirement_text'] = await call_claude(
+            client, REPAIR_PLACEHOLDERS_PROMPT, message, parse_repair,
+            max_retries=2, max_tokens=output_budget("repair", req['requirement_text'])
+        )
+        return True
+    except Exception as e:
+        print(f"WARNING: Placeholder repair failed ({str(e)[:100]}) - keeping: {req['requirement_text'][:80]}")
+        return False
+
+async def restore_placeholders(client, customer_req, requirements, names=()):
+    """Put masked placeholder names back into one row's requirements, then repair every
+    sub-requirement that lost or altered a placeholder (error results are left alone)"""
+    unmask_requirements(requirements, names)
+    if any(req['requirement_type'] == 'ERROR' for req in requirements):
+        return requirements
+    PLACEHOLDER_STATS["expected"] += len(set(extract_placeholders(customer_req)))
+    problems = placeholder_problems(customer_req, requirements)
+    if not problems:
+        return requirements
+    PLACEHOLDER_STATS["lost"] += sum(len(lost) for lost, _ in problems.values())
+    PLACEHOLDER_STATS["altered"] += sum(len(altered) for _, altered in problems.values())
+    print(f"Placeholders lost or altered in {len(problems)} of {len(requirements)} requirement(s) - repairing")
+    repaired = await asyncio.gather(*(
+        repair_placeholders(client, customer_req, requirements[i], lost, altered)
+        for i, (lost, altered) in problems.items()
+    ))
+    PLACEHOLDER_STATS["repaired"] += sum(repaired)
+    PLACEHOLDER_STATS["unrepaired"] += len(repaired) - sum(repaired)
+    return requirements
+
+def placeholder_summary():
+    stats = PLACEHOLDER_STATS
+    rate = stats["lost"] / stats["expected"] if stats["expected"] else 0.0
+    return (
+        f"Placeholders: {stats['lost']}/{stats['expected']} lost ({rate:.1%}), {stats['altered']} altered - "
+        f"{stats['repair_calls']} repair calls, {stats['repaired']} requirements repaired, {stats['unrepaired']} left as generated"
     )
+
+# ==================== RULE CHECKS ====================
+# Patterns for the rules a generated requirement most often still breaks. Checked locally on
+# every requirement_text (placeholder names blanked out); only the sub-requirements with
+# findings get a repair call, and it lists exactly those findings.
+
+# (rule ID, what the finding says, pattern)
+RULE_CHECKS = [
+    ("R9", "open-ended clause", re.compile(r'\betc\b\.?|\band so on\b|\bincluding but not limited to\b', re.IGNORECASE)),
+    ("R16", "negative requirement", re.compile(r'\bshall\s+not\b', re.IGNORECASE)),
+    # a slash touching a digit is a ratio or tolerance, not an alternative (as SLASH_PATTERN)
+    ("R17", "oblique symbol", re.compile(r'\w*(?<!\d)/(?!\d)\w*')),
+    ("R21", "parenthetical text", re.compile(r'\([^)]*\)?|\)')),
+    # "IT" stays an acronym; "this"/"that" only where they stand for a noun
+    ("R24", "pronoun", re.compile(r'\b(?:[Ii]ts?|[Tt]hey|[Tt]hem|[Tt]heir)\b|\b[Tt]his\s+(?:shall|is|are|will|must)\b|(?:^|[.;]\s+)That\b')),
+    ("R26", "absolute", re.compile(r'\b100\s?%|\b(?:always|never)\b', re.IGNORECASE)),
+]
+
+# Units a quantity may carry: SI and common engineering symbols (case-sensitive), unit names
+# (any case), % and °
+UNIT_SYMBOLS = (
+    "[kMGTmµnp]?(?:m|s|g|Hz|N|Pa|J|W|Wh|V|A|Ω|K|L|l|B|bit|bps)|min|h|d|bar|mbar|psi|rpm|dB|dBm|dBA|°[CF]?|%"
+)
+UNIT_NAMES = (
+    "(?:kilo|mega|giga|tera|milli|micro|nano|centi)?"
+    "(?:seconds?|meters?|metres?|grams?|hertz|newtons?|pascals?|joules?|watts?|volts?|amperes?|amps?|ohms?"
+    "|liters?|litres?|bytes?|bits?)|minutes?|hours?|days?|weeks?|kelvin|degrees?|percent|decibels?"
+)
+UNIT = rf'(?:{UNIT_SYMBOLS}|(?i:{UNIT_NAMES}))[²³]?(?!\w)'
+# Quantities with their tolerances and units ("100 km/h", "5.0 +0.5/-0.3 L/min"), or a count
+# per unit ("1000 ± 50 requests/second"); R33 wants these written out, so R17 does not look
+# inside them. A slash after a number is only part of the quantity between units, so
+# "3 users/admins" is still an oblique symbol.
+QUANTITY_PATTERN = re.compile(
+    r'[-+±]?\d[\d.,]*(?:\s*(?:[-+±–]|/\s*[-+]?)\s*\d[\d.,]*)*'
+    rf'(?:\s*(?:{UNIT}|[^\W\d_]+(?=\s*/\s*{UNIT}))(?:\s*/\s*{UNIT})*)?'
+)
+QUANTITY_BLIND_RULES = {"R17"}
+
+RULE_CHECK_STATS = {"checked": 0, "flagged": 0, "findings": {}, "repaired": 0, "unrepaired": 0}
+
+def rule_findings(requirement_text):
+    """[(rule ID, finding, text as written)] for one generated requirement"""
+    text = re.sub(r'\[[^\]]+\]', ' ', str(requirement_text))
+    unitless = QUANTITY_PATTERN.sub(lambda match: " " * len(match.group(0)), text)
+    return [
+        (rule_id, finding, match.group(0).strip(" ,;:"))
+        for rule_id, finding, pattern in RULE_CHECKS
+        for match in pattern.finditer(unitless if rule_id in QUANTITY_BLIND_RULES else text)
+    ]
+
+async def repair_rule_findings(client, customer_req, req, findings):
+    """Ask for one requirement_text revised to resolve its findings; True when the revision is clean"""
+    flagged = {rule_id for rule_id, _, _ in findings}
+    placeholders = extract_placeholders(req['requirement_text'])
     
-    for attempt in range(max_retries):
+    def parse_revision(text):
+        revised = str(parse_json_response(text)['requirement_text'])
+        remaining = sorted({rule_id for rule_id, _, _ in rule_findings(revised)} & flagged)
+        lost = [name for name in placeholders if f"[{name}]" not in revised]
+        if remaining or lost:
+            raise ValueError(f"Revision still breaks {', '.join(remaining) or '-'}, lost {', '.join(lost) or '-'}")
+        return revised
+    
+    message = REPAIR_RULES_MESSAGE.format(
+        customer_req=customer_req,
+        requirement_text=req['requirement_text'],
+        findings="\n".join(f'- {rule_id} ({finding}): "{written}"' for rule_id, finding, written in findings)
+    )
+    try:
+        req['requirement_text'] = await call_claude(
+            client, REPAIR_RULES_PROMPT, message, parse_revision,
+            max_retries=2, max_tokens=output_budget("repair", req['requirement_text'])
+        )
+        return True
+    except Exception as e:
+        print(f"WARNING: Rule repair failed ({str(e)[:100]}) - keeping: {req['requirement_text'][:80]}")
+        return False
+
+async def check_rules(client, customer_req, requirements):
+    """Check every sub-requirement of one row against RULE_CHECKS and repair those with findings
+    (error results are left alone)"""
+    if any(req['requirement_type'] == 'ERROR' for req in requirements):
+        return requirements
+    RULE_CHECK_STATS["checked"] += len(requirements)
+    flagged = {i: findings for i, req in enumerate(requirements) if (findings := rule_findings(req['requirement_text']))}
+    if not flagged:
+        return requirements
+    for findings in flagged.values():
+        for rule_id in dict.fromkeys(rule_id for rule_id, _, _ in findings):
+            RULE_CHECK_STATS["findings"][rule_id] = RULE_CHECK_STATS["findings"].get(rule_id, 0) + 1
+    RULE_CHECK_STATS["flagged"] += len(flagged)
+    print(f"Rule check: {len(flagged)} of {len(requirements)} requirement(s) flagged "
+          f"({', '.join(sorted({rule_id for findings in flagged.values() for rule_id, _, _ in findings}, key=lambda rule_id: int(rule_id[1:])))}) - repairing")
+    repaired = await asyncio.gather(*(
+        repair_rule_findings(client, customer_req, requirements[i], findings) for i, findings in flagged.items()
+    ))
+    RULE_CHECK_STATS["repaired"] += sum(repaired)
+    RULE_CHECK_STATS["unrepaired"] += len(repaired) - sum(repaired)
+    return requirements
+
+def rule_check_summary():
+    stats = RULE_CHECK_STATS
+    per_rule = ", ".join(f"{rule_id}: {count}" for rule_id, count in sorted(stats["findings"].items(), key=lambda item: int(item[0][1:])))
+    return (
+        f"Rule check: {stats['flagged']}/{stats['checked']} requirements flagged ({per_rule or 'none'}) - "
+        f"{stats['repaired']} repaired, {stats['unrepaired']} left as generated"
+    )
+
+# ==================== INCREMENTAL JSON PARSING ====================
+# Streamed text is scanned as it arrives instead of after the full completion: string and
+# bracket state are tracked per character, so output that can no longer become valid JSON
+# is caught mid-stream, and each element of a top-level array is parsed as soon as it closes.
+
+# Fields every sub-requirement of a split must carry (see SPLIT_REQUIREMENT_PROMPT)
+SUB_REQUIREMENT_FIELDS = ("requirement_type", "requirement_text", "verification_method")
+
+# Characters allowed outside strings: structure and the spelling of numbers, true, false, null
+JSON_BARE_CHARACTERS = set(",:-+.0123456789eEtrufalsn")
+
+class MalformedResponse(ValueError):
+    """Streamed output that can no longer become the expected JSON"""
+
+class StreamingJSONScanner:
+    """Structural check of a JSON response fed in chunks.
+
+    The value starts at the first [ or { of the response, or after a ``` fence; up to
+    PREAMBLE_LIMIT characters before that are tolerated. Elements of a top-level array
+    (or of an array directly inside the top-level object, as tool answers wrap them)
+    are parsed and handed to on_item(number, item) as they close.
+    """
+
+    ITEM_PARENTS = (["["], ["{", "["])
+
+    PREAMBLE_LIMIT = 500
+
+    def __init__(self, on_item=None):
+        self.on_item = on_item
+        self.chunks = []
+        self.received = 0
+        self.preamble = ""
+        self.position = 0
+        self.started = False
+        self.finished = False
+        self.stack = []
+        self.in_string = False
+        self.escaped = False
+        self.item_start = None
+        self.item_parts = []  # Earlier chunks' share of the open array element
+        self.items = 0
+
+    @property
+    def text(self):
+        """Everything fed so far, joined on demand (feed never copies what it already scanned)"""
+        return "".join(self.chunks)
+
+    def feed(self, chunk):
+        self.chunks.append(chunk)
+        self.chunk, self.chunk_start = chunk, self.received
+        self.received += len(chunk)
+        while self.position < self.received and not self.finished:
+            char = chunk[self.position - self.chunk_start]
+            if self.started or self._find_start(char):
+                self._scan(char)
+            self.position += 1
+        if self.item_start is not None:
+            self.item_parts.append(chunk[max(self.item_start - self.chunk_start, 0):])
+
+    def _find_start(self, char):
+        """True once the scanner stands on the opening bracket of the JSON value"""
+        if char in "[{" and (not self.preamble.strip() or "```" in self.preamble):
+            self.started = True
+        elif self.position >= self.PREAMBLE_LIMIT:
+            raise MalformedResponse(f"no JSON value in the first {self.PREAMBLE_LIMIT} characters")
+        else:
+            self.preamble += char
+        return self.started
+
+    def _scan(self, char):
+        if self.in_string:
+            if self.escaped:
+                self.escaped = False
+            elif char == "\\":
+                self.escaped = True
+            elif char == '"':
+                self.in_string = False
+        elif char == '"':
+            self.in_string = True
+        elif char in "[{":
+            if self.stack in self.ITEM_PARENTS:
+                self.item_start = self.position
+                self.item_parts = []
+            self.stack.append(char)
+        elif char in "]}":
+            if not self.stack or self.stack[-1] != {"]": "[", "}": "{"}[char]:
+                raise MalformedResponse(f"unbalanced '{char}' at character {self.position}")
+            self.stack.pop()
+            if self.stack in self.ITEM_PARENTS and self.item_start is not None:
+                start = max(self.item_start - self.chunk_start, 0)
+                self._item("".join(self.item_parts) + self.chunk[start:self.position - self.chunk_start + 1])
+            self.finished = not self.stack
+        elif not char.isspace() and char not in JSON_BARE_CHARACTERS:
+            raise MalformedResponse(f"unexpected '{char}' at character {self.position}")
+
+    def _item(self, item_text):
+        self.item_start = None
+        self.item_parts = []
+        self.items += 1
         try:
-            message = client.messages.create(
-                model=MODEL,
-                max_tokens=MAX_TOKENS,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            
-            response_text = message.content[0].text
-            
-            # Parse JSON
-            import json
-            if "```json" in response_text:
-                response_text = response_text.split("```json")[1].split("```")[0]
-            elif "```" in response_text:
-                response_text = response_text.split("```")[1].split("```")[0]
-            
-            analysis = json.loads(response_text.strip())
-            
-            return (
-                analysis['should_split'],
-                analysis['number_of_atomic_requirements'],
-                analysis['identified_capabilities'],
-                analysis.get('placeholders_found', [])
-            )
-            
-        except Exception as e:
-            if attempt < max_retries - 1:
-                print(f"Retry {attempt + 1}/{max_retries} after error: {str(e)[:100]}")
-                time.sleep(2)
-            else:
-                print(f"Analysis failed after {max_retries} attempts, using default")
-                return (False, 1, ["Unknown"], extract_placeholders(customer_req))
+            item = json.loads(item_text)
+            if self.on_item is not None:
+                self.on_item(self.items, item)
+        except (KeyError, TypeError, ValueError) as e:
+            raise MalformedResponse(f"element {self.items}: {str(e)[:100]}")
+
+def validate_sub_requirement(number, item):
+    """on_item check for split arrays: complete sub-requirements are reported as they arrive"""
+    missing = [field for field in SUB_REQUIREMENT_FIELDS if not item.get(field)]
+    if missing and USE_TOOL_OUTPUT:
+        print(f"   Sub-requirement {number} arrived without {', '.join(missing)}; repairing after the call")
+        return
+    if missing:
+        raise ValueError(f"sub-requirement without {', '.join(missing)}")
+    print(f"   Sub-requirement {number} ready: {str(item['requirement_text'])[:60]}")
+
+# ==================== STRUCTURED OUTPUT (TOOL USE) ====================
+# Every stage answers by calling a tool whose input schema mirrors the JSON format in its
+# prompt, so the answer is always well-formed JSON. Required fields that are still missing
+# (or of the wrong type) are filled by one narrow repair call for just those fields.
+# All tools go out with every call and tool_choice picks the stage's tool: the tool list
+# stays part of the shared, cached prompt prefix.
+
+STRING_LIST = {"type": "array", "items": {"type": "string"}}
+
+ANALYSIS_PROPERTIES = {
+    "should_split": {"type": "boolean"},
+    "reasoning": {"type": "string", "description": "Detailed justification referencing R18"},
+    "number_of_atomic_requirements": {"type": "integer", "minimum": 1, "maximum": 10},
+    "identified_capabilities": STRING_LIST,
+    "placeholders_found": STRING_LIST,
+}
+ANALYSIS_REQUIRED = ["should_split", "number_of_atomic_requirements", "identified_capabilities"]
+
+IMPROVED_PROPERTIES = {
+    "requirement_type": {"type": "string", "description": "Functional|Performance|Interface|Safety|Security|etc."},
+    "improved_requirement": {"type": "string", "description": "Complete INCOSE-compliant requirement with ALL [PLACEHOLDERS] preserved"},
+    "verification_method": {"type": "string", "description": "Test|Inspection|Analysis|Demonstration"},
+    "placeholders_preserved": STRING_LIST,
+    "incose_rules_applied": STRING_LIST,
+    "vague_terms_removed": STRING_LIST,
+    "tolerances_added": STRING_LIST,
+    "escape_clauses_removed": STRING_LIST,
+    "improvements_summary": {"type": "string"},
+}
+IMPROVED_REQUIRED = ["requirement_type", "improved_requirement", "verification_method", "vague_terms_removed", "tolerances_added"]
+
+SUB_REQUIREMENT_PROPERTIES = {
+    "sub_id": {"type": "string"},
+    "requirement_type": {"type": "string", "description": "Functional|Performance|Interface|Safety|Security|etc."},
+    "requirement_text": {"type": "string", "description": "Complete INCOSE-compliant requirement with relevant [PLACEHOLDERS]"},
+    "verification_method": {"type": "string", "description": "Test|Inspection|Analysis|Demonstration"},
+    "placeholders_used": STRING_LIST,
+    "incose_rules_applied": STRING_LIST,
+    "vague_terms_removed": STRING_LIST,
+    "tolerances_added": STRING_LIST,
+    "improvements_summary": {"type": "string"},
+}
+SUB_REQUIREMENT_REQUIRED = list(SUB_REQUIREMENT_FIELDS) + ["vague_terms_removed", "tolerances_added"]
+
+def object_schema(properties, required):
+    return {"type": "object", "properties": properties, "required": required}
+
+def requirements_array(properties, required):
+    return {"type": "array", "items": object_schema(properties, required)}
+
+# {stage instructions: (tool, field holding the array the text format returns bare, or None)}
+OUTPUT_TOOLS = {
+    ANALYZE_SPLIT_PROMPT: ({
+        "name": "record_split_analysis",
+        "description": "Record the R18 split decision for the requirement",
+        "input_schema": object_schema(ANALYSIS_PROPERTIES, ANALYSIS_REQUIRED),
+    }, None),
+    IMPROVE_REQUIREMENT_PROMPT: ({
+        "name": "record_improved_requirement",
+        "description": "Record the ISO 29148 + INCOSE compliant requirement",
+        "input_schema": object_schema(IMPROVED_PROPERTIES, IMPROVED_REQUIRED),
+    }, None),
+    SPLIT_REQUIREMENT_PROMPT: ({
+        "name": "record_split_requirements",
+        "description": "Record the atomic requirements the requirement was split into",
+        "input_schema": object_schema(
+            {"requirements": requirements_array(SUB_REQUIREMENT_PROPERTIES, SUB_REQUIREMENT_REQUIRED)}, ["requirements"]
+        ),
+    }, "requirements"),
+    FUSED_REQUIREMENT_PROMPT: ({
+        "name": "record_fused_result",
+        "description": "Record the R18 split decision and the final requirement(s)",
+        "input_schema": object_schema(
+            {**ANALYSIS_PROPERTIES, "requirements": requirements_array(SUB_REQUIREMENT_PROPERTIES, SUB_REQUIREMENT_REQUIRED)},
+            ANALYSIS_REQUIRED + ["requirements"]
+        ),
+    }, None),
+    PACKED_IMPROVE_PROMPT: ({
+        "name": "record_improved_requirements",
+        "description": "Record one improved requirement per key",
+        "input_schema": object_schema(
+            {"requirements": requirements_array({"key": {"type": "string"}, **IMPROVED_PROPERTIES}, ["key"] + IMPROVED_REQUIRED)},
+            ["requirements"]
+        ),
+    }, "requirements"),
+    CAPABILITY_REQUIREMENT_PROMPT: ({
+        "name": "record_capability_requirement",
+        "description": "Record the ISO 29148 + INCOSE compliant requirement for the one named capability",
+        "input_schema": object_schema(IMPROVED_PROPERTIES, IMPROVED_REQUIRED),
+    }, None),
+    REPAIR_FIELDS_PROMPT: ({
+        "name": "record_missing_fields",
+        "description": "Record the missing fields of each listed record",
+        "input_schema": object_schema({"records": {"type": "array", "items": object_schema({
+            "record": {"type": "integer", "description": "Record number from the user message"},
+            "fields": {"type": "object", "description": "Missing field name → value"},
+        }, ["record", "fields"])}}, ["records"]),
+    }, "records"),
+    REPAIR_PLACEHOLDERS_PROMPT: ({
+        "name": "record_repaired_requirement",
+        "description": "Record the rewritten requirement with its placeholders restored",
+        "input_schema": object_schema({"requirement_text": {"type": "string"}}, ["requirement_text"]),
+    }, None),
+    REPAIR_RULES_PROMPT: ({
+        "name": "record_revised_requirement",
+        "description": "Record the requirement revised to resolve the listed rule findings",
+        "input_schema": object_schema({"requirement_text": {"type": "string"}}, ["requirement_text"]),
+    }, None),
+}
+
+JSON_TYPES = {"string": str, "integer": int, "boolean": bool, "array": list, "object": dict}
+
+def field_is_missing(record, field, schema):
+    value = record.get(field)
+    expected = JSON_TYPES.get(schema.get("type"))
+    if value is None or value == "":
+        return True
+    if expected is int and isinstance(value, bool):
+        return True
+    return expected is not None and not isinstance(value, expected)
+
+def incomplete_records(answer, schema):
+    """[(record dict, [missing required fields])] for the answer object and the objects in its arrays"""
+    found = []
+    
+    def check(record, record_schema):
+        properties = record_schema.get("properties", {})
+        missing = [field for field in record_schema.get("required", []) if field_is_missing(record, field, properties.get(field, {}))]
+        found.append((record, missing))
+        for field, field_schema in properties.items():
+            if field_schema.get("type") == "array" and field_schema["items"].get("type") == "object" and isinstance(record.get(field), list):
+                for item in record[field]:
+                    if isinstance(item, dict):
+                        check(item, field_schema["items"])
+    
+    check(answer, schema)
+    return [(record, missing) for record, missing in found if missing]
+
+async def repair_missing_fields(client, message, answer, incomplete):
+    """Ask for just the missing fields of the incomplete records and merge them into `answer`"""
+    numbered = {str(number): record for number, (record, _) in enumerate(incomplete, 1)}
+    missing = "\n".join(
+        f"- record {number}: {', '.join(fields)} (record starts: {json.dumps(record, ensure_ascii=False)[:200]})"
+        for number, (record, fields) in enumerate(incomplete, 1)
+    )
+    repairs = await call_claude(
+        client, REPAIR_FIELDS_PROMPT,
+        REPAIR_FIELDS_MESSAGE.format(
+            original_message=message, partial_answer=json.dumps(answer, ensure_ascii=False, indent=1), missing=missing
+        ),
+        parse_json_response, max_retries=2,
+        max_tokens=min(MAX_TOKENS, REQUIREMENT_OUTPUT_TOKENS * len(incomplete))
+    )
+    for repair in repairs:
+        record = numbered.get(str(repair.get("record"))) if isinstance(repair, dict) else None
+        if record is not None and isinstance(repair.get("fields"), dict):
+            record.update(repair["fields"])
+
+async def complete_tool_answer(client, instructions, message, response_text):
+    """Check a tool answer against its schema, repair missing required fields, and return it
+    as text in the same shape the prompt's plain JSON format has
+    """
+    tool, unwrap = OUTPUT_TOOLS[instructions]
+    answer = json.loads(response_text)
+    incomplete = incomplete_records(answer, tool["input_schema"])
+    if incomplete and instructions != REPAIR_FIELDS_PROMPT:
+        print(f"Repairing {sum(len(fields) for _, fields in incomplete)} missing field(s) in {len(incomplete)} record(s)")
+        await repair_missing_fields(client, message, answer, incomplete)
+        incomplete = incomplete_records(answer, tool["input_schema"])
+    if incomplete:
+        raise ValueError(f"Answer still misses {', '.join(incomplete[0][1])}")
+    return json.dumps(answer[unwrap] if unwrap else answer, ensure_ascii=False)
+
+# ==================== API CALLS ====================
+
+def parse_json_response(response_text):
+    """Parse JSON from a model response, stripping ``` fences"""
+    if "```json" in response_text:
+        response_text = response_text.split("```json")[1].split("```")[0]
+    elif "```" in response_text:
+        response_text = response_text.split("```")[1].split("```")[0]
+    
+    return json.loads(response_text.strip())
 
-def improve_requirement(client, customer_req, max_retries=3):
-    """Improve atomic requirement with all 42 INCOSE rules"""
-    prompt = IMPROVE_REQUIREMENT_PROMPT.format(
-        customer_req=customer_req,
-        incose_rules=COMPLETE_INCOSE_RULES
+def build_system_blocks(instructions):
+    """Rules prefix + stage instructions as system blocks, each marked for prompt caching"""
+    return [
+        {"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": instructions, "cache_control": {"type": "ephemeral"}},
+    ]
+
+def record_usage(usage):
+    """Add one response's token usage (including prompt-cache reads/writes) to the run totals"""
+    for field in TOKEN_USAGE:
+        TOKEN_USAGE[field] += getattr(usage, field, None) or 0
+
+def usage_summary():
+    return (
+        f"Tokens: {TOKEN_USAGE['input_tokens']} input, {TOKEN_USAGE['output_tokens']} output, "
+        f"{TOKEN_USAGE['cache_read_input_tokens']} cache read, "
+        f"{TOKEN_USAGE['cache_creation_input_tokens']} cache write"
+    )
+
+def output_budget(stage, customer_req="", num_requirements=1):
+    """max_tokens for one stage call, from the requirement length and planned split count"""
+    per_requirement = REQUIREMENT_OUTPUT_TOKENS + 2 * estimate_tokens(customer_req)
+    if stage == "analyze":
+        budget = ANALYZE_OUTPUT_TOKENS + estimate_tokens(customer_req)
+    elif stage == "fused":
+        # The split count is not known yet: plan one requirement per clause fragment
+        fragments = [f for f in CLAUSE_SPLIT_PATTERN.split(str(customer_req)) if f and len(f.split()) >= 2]
+        budget = ANALYZE_OUTPUT_TOKENS + max(1, min(10, len(fragments))) * per_requirement
+    else:
+        budget = max(1, num_requirements) * per_requirement
+    return min(MAX_TOKENS, budget)
+
+def build_message_params(instructions, message, max_tokens=MAX_TOKENS, prefill=None):
+    """Messages API parameters for one stage call (shared by interactive and batch mode);
+    `prefill` continues a response that was cut off at max_tokens
+    """
+    messages = [{"role": "user", "content": message}]
+    if prefill:
+        messages.append({"role": "assistant", "content": prefill})
+    params = {
+        "model": MODEL,
+        "max_tokens": max_tokens,
+        "system": build_system_blocks(instructions),
+        "messages": messages,
+    }
+    if USE_TOOL_OUTPUT and instructions in OUTPUT_TOOLS:
+        params["tools"] = [tool for tool, _ in OUTPUT_TOOLS.values()]
+        params["tool_choice"] = {"type": "tool", "name": OUTPUT_TOOLS[instructions][0]["name"]}
+    return params
+
+def response_text_of(response):
+    """Text of a response, or the JSON input of its tool call when it answered through a tool"""
+    for block in response.content:
+        if getattr(block, "type", None) == "tool_use":
+            return json.dumps(block.input, ensure_ascii=False)
+    return "".join(block.text for block in response.content if getattr(block, "type", None) == "text")
+
+def answers_with_tool(instructions):
+    return USE_TOOL_OUTPUT and instructions in OUTPUT_TOOLS
+
+def response_cache_key(instructions, message, max_tokens):
+    """Cache key of one stage call: everything the answer depends on - the rules prefix, the stage
+    instructions, the message, the call's max_tokens and, when answers come through tools, the
+    tool definitions"""
+    prompt = [SYSTEM_PROMPT, instructions, message]
+    if answers_with_tool(instructions):
+        prompt.append([tool for tool, _ in OUTPUT_TOOLS.values()])
+    return ResponseCache.make_key(MODEL, prompt, max_tokens)
+
+async def stream_message(client, params, scanner, tally):
+    """Stream one response through `scanner`; returns the final message
+
+    A MalformedResponse from the scanner leaves the stream block, which closes the
+    connection and stops the generation.
+    """
+    started = time.perf_counter()
+    async with client.messages.stream(**params) as stream:
+        RATE_LIMITER.update_from_headers(stream.response.headers)
+        async for event in stream:
+            # Text deltas, or the tool input as it is generated
+            chunk = event.text if event.type == "text" else event.partial_json if event.type == "input_json" else None
+            if chunk is None:
+                continue
+            if tally.get("ttft_seconds") is None:
+                tally["ttft_seconds"] = time.perf_counter() - started
+            scanner.feed(chunk)
+        return await stream.get_final_message()
+
+async def send_message(client, instructions, message, max_tokens, tally, prefill=None, scanner=None):
+    """One request through the shared rate limiter; adds its usage and rate-limiter wait to `tally`.
+    With a scanner the response is streamed and checked as it arrives.
+    """
+    # Cache reads do not count towards the input-token rate limit, so only the per-requirement
+    # message is reserved up front; output is reserved at max_tokens, as the API does
+    input_tokens = estimate_tokens(message) + estimate_tokens(prefill or "")
+    queued = time.perf_counter()
+    await RATE_LIMITER.acquire(input_tokens, max_tokens)
+    tally["queue_seconds"] += time.perf_counter() - queued
+    params = build_message_params(instructions, message, max_tokens, prefill)
+    received = scanner.received if scanner is not None else 0
+    try:
+        if scanner is not None:
+            response = await stream_message(client, params, scanner, tally)
+        else:
+            raw = await client.messages.with_raw_response.create(**params)
+            RATE_LIMITER.update_from_headers(raw.headers)
+            response = await raw.parse()
+    except MalformedResponse:
+        # Aborted mid-stream: charge what was generated up to the abort
+        RATE_LIMITER.settle(input_tokens, input_tokens, max_tokens, estimate_tokens(scanner.text[received:]))
+        raise
+    except Exception:
+        # 429/529/API errors: nothing was generated, hand the whole reservation back
+        RATE_LIMITER.settle(input_tokens, 0, max_tokens, 0)
+        raise
+    RATE_LIMITER.settle(
+        input_tokens,
+        response.usage.input_tokens + (getattr(response.usage, 'cache_creation_input_tokens', None) or 0),
+        max_tokens,
+        response.usage.output_tokens
     )
+    record_usage(response.usage)
+    for field, count in usage_tokens(response.usage).items():
+        tally[field] += count
+    return response
+
+async def continue_truncated(client, instructions, message, response_text, max_tokens, tally, scanner=None):
+    """Continue a response cut off at max_tokens by prefilling what arrived so far
+
+    A tool call cannot be prefilled, so a cut-off tool answer is requested again instead.
+    Returns (full text, final stop_reason, continuations used).
+    """
+    stop_reason = "max_tokens"
+    continuations = 0
+    while stop_reason == "max_tokens" and continuations < MAX_CONTINUATIONS:
+        continuations += 1
+        # The budget was too small for this row: give every continuation more room
+        max_tokens = min(MAX_TOKENS, 2 * max_tokens)
+        if answers_with_tool(instructions):
+            print(f"Tool answer cut off at max_tokens - requesting again with {max_tokens} ({continuations}/{MAX_CONTINUATIONS})")
+            scanner = StreamingJSONScanner(scanner.on_item) if scanner is not None else None
+            response = await send_message(client, instructions, message, max_tokens, tally, scanner=scanner)
+            response_text = response_text_of(response)
+        else:
+            print(f"Response cut off at max_tokens - continuing ({continuations}/{MAX_CONTINUATIONS})")
+            # The API rejects an assistant prefill that ends in whitespace
+            response_text = response_text.rstrip()
+            response = await send_message(client, instructions, message, max_tokens, tally, response_text, scanner)
+            response_text += response_text_of(response)
+        stop_reason = response.stop_reason
+    return response_text, stop_reason, continuations
+
+async def call_claude(client, instructions, message, parse_response, max_retries=3, max_tokens=MAX_TOKENS, on_item=None):
+    """Send one requirement message through the shared rate limiter, parse the reply and retry on failure
+
+    With STREAM_RESPONSES the reply is streamed: malformed output aborts the attempt early,
+    and `on_item` sees each element of a top-level JSON array as soon as it closes.
+    """
+    cache_key = response_cache_key(instructions, message, max_tokens)
+    cached = RESPONSE_CACHE.get(cache_key)
+    if cached is not None:
+        try:
+            result = parse_response(cached)
+            record_call(instructions, "cache")
+            return result
+        except Exception:
+            pass  # Stale entry the current parser rejects: fetch a fresh response
     
+    # Metrics cover the whole call: every attempt's tokens, rate-limiter waits and backoff
+    started = time.perf_counter()
+    tally = {**dict.fromkeys(TOKEN_USAGE, 0), "queue_seconds": 0.0, "ttft_seconds": None}
+    stop_reason = None
+    continuations = 0
     for attempt in range(max_retries):
         try:
-            message = client.messages.create(
-                model=MODEL,
-                max_tokens=MAX_TOKENS,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            
-            response_text = message.content[0].text
+            scanner = StreamingJSONScanner(on_item) if STREAM_RESPONSES else None
+            response = await send_message(client, instructions, message, max_tokens, tally, scanner=scanner)
+            stop_reason = response.stop_reason
+            response_text = response_text_of(response)
+            if stop_reason == "max_tokens":
+                response_text, stop_reason, used = await continue_truncated(
+                    client, instructions, message, response_text, max_tokens, tally, scanner
+                )
+                continuations += used
+            if answers_with_tool(instructions):
+                response_text = await complete_tool_answer(client, instructions, message, response_text)
             
-            # Parse JSON
-            import json
-            if "```json" in response_text:
-                response_text = response_text.split("```json")[1].split("```")[0]
-            elif "```" in response_text:
-                response_text = response_text.split("```")[1].split("```")[0]
-            
-            improved = json.loads(response_text.strip())
-            
-            # Verify placeholder preservation
-            verify_placeholders_preserved(customer_req, improved['improved_requirement'])
-            
-            return [{
-                "requirement_type": improved['requirement_type'],
-                "requirement_text": improved['improved_requirement'],
-                "verification_method": improved['verification_method'],
-                "placeholders": ", ".join(improved.get('placeholders_preserved', [])),
-                "incose_rules": ", ".join(improved.get('incose_rules_applied', [])),
-                "vague_terms_removed": improved.get('vague_terms_removed', []),
-                "tolerances_added": improved.get('tolerances_added', []),
-                "improvements": improved.get('improvements_summary', '')
-            }]
+            result = parse_response(response_text)
+            # Only responses that parsed are worth replaying
+            RESPONSE_CACHE.put(cache_key, response_text)
+            record_call(instructions, "interactive", tally, time.perf_counter() - started, tally["ttft_seconds"],
+                        retries=attempt, stop_reason=stop_reason, continuations=continuations)
+            return result
             
         except Exception as e:
+            headers = getattr(getattr(e, 'response', None), 'headers', None)
+            RATE_LIMITER.update_from_headers(headers)
             if attempt < max_retries - 1:
                 print(f"Retry {attempt + 1}/{max_retries} after error: {str(e)[:100]}")
-                time.sleep(2)
+                await asyncio.sleep(RATE_LIMITER.backoff_delay(attempt, parse_retry_after(headers)))
             else:
-                print(f"Improvement failed: {str(e)[:200]}")
-                return [{
-                    "requirement_type": "ERROR",
-                    "requirement_text": f"ERROR: {str(e)[:500]}",
-                    "verification_method": "N/A",
-                    "placeholders": "",
-                    "incose_rules": "",
-                    "vague_terms_removed": [],
-                    "tolerances_added": [],
-                    "improvements": ""
-                }]
-
-def split_requirement(client, customer_req, num_requirements, capabilities, max_retries=3):
-    """Split requirement into atomic INCOSE-compliant requirements"""
-    prompt = SPLIT_REQUIREMENT_PROMPT.format(
+                record_call(instructions, "interactive", tally, time.perf_counter() - started, tally["ttft_seconds"],
+                            retries=attempt, stop_reason=stop_reason, continuations=continuations, parsed=False)
+                raise
+
+def format_analysis(analysis):
+    """Analysis JSON → (should_split, number, capabilities, placeholders)"""
+    return (
+        analysis['should_split'],
+        analysis['number_of_atomic_requirements'],
+        analysis['identified_capabilities'],
+        analysis.get('placeholders_found', [])
+    )
+
+def format_improvement(customer_req, improved):
+    """Improvement JSON → list with one formatted requirement (placeholders are checked by restore_placeholders)"""
+    return [{
+        "requirement_type": improved['requirement_type'],
+        "requirement_text": improved['improved_requirement'],
+        "verification_method": improved['verification_method'],
+        "placeholders": ", ".join(improved.get('placeholders_preserved', [])),
+        "incose_rules": ", ".join(improved.get('incose_rules_applied', [])),
+        "vague_terms_removed": improved.get('vague_terms_removed', []),
+        "tolerances_added": improved.get('tolerances_added', []),
+        "improvements": improved.get('improvements_summary', '')
+    }]
+
+def format_split(customer_req, requirements):
+    """Split JSON array → list of formatted requirements (placeholders are checked by restore_placeholders)"""
+    # Format output
+    formatted = []
+    for req in requirements:
+        formatted.append({
+            "requirement_type": req['requirement_type'],
+            "requirement_text": req['requirement_text'],
+            "verification_method": req['verification_method'],
+            "placeholders": ", ".join(req.get('placeholders_used', [])),
+            "incose_rules": ", ".join(req.get('incose_rules_applied', [])),
+            "vague_terms_removed": req.get('vague_terms_removed', []),
+            "tolerances_added": req.get('tolerances_added', []),
+            "improvements": req.get('improvements_summary', '')
+        })
+    return formatted
+
+def format_fused(customer_req, fused):
+    """Fused JSON → (analysis tuple, formatted requirements), validated like the two-stage path"""
+    analysis = format_analysis(fused)
+    requirements = fused['requirements']
+    if not isinstance(requirements, list) or not requirements:
+        raise ValueError("Fused response has no requirements array")
+    if not analysis[0] and len(requirements) != 1:
+        raise ValueError(f"Atomic requirement returned {len(requirements)} requirements")
+    if analysis[0] and len(requirements) < 2:
+        raise ValueError("Split decision returned fewer than 2 requirements")
+    return analysis, format_split(customer_req, requirements)
+
+def error_requirement(error):
+    """Placeholder result for a requirement whose transformation failed"""
+    return {
+        "requirement_type": "ERROR",
+        "requirement_text": f"ERROR: {str(error)[:500]}",
+        "verification_method": "N/A",
+        "placeholders": "",
+        "incose_rules": "",
+        "vague_terms_removed": [],
+        "tolerances_added": [],
+        "improvements": ""
+    }
+
+async def analyze_requirement(client, customer_req, max_retries=3):
+    """Analyze if requirement should be split (R18)"""
+    message = REQUIREMENT_MESSAGE.format(customer_req=customer_req)
+    
+    try:
+        return await call_claude(
+            client, ANALYZE_SPLIT_PROMPT, message,
+            lambda text: format_analysis(parse_json_response(text)),
+            max_retries, output_budget("analyze", customer_req)
+        )
+    except Exception:
+        print(f"Analysis failed after {max_retries} attempts, using default")
+        return (False, 1, ["Unknown"], extract_placeholders(customer_req))
+
+async def improve_requirement(client, customer_req, max_retries=3):
+    """Improve atomic requirement with all 42 INCOSE rules"""
+    message = REQUIREMENT_MESSAGE.format(customer_req=customer_req)
+    
+    try:
+        return await call_claude(
+            client, IMPROVE_REQUIREMENT_PROMPT, message,
+            lambda text: format_improvement(customer_req, parse_json_response(text)),
+            max_retries, output_budget("improve", customer_req)
+        )
+    except Exception as e:
+        print(f"Improvement failed: {str(e)[:200]}")
+        return [error_requirement(e)]
+
+async def split_requirement(client, customer_req, num_requirements, capabilities, max_retries=3):
+    """Split requirement into atomic INCOSE-compliant requirements (one call per capability in fan-out mode)"""
+    if FAN_OUT_SPLITS and len(capabilities) >= FAN_OUT_MIN_CAPABILITIES:
+        fanned = await fan_out_split(client, customer_req, capabilities)
+        if fanned is not None:
+            return fanned
+    message = SPLIT_REQUIREMENT_MESSAGE.format(
         customer_req=customer_req,
         num_requirements=num_requirements,
-        capabilities=", ".join(capabilities),
-        incose_rules=COMPLETE_INCOSE_RULES
+        capabilities=", ".join(capabilities)
     )
     
-    for attempt in range(max_retries):
+    try:
+        formatted = await call_claude(
+            client, SPLIT_REQUIREMENT_PROMPT, message,
+            lambda text: format_split(customer_req, parse_json_response(text)),
+            max_retries, output_budget("split", customer_req, num_requirements),
+            validate_sub_requirement
+        )
+        print(f"Split into {len(formatted)} requirements")
+        return formatted
+    except Exception as e:
+        print(f"Split failed: {str(e)[:200]}")
+        return [error_requirement(e)]
+
+# Subject of a requirement: everything before its first modal verb
+SUBJECT_PATTERN = re.compile(r'^.*?(?=\b(?:shall|must|should|will)\b)', re.IGNORECASE | re.DOTALL)
+
+FAN_OUT_STATS = {"splits": 0, "calls": 0, "retried": 0, "failed": 0, "fallbacks": 0}
+
+def assign_placeholders(customer_req, capabilities):
+    """Placeholders per capability: those the capability names, those in the subject (every
+    capability shares it), and each remaining one to the capability it most likely belongs to"""
+    expected = list(dict.fromkeys(extract_placeholders(customer_req)))
+    subject = SUBJECT_PATTERN.match(str(customer_req))
+    shared = set(extract_placeholders(subject.group(0))) if subject else set()
+    assigned = [[name for name in expected if name in shared or f"[{name}]" in capability] for capability in capabilities]
+    for name in expected:
+        if not any(name in names for names in assigned):
+            assigned[placeholder_owner(customer_req, name, capabilities, expected)].append(name)
+    return [[name for name in expected if name in names] for names in assigned]
+
+async def fan_out_split(client, customer_req, capabilities, max_retries=3):
+    """One improve-style call per capability, run concurrently; the requirements come back in
+    capability order. A failed capability is retried on its own and ends as an error requirement
+    in its slot if it keeps failing; None only when every capability failed (the caller then
+    splits in one call)."""
+    assigned = assign_placeholders(customer_req, capabilities)
+    
+    async def improve_capability(number, capability, names):
+        message = CAPABILITY_REQUIREMENT_MESSAGE.format(
+            number=number,
+            num_requirements=len(capabilities),
+            customer_req=customer_req,
+            capability=capability,
+            placeholders=", ".join(f"[{name}]" for name in names) or "(none)"
+        )
+        return await call_claude(
+            client, CAPABILITY_REQUIREMENT_PROMPT, message,
+            lambda text: format_improvement(customer_req, parse_json_response(text)),
+            max_retries, output_budget("improve", customer_req)
+        )
+    
+    FAN_OUT_STATS["splits"] += 1
+    FAN_OUT_STATS["calls"] += len(capabilities)
+    jobs = list(enumerate(zip(capabilities, assigned), 1))
+    results = await asyncio.gather(
+        *(improve_capability(number, capability, names) for number, (capability, names) in jobs),
+        return_exceptions=True
+    )
+    failed = [i for i, result in enumerate(results) if isinstance(result, Exception)]
+    if len(failed) == len(results):
+        FAN_OUT_STATS["fallbacks"] += 1
+        print(f"Capability fan-out failed: {str(results[0])[:200]} - splitting in one call")
+        return None
+    if failed:
+        # Keep the capabilities that succeeded; only the failed ones get another round
+        FAN_OUT_STATS["retried"] += len(failed)
+        FAN_OUT_STATS["calls"] += len(failed)
+        print(f"Capability fan-out: retrying {len(failed)} of {len(results)} capabilities")
+        retried = await asyncio.gather(
+            *(improve_capability(jobs[i][0], *jobs[i][1]) for i in failed),
+            return_exceptions=True
+        )
+        for i, result in zip(failed, retried):
+            if isinstance(result, Exception):
+                FAN_OUT_STATS["failed"] += 1
+                print(f"Capability {jobs[i][0]} failed: {str(result)[:200]}")
+                result = [error_requirement(result)]
+            results[i] = result
+    print(f"Fanned out into {len(results)} capability requirements")
+    return [requirement for result in results for requirement in result]
+
+def fan_out_summary():
+    return (
+        f"Fan-out: {FAN_OUT_STATS['splits']} splits as {FAN_OUT_STATS['calls']} capability calls "
+        f"({FAN_OUT_STATS['retried']} capabilities retried, {FAN_OUT_STATS['failed']} failed; "
+        f"{FAN_OUT_STATS['fallbacks']} fell back to one split call)"
+    )
+
+async def fused_requirement(client, customer_req, max_retries=3):
+    """Analyze (R18) and improve/split in one call; None if the fused call keeps failing"""
+    message = REQUIREMENT_MESSAGE.format(customer_req=customer_req)
+    
+    try:
+        return await call_claude(
+            client, FUSED_REQUIREMENT_PROMPT, message,
+            lambda text: format_fused(customer_req, parse_json_response(text)),
+            max_retries, output_budget("fused", customer_req)
+        )
+    except Exception as e:
+        print(f"Fused stage failed: {str(e)[:200]}")
+        return None
+
+# ==================== PACKED IMPROVE CALLS ====================
+# The rules prefix dominates the input of every call; packing several atomic requirements
+# into one improve prompt pays for it once per pack instead of once per requirement.
+
+def pack_message(customer_reqs):
+    """User message with each requirement under its key R1, R2, ..."""
+    return "\n\n".join(
+        f"KEY: R{i+1}\n" + REQUIREMENT_MESSAGE.format(customer_req=customer_req)
+        for i, customer_req in enumerate(customer_reqs)
+    )
+
+def pack_budget(customer_reqs):
+    """max_tokens for a pack: the improve budgets of its requirements added up"""
+    return min(MAX_TOKENS, sum(output_budget("improve", customer_req) for customer_req in customer_reqs))
+
+def pack_is_full(pack_reqs, customer_req):
+    """True when customer_req would push the pack past its count, input or output budget"""
+    return bool(pack_reqs) and (
+        len(pack_reqs) >= PACK_MAX_REQUIREMENTS
+        or sum(estimate_tokens(req) for req in pack_reqs) + estimate_tokens(customer_req) > PACK_MAX_INPUT_TOKENS
+        or sum(output_budget("improve", req) for req in pack_reqs) + output_budget("improve", customer_req) > MAX_TOKENS
+    )
+
+def plan_packs(customer_reqs):
+    """Consecutive positions of customer_reqs grouped into packs within the count and token budgets"""
+    packs, current = [], []
+    for position, customer_req in enumerate(customer_reqs):
+        if pack_is_full([customer_reqs[p] for p in current], customer_req):
+            packs.append(current)
+            current = []
+        current.append(position)
+    if current:
+        packs.append(current)
+    return packs
+
+def format_packed(customer_reqs, packed):
+    """Packed JSON array → {position: improvement JSON} for every key that came back complete"""
+    if not isinstance(packed, list):
+        raise ValueError("Packed response is not a JSON array")
+    items = {}
+    for item in packed:
+        match = re.fullmatch(r'R(\d+)', str(item.get('key', ''))) if isinstance(item, dict) else None
+        if match and 0 < int(match.group(1)) <= len(customer_reqs):
+            position = int(match.group(1)) - 1
+            try:
+                format_improvement(customer_reqs[position], item)
+            except (KeyError, TypeError):
+                continue
+            items[position] = item
+    if not items:
+        raise ValueError("Packed response matched none of the keys")
+    return items
+
+def unpack_improvements(customer_reqs, items):
+    """{position: formatted requirement list}; each result is also cached as a single improve response"""
+    results = {}
+    for position, item in items.items():
+        customer_req = customer_reqs[position]
+        improved = {field: value for field, value in item.items() if field != 'key'}
+        RESPONSE_CACHE.put(
+            response_cache_key(IMPROVE_REQUIREMENT_PROMPT, REQUIREMENT_MESSAGE.format(customer_req=customer_req),
+                               output_budget("improve", customer_req)),
+            json.dumps(improved, ensure_ascii=False)
+        )
+        results[position] = format_improvement(customer_req, improved)
+    return results
+
+async def improve_packed(client, customer_reqs, max_retries=2):
+    """Improve several atomic requirements in one call; a pack that fails is bisected and
+    each half retried, and keys missing from a partial answer are retried as their own pack
+    """
+    if len(customer_reqs) == 1:
+        return [await improve_requirement(client, customer_reqs[0])]
+    
+    try:
+        items = await call_claude(
+            client, PACKED_IMPROVE_PROMPT, pack_message(customer_reqs),
+            lambda text: format_packed(customer_reqs, parse_json_response(text)),
+            max_retries, pack_budget(customer_reqs)
+        )
+    except Exception as e:
+        half = len(customer_reqs) // 2
+        print(f"Pack of {len(customer_reqs)} failed ({str(e)[:100]}) - retrying as {half} + {len(customer_reqs) - half}")
+        left, right = await asyncio.gather(
+            improve_packed(client, customer_reqs[:half], max_retries),
+            improve_packed(client, customer_reqs[half:], max_retries)
+        )
+        return left + right
+    
+    results = unpack_improvements(customer_reqs, items)
+    missing = [position for position in range(len(customer_reqs)) if position not in results]
+    if missing:
+        print(f"Pack answered {len(results)}/{len(customer_reqs)} keys - retrying {len(missing)}")
+        for position, result in zip(missing, await improve_packed(client, [customer_reqs[p] for p in missing], max_retries)):
+            results[position] = result
+    return [results[position] for position in range(len(customer_reqs))]
+
+class ImprovePacker:
+    """Collects the improve calls of concurrently processed rows into packs.
+
+    A pack is sent when it is full (see pack_is_full) or PACK_LINGER_SECONDS after its
+    first requirement arrived.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.pending = []  # (customer_req, future)
+        self.timer = None
+        self.tasks = set()
+        self.packs_sent = 0
+        self.packed_requirements = 0
+
+    async def improve(self, customer_req):
+        if pack_is_full([req for req, _ in self.pending], customer_req):
+            self.flush()
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((customer_req, future))
+        if len(self.pending) >= PACK_MAX_REQUIREMENTS:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(PACK_LINGER_SECONDS, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        pending, self.pending = self.pending, []
+        if pending:
+            task = asyncio.ensure_future(self._send(pending))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _send(self, pending):
+        self.packs_sent += 1
+        self.packed_requirements += len(pending)
         try:
-            message = client.messages.create(
-                model=MODEL,
-                max_tokens=MAX_TOKENS,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            
-            response_text = message.content[0].text
-            
-            # Parse JSON
-            import json
-            if "```json" in response_text:
-                response_text = response_text.split("```json")[1].split("```")[0]
-            elif "```" in response_text:
-                response_text = response_text.split("```")[1].split("```")[0]
-            
-            requirements = json.loads(response_text.strip())
-            
-            # Verify placeholders distributed
-            all_generated_placeholders = set()
-            for req in requirements:
-                all_generated_placeholders.update(extract_placeholders(req['requirement_text']))
-            
-            original_placeholders = set(extract_placeholders(customer_req))
-            if not original_placeholders.issubset(all_generated_placeholders):
-                print(f"Some placeholders not distributed across split requirements")
-            
-            # Format output
-            formatted = []
-            for req in requirements:
-                formatted.append({
-                    "requirement_type": req['requirement_type'],
-                    "requirement_text": req['requirement_text'],
-                    "verification_method": req['verification_method'],
-                    "placeholders": ", ".join(req.get('placeholders_used', [])),
-                    "incose_rules": ", ".join(req.get('incose_rules_applied', [])),
-                    "vague_terms_removed": req.get('vague_terms_removed', []),
-                    "tolerances_added": req.get('tolerances_added', []),
-                    "improvements": req.get('improvements_summary', '')
-                })
-            
-            print(f"Split into {len(formatted)} requirements")
-            return formatted
-            
+            results = await improve_packed(self.client, [customer_req for customer_req, _ in pending])
         except Exception as e:
-            if attempt < max_retries - 1:
-                print(f"Retry {attempt + 1}/{max_retries} after error: {str(e)[:100]}")
-                time.sleep(2)
-            else:
-                print(f"Split failed: {str(e)[:200]}")
-                return [{
-                    "requirement_type": "ERROR",
-                    "requirement_text": f"ERROR: {str(e)[:500]}",
-                    "verification_method": "N/A",
-                    "placeholders": "",
-                    "incose_rules": "",
-                    "vague_terms_removed": [],
-                    "tolerances_added": [],
-                    "improvements": ""
-                }]
+            results = [[error_requirement(e)] for _ in pending]
+        for (_, future), result in zip(pending, results):
+            if not future.done():
+                future.set_result(result)
+
+    def summary(self):
+        average = self.packed_requirements / self.packs_sent if self.packs_sent else 0.0
+        return f"Packed improve: {self.packed_requirements} requirements in {self.packs_sent} packs ({average:.1f} per pack)"
 
 def format_list_to_string(item_list):
     """Convert list to readable string format"""
@@ -593,179 +2774,1067 @@ def format_list_to_string(item_list):
         return "; ".join(str(item) for item in item_list)
     return str(item_list)
 
-def process_requirement(client, row, index, total):
-    """Main processing logic with progress tracking"""
+async def process_requirement(client, row, index, total, packer=None):
+    """Main processing logic with progress tracking (atomic improve calls go through `packer` when given)"""
     customer_req = row.get('customer_req', '')
     category = row.get('Category', f'REQ_{index}')
     
     print(f"\n[{index}/{total}] Processing: {category}")
     print(f"   Original: {customer_req[:80]}...")
     
-    # Extract placeholders
+    # Extract placeholders; the model sees them as [P<n>] tokens when masking is on
     placeholders = extract_placeholders(customer_req)
     if placeholders:
         print(f"Placeholders found: {placeholders}")
+    original_req = customer_req
+    customer_req, names = mask_placeholders(original_req) if MASK_PLACEHOLDERS else (original_req, [])
     
-    # Step 1: Analyze atomicity (R18)
-    should_split, num_reqs, capabilities, _ = analyze_requirement(client, customer_req)
-    time.sleep(0.5)  # Rate limiting
+    requirements = None
+    analysis = None
     
-    # Step 2: Process accordingly
-    if should_split:
-        print(f"Splitting → {num_reqs} requirements")
-        requirements = split_requirement(client, customer_req, num_reqs, capabilities)
-    else:
-        print(f"Atomic → Applying 42 INCOSE rules")
-        requirements = improve_requirement(client, customer_req)
+    # Optional local R18 decision: clear cases skip the analyze call
+    if PRECLASSIFY_ATOMICITY:
+        decision, analysis = preclassify_requirement(customer_req)
+        PRECLASSIFY_STATS[decision] += 1
+        if analysis is not None:
+            print(f"Pre-classified as {decision} (analyze call skipped)")
+    
+    # Optional single round trip: decision and transformation in one call
+    if FUSED_STAGES and analysis is None:
+        fused = await fused_requirement(client, customer_req)
+        if fused is not None:
+            (should_split, num_reqs, _, _), requirements = fused
+            print(f"Fused → {len(requirements)} requirement(s)")
+        else:
+            print(f"Falling back to analyze + improve/split")
     
-    time.sleep(0.5)  # Rate limiting
+    if requirements is None:
+        # Step 1: Analyze atomicity (R18)
+        if analysis is None:
+            analysis = await analyze_requirement(client, customer_req)
+        should_split, num_reqs, capabilities, _ = analysis
+        
+        # Step 2: Process accordingly
+        if should_split:
+            print(f"Splitting → {num_reqs} requirements")
+            requirements = await split_requirement(client, customer_req, num_reqs, capabilities)
+        else:
+            print(f"Atomic → Applying 42 INCOSE rules")
+            if packer is not None:
+                requirements = await packer.improve(customer_req)
+            else:
+                requirements = await improve_requirement(client, customer_req)
+    
+    await restore_placeholders(client, original_req, requirements, names)
+    if CHECK_RULES:
+        await check_rules(client, original_req, requirements)
+    
+    if SCAN_VAGUE_TERMS:
+        record_vague_candidates(requirements, row.get('vague_findings'))
     
     # Add source information
     for req in requirements:
         req['category'] = category
-        req['original_req'] = customer_req
+        req['original_req'] = original_req
     
     return requirements
 
-def process_all_requirements(df):
+def build_output_rows(category, customer_req, results):
+    """Turn the sub-requirements of one input row into output rows (A-J)"""
+    # Simple consolidation without extra API call for efficiency
+    if len(results) == 1:
+        consolidated = results[0]['requirement_text']
+        detailed = results[0]['requirement_text']
+    else:
+        consolidated = f"The system shall meet {len(results)} requirements addressing: " + ", ".join([req['requirement_type'] for req in results])
+        detailed = "The system shall meet the following requirements:\n" + "\n".join([
+            f"{i+1}. {req['requirement_text']}" for i, req in enumerate(results)
+        ])
+    
+    # Add to results with exact column structure requested
+    rows = []
+    for i, req in enumerate(results):
+        rows.append({
+            'Category': category,
+            'Customer_Req': customer_req,
+            'Ambiguities_Identified': req.get('improvements', ''),
+            'Improvements_Made': req.get('incose_rules', ''),
+            'Vague_Terms_Removed': format_list_to_string(req.get('vague_terms_removed', [])),
+            'Tolerances_Added': format_list_to_string(req.get('tolerances_added', [])),
+            'Consolidated_Requirement': consolidated if i == 0 else '',  # Only first row
+            'Detailed_Requirement': detailed if i == 0 else '',  # Only first row
+            'Sub_Requirement_Text': req['requirement_text'],
+            'Verification_Method': req['verification_method'],
+            'Vague_Term_Candidates': format_list_to_string(req.get('vague_term_candidates', [])),
+        })
+    return rows
+
+def build_error_row(category, customer_req, error):
+    """Output row for an input requirement that could not be processed"""
+    return {
+        'Category': category,
+        'Customer_Req': customer_req,
+        'Ambiguities_Identified': 'Processing error',
+        'Improvements_Made': 'N/A',
+        'Vague_Terms_Removed': '',
+        'Tolerances_Added': '',
+        'Consolidated_Requirement': f'ERROR: {str(error)[:200]}',
+        'Detailed_Requirement': f'ERROR: {str(error)[:200]}',
+        'Sub_Requirement_Text': f'ERROR: {str(error)[:500]}',
+        'Verification_Method': 'N/A'
+    }
+
+# ==================== CHECKPOINT JOURNAL ====================
+
+def requirement_hash(customer_req):
+    """Content hash of a requirement (whitespace-normalized), used to match journal entries"""
+    normalized = " ".join(str(customer_req).split())
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()[:16]
+
+def start_journal(path):
+    """Begin an empty journal for a fresh (non-resumed) run"""
+    if path:
+        with open(path, "w", encoding="utf-8"):
+            pass
+
+def record_finished(path, category, customer_req, output_rows):
+    """Durably append one finished requirement to the journal (fsync'd before returning)
+
+    Rows that ended in an error are not recorded, so a resumed run retries them.
+    """
+    if not path or any(str(row['Sub_Requirement_Text']).startswith('ERROR:') for row in output_rows):
+        return
+    record = {"category": category, "req_hash": requirement_hash(customer_req), "rows": output_rows}
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def load_journal(path):
+    """Journal entries as {(category, req_hash): output rows}
+
+    A torn last line (crash mid-write) is cut off so later appends start on a clean line.
+    """
+    journal = {}
+    if not path or not os.path.exists(path):
+        return journal
+    valid_bytes = 0
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if not line.endswith(b"\n"):
+                break
+            journal[(record["category"], record["req_hash"])] = record["rows"]
+            valid_bytes += len(line)
+    if valid_bytes < os.path.getsize(path):
+        with open(path, "r+b") as f:
+            f.truncate(valid_bytes)
+    return journal
+
+def select_pending(df, journal):
+    """Rows of df that still need processing (not in the journal with identical text)"""
+    pending = [
+        (row['Category'], requirement_hash(row['customer_req'])) not in journal
+        for _, row in df.iterrows()
+    ]
+    return df[pending]
+
+# ==================== DIFF MODE ====================
+
+def previous_output_key(customer_req):
+    """Hash matching a requirement across runs: case/whitespace-normalized text, placeholders as written
+
+    Placeholders keep their case as in find_duplicates: renaming [System_A] to [SYSTEM_A] is a change.
+    """
+    return requirement_hash(f"{normalize_requirement(customer_req)} {extract_placeholders(str(customer_req))}")
+
+def load_previous_output(filepath):
+    """Rows of an earlier output file as {previous_output_key: (Category, output rows)}
+
+    Requirements that ended in an error there are left out, so they are processed again.
+    """
+    previous = {}
+    df = read_output_file(filepath)
+    for category, group in df.groupby('Category', sort=False):
+        rows = group.to_dict('records')
+        if any(str(row['Sub_Requirement_Text']).startswith('ERROR:') for row in rows):
+            continue
+        previous.setdefault(previous_output_key(rows[0]['Customer_Req']), (category, rows))
+    print(f"Previous output {filepath}: {len(previous)} requirements available to carry forward")
+    return previous
+
+def carry_forward(previous, category, customer_req, renamed):
+    """Earlier output rows for an unchanged requirement, relabelled with this run's Category, or None
+
+    `renamed` maps earlier categories to the first current one that carried them, so
+    Duplicate_Of follows rows that moved and repeated texts point at their first occurrence;
+    a representative that was not carried leaves it blank.
+    """
+    match = previous.get(previous_output_key(customer_req))
+    if match is None:
+        return None
+    previous_category, rows = match
+    first = renamed.setdefault(previous_category, category)
+    return [
+        {
+            **{column: row.get(column, '') for column in OUTPUT_COLUMNS},
+            'Category': category,
+            'Customer_Req': customer_req,
+            'Duplicate_Of': first if first != category else renamed.get(row.get('Duplicate_Of'), ''),
+        }
+        for row in rows
+    ]
+
+def carry_forward_unchanged(df, previous, journal, journal_path):
+    """Add carried rows for unchanged requirements of df to the journal (dict and file); returns the count"""
+    renamed = {}
+    carried = 0
+    for _, row in df.iterrows():
+        key = (row['Category'], requirement_hash(row['customer_req']))
+        if key in journal:
+            continue
+        output_rows = carry_forward(previous, row['Category'], row['customer_req'], renamed)
+        if output_rows:
+            journal[key] = output_rows
+            record_finished(journal_path, row['Category'], row['customer_req'], output_rows)
+            carried += 1
+    print(f"   Diff mode: {carried} unchanged requirements carried forward, "
+          f"{len(df) - carried} new or changed")
+    return carried
+
+async def process_all_requirements_async(df, max_concurrency=MAX_CONCURRENCY, journal_path=JOURNAL_FILE, output=None,
+                                         duplicates=None, templates=None):
+    """Process all requirements concurrently, at most max_concurrency rows in flight
+
+    `duplicates` (from group_duplicates) and `templates` (from group_templates) list rows
+    that are not in df but receive their representative's result.
+    Returns a DataFrame of all output rows, or None when rows are streamed to `output`.
+    """
+    client = init_claude_client()
+    if SCAN_VAGUE_TERMS:
+        df = df.assign(vague_findings=scan_vague_terms(df['customer_req']))
+        print(scan_summary(df['vague_findings']))
+    rows = list(df.iterrows())
+    total = len(rows)
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    # Packs fill from the rows in flight, so max_concurrency also caps the pack size
+    packer = ImprovePacker(client) if PACK_IMPROVE else None
+    completed = 0
+    covered = 0  # Input rows with a result, duplicates and template rows included
+    
+    print(f"\n{'='*70}")
+    print(f"PROCESSING {total} REQUIREMENTS (max {max_concurrency} in flight)")
+    print(f"{'='*70}")
+    
+    start_time = time.time()
+    
+    async def run_row(position, idx, row):
+        nonlocal completed, covered
+        # Get Category and Customer_Req from original row
+        category = row.get('Category', f'REQ_{idx+1}')
+        customer_req = row.get('customer_req', '')
+        
+        async with semaphore:
+            try:
+                results = await process_requirement(client, row, position + 1, total, packer)
+                output_rows = build_output_rows(category, customer_req, results)
+            except Exception as e:
+                print(f" Error processing row {idx}: {str(e)[:200]}")
+                output_rows = [build_error_row(category, customer_req, e)]
+        
+        members = fan_out_results(category, customer_req, output_rows, duplicates, templates)
+        for member_category, member_req, member_rows in members:
+            record_finished(journal_path, member_category, member_req, member_rows)
+            if output is not None:
+                output.add(member_category, member_rows)
+        completed += 1
+        covered += len(members)
+        # Progress update every 10 requirements
+        if completed % 10 == 0:
+            elapsed = time.time() - start_time
+            remaining = elapsed / completed * (total - completed)
+            print(f"\n Progress: {completed}/{total} ({completed/total*100:.1f}%) - Est. remaining: {remaining/60:.1f} min")
+        
+        return [] if output is not None else [row for _, _, member_rows in members for row in member_rows]
+    
+    try:
+        # gather() returns in submission order, so output rows keep the input order
+        per_row = await asyncio.gather(*(
+            run_row(position, idx, row) for position, (idx, row) in enumerate(rows)
+        ))
+    finally:
+        await client.close()
+        print_run_summary(covered)
+        if packer is not None:
+            print(packer.summary())
+        RESPONSE_CACHE.close()
+    
+    elapsed = time.time() - start_time
+    print(f"\n{'='*70}")
+    print(f"PROCESSING COMPLETE - Total time: {elapsed/60:.1f} minutes")
+    print(f"{'='*70}")
+    
+    if output is not None:
+        return None
+    return pd.DataFrame([output_row for output_rows in per_row for output_row in output_rows])
+
+def process_all_requirements(df, max_concurrency=MAX_CONCURRENCY, journal_path=JOURNAL_FILE, output=None,
+                             duplicates=None, templates=None):
     """Process all requirements with progress tracking"""
+    return asyncio.run(process_all_requirements_async(df, max_concurrency, journal_path, output, duplicates, templates))
+
+async def process_stream_async(records, max_concurrency=MAX_CONCURRENCY, journal_path=JOURNAL_FILE, output=None, journal=None,
+                               previous=None):
+    """Process (Category, customer_req) records as they are read, at most max_concurrency rows in flight
+
+    Records are pulled INPUT_CHUNK_ROWS at a time in a worker thread and queued for the
+    processing tasks; the bounded queue keeps reading just ahead of processing. Journaled
+    rows, and unchanged rows carried from `previous` (see load_previous_output), are written
+    straight to `output`. Returns the number of requirements read.
+    """
     client = init_claude_client()
-    all_results = []
-    total = len(df)
+    queue = asyncio.Queue(maxsize=2 * max(1, max_concurrency))
+    packer = ImprovePacker(client) if PACK_IMPROVE else None
+    journal = journal or {}
+    renamed = {}
+    counts = {"read": 0, "completed": 0, "covered": 0, "carried": 0}
     
     print(f"\n{'='*70}")
-    print(f"PROCESSING {total} REQUIREMENTS")
+    print(f"PROCESSING STREAMED INPUT (max {max_concurrency} in flight, read in chunks of {INPUT_CHUNK_ROWS})")
     print(f"{'='*70}")
     
     start_time = time.time()
     
-    for idx, row in df.iterrows():
+    async def read_records():
+        iterator = iter(records)
         try:
-            results = process_requirement(client, row, idx + 1, total)
-            
-            # Get Category and Customer_Req from original row
-            category = row.get('Category', f'REQ_{idx+1}')
-            customer_req = row.get('customer_req', '')
-            
-            # Create consolidated versions
-            print(f"Consolidating requirements...")
-            
-            # Simple consolidation without extra API call for efficiency
-            if len(results) == 1:
-                consolidated = results[0]['requirement_text']
-                detailed = results[0]['requirement_text']
-            else:
-                consolidated = f"The system shall meet {len(results)} requirements addressing: " + ", ".join([req['requirement_type'] for req in results])
-                detailed = "The system shall meet the following requirements:\n" + "\n".join([
-                    f"{i+1}. {req['requirement_text']}" for i, req in enumerate(results)
-                ])
-            
-            # Collect all vague terms and tolerances across sub-requirements
-            all_vague_terms = []
-            all_tolerances = []
-            for req in results:
-                all_vague_terms.extend(req.get('vague_terms_removed', []))
-                all_tolerances.extend(req.get('tolerances_added', []))
-            
-            # Add to results with exact column structure requested
-            for i, req in enumerate(results):
-                result = {
-                    'Category': category,
-                    'Customer_Req': customer_req,
-                    'Ambiguities_Identified': req.get('improvements', ''),
-                    'Improvements_Made': req.get('incose_rules', ''),
-                    'Vague_Terms_Removed': format_list_to_string(req.get('vague_terms_removed', [])),
-                    'Tolerances_Added': format_list_to_string(req.get('tolerances_added', [])),
-                    'Consolidated_Requirement': consolidated if i == 0 else '',  # Only first row
-                    'Detailed_Requirement': detailed if i == 0 else '',  # Only first row
-                    'Sub_Requirement_Text': req['requirement_text'],
-                    'Verification_Method': req['verification_method']
-                }
-                all_results.append(result)
-            
-            time.sleep(0.5)
-            
-            # Progress update every 10 requirements
-            if (idx + 1) % 10 == 0:
+            while True:
+                chunk = await asyncio.to_thread(lambda: list(itertools.islice(iterator, INPUT_CHUNK_ROWS)))
+                if not chunk:
+                    break
+                for category, customer_req in chunk:
+                    counts["read"] += 1
+                    output.expect(category)
+                    journaled = journal.get((category, requirement_hash(customer_req)))
+                    carried = None if journaled or not previous else carry_forward(previous, category, customer_req, renamed)
+                    if carried:
+                        record_finished(journal_path, category, customer_req, carried)
+                        counts["carried"] += 1
+                    if journaled or carried:
+                        output.add(category, journaled or carried)
+                        counts["covered"] += 1
+                    else:
+                        await queue.put((category, customer_req))
+        finally:
+            for _ in range(max(1, max_concurrency)):
+                await queue.put(None)
+    
+    async def process_records():
+        while (record := await queue.get()) is not None:
+            category, customer_req = record
+            row = {'Category': category, 'customer_req': customer_req}
+            if SCAN_VAGUE_TERMS:
+                row['vague_findings'] = scan_vague_terms(pd.Series([customer_req])).iloc[0]
+            try:
+                results = await process_requirement(client, row, counts["completed"] + 1, "?", packer)
+                output_rows = build_output_rows(category, customer_req, results)
+            except Exception as e:
+                print(f" Error processing {category}: {str(e)[:200]}")
+                output_rows = [build_error_row(category, customer_req, e)]
+            record_finished(journal_path, category, customer_req, output_rows)
+            output.add(category, output_rows)
+            counts["completed"] += 1
+            counts["covered"] += 1
+            if counts["completed"] % 10 == 0:
                 elapsed = time.time() - start_time
-                avg_time = elapsed / (idx + 1)
-                remaining = avg_time * (total - idx - 1)
-                print(f"\n Progress: {idx+1}/{total} ({(idx+1)/total*100:.1f}%) - Est. remaining: {remaining/60:.1f} min")
-            
-        except Exception as e:
-            print(f" Error processing row {idx}: {str(e)[:200]}")
-            all_results.append({
-                'Category': row.get('Category', f'REQ_{idx}'),
-                'Customer_Req': row.get('customer_req', ''),
-                'Ambiguities_Identified': 'Processing error',
-                'Improvements_Made': 'N/A',
-                'Vague_Terms_Removed': '',
-                'Tolerances_Added': '',
-                'Consolidated_Requirement': f'ERROR: {str(e)[:200]}',
-                'Detailed_Requirement': f'ERROR: {str(e)[:200]}',
-                'Sub_Requirement_Text': f'ERROR: {str(e)[:500]}',
-                'Verification_Method': 'N/A'
-            })
+                print(f"\n Progress: {counts['completed']} processed, {counts['read']} read - "
+                      f"{counts['completed'] / elapsed * 60:.1f} requirements/min")
+    
+    try:
+        await asyncio.gather(read_records(), *(process_records() for _ in range(max(1, max_concurrency))))
+    finally:
+        await client.close()
+        print_run_summary(counts["covered"])
+        if packer is not None:
+            print(packer.summary())
+        RESPONSE_CACHE.close()
     
     elapsed = time.time() - start_time
     print(f"\n{'='*70}")
-    print(f"PROCESSING COMPLETE - Total time: {elapsed/60:.1f} minutes")
+    print(f"PROCESSING COMPLETE - {counts['read']} requirements in {elapsed/60:.1f} minutes")
+    if previous:
+        print(f"Diff mode: {counts['carried']} unchanged requirements carried forward")
     print(f"{'='*70}")
+    return counts["read"]
+
+# ==================== BATCH MODE ====================
+
+async def run_message_batch(client, requests):
+    """Submit {custom_id: (instructions, message, parse_response, max_tokens)} as one message batch.
+
+    Cached responses are answered locally; the rest are submitted, polled until the batch
+    has ended and parsed. Entries cut off at max_tokens are continued interactively.
+    Returns {custom_id: parsed result} for every request that succeeded.
+    """
+    results = {}
+    pending = {}
+    for custom_id, (instructions, message, parse_response, max_tokens) in requests.items():
+        cache_key = response_cache_key(instructions, message, max_tokens)
+        cached = RESPONSE_CACHE.get(cache_key)
+        if cached is not None:
+            try:
+                results[custom_id] = parse_response(cached)
+                record_call(instructions, "cache")
+                continue
+            except Exception:
+                pass
+        pending[custom_id] = (instructions, message, parse_response, max_tokens, cache_key)
     
-    return pd.DataFrame(all_results)
+    if not pending:
+        return results
+    
+    batch = await client.messages.batches.create(requests=[
+        {"custom_id": custom_id, "params": build_message_params(instructions, message, max_tokens)}
+        for custom_id, (instructions, message, _, max_tokens, _) in pending.items()
+    ])
+    print(f"   Batch {batch.id} submitted: {len(pending)} requests ({len(results)} answered from cache)")
+    
+    while batch.processing_status != "ended":
+        await asyncio.sleep(BATCH_POLL_SECONDS)
+        batch = await client.messages.batches.retrieve(batch.id)
+        counts = batch.request_counts
+        print(f"   Batch {batch.id}: {counts.processing} processing, {counts.succeeded} succeeded, {counts.errored} errored")
+    
+    async for entry in await client.messages.batches.results(batch.id):
+        if entry.custom_id not in pending:
+            continue
+        instructions, message, parse_response, max_tokens, cache_key = pending[entry.custom_id]
+        if entry.result.type != "succeeded":
+            print(f"   {entry.custom_id}: batch request {entry.result.type}")
+            record_call(instructions, "batch", stop_reason=entry.result.type, parsed=False)
+            continue
+        response = entry.result.message
+        record_usage(response.usage)
+        tally = {**usage_tokens(response.usage), "queue_seconds": 0.0}
+        response_text = response_text_of(response)
+        stop_reason = response.stop_reason
+        continuations = 0
+        try:
+            if stop_reason == "max_tokens":
+                # The batch gave up at max_tokens: finish the response with interactive calls
+                response_text, stop_reason, continuations = await continue_truncated(
+                    client, instructions, message, response_text, max_tokens, tally
+                )
+            if answers_with_tool(instructions):
+                response_text = await complete_tool_answer(client, instructions, message, response_text)
+            results[entry.custom_id] = parse_response(response_text)
+            RESPONSE_CACHE.put(cache_key, response_text)
+            record_call(instructions, "batch", tally, stop_reason=stop_reason, continuations=continuations)
+        except Exception as e:
+            print(f"   {entry.custom_id}: could not parse batch result: {str(e)[:100]}")
+            record_call(instructions, "batch", tally, stop_reason=stop_reason, continuations=continuations, parsed=False)
+    
+    return results
 
-def export_to_excel(df, filepath):
-    """Export to Excel with formatting"""
-    # Ensure exact column order as requested
-    column_order = [
-        'Category',
-        'Customer_Req',
-        'Ambiguities_Identified',
-        'Improvements_Made',
-        'Vague_Terms_Removed',
-        'Tolerances_Added',
-        'Consolidated_Requirement',
-        'Detailed_Requirement',
-        'Sub_Requirement_Text',
-        'Verification_Method'
-    ]
+async def process_all_requirements_batch_async(df, journal_path=JOURNAL_FILE, output=None, duplicates=None, templates=None):
+    """Process all requirements with two message batches: analyze, then improve/split
+    (a single batch of fused prompts when FUSED_STAGES is set)
+
+    `duplicates` and `templates` are handled as in process_all_requirements_async.
+    Returns a DataFrame of all output rows, or None when rows are streamed to `output`.
+    """
+    client = init_claude_client()
+    originals = dict(zip(df['Category'], df['customer_req']))
+    # Prompts carry the masked text; names are put back when each row's results are assembled
+    masked = {category: mask_placeholders(customer_req) if MASK_PLACEHOLDERS else (customer_req, [])
+              for category, customer_req in originals.items()}
+    rows = [(category, masked[category][0]) for category in originals]
+    findings = {}
+    if SCAN_VAGUE_TERMS:
+        scanned = scan_vague_terms(df['customer_req'])
+        findings = dict(zip(df['Category'], scanned))
+        print(scan_summary(scanned))
+    
+    print(f"\n{'='*70}")
+    print(f"PROCESSING {len(rows)} REQUIREMENTS IN BATCH MODE")
+    print(f"{'='*70}")
     
-    # Reorder columns
-    df = df[column_order]
+    start_time = time.time()
+    covered = 0  # Input rows with a result, duplicates and template rows included
     
-    with pd.ExcelWriter(filepath, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='ISO_Compliant_Requirements')
+    try:
+        if FUSED_STAGES:
+            # Decision and transformation in a single batch
+            print("\nBatch 1/1: analyzing and transforming...")
+            analyses = {}
+            transformed = await run_message_batch(client, {
+                category: (
+                    FUSED_REQUIREMENT_PROMPT,
+                    REQUIREMENT_MESSAGE.format(customer_req=customer_req),
+                    lambda text, req=customer_req: format_fused(req, parse_json_response(text))[1],
+                    output_budget("fused", customer_req)
+                )
+                for category, customer_req in rows
+            })
+        else:
+            # Stage 1: analyze atomicity (R18) in one batch, except rows the pre-classifier settles
+            analyses = {}
+            if PRECLASSIFY_ATOMICITY:
+                for category, customer_req in rows:
+                    decision, analysis = preclassify_requirement(customer_req)
+                    PRECLASSIFY_STATS[decision] += 1
+                    if analysis is not None:
+                        analyses[category] = analysis
+            print("\nBatch 1/2: analyzing atomicity...")
+            analyses.update(await run_message_batch(client, {
+                category: (
+                    ANALYZE_SPLIT_PROMPT,
+                    REQUIREMENT_MESSAGE.format(customer_req=customer_req),
+                    lambda text: format_analysis(parse_json_response(text)),
+                    output_budget("analyze", customer_req)
+                )
+                for category, customer_req in rows
+                if category not in analyses
+            }))
+            for category, customer_req in rows:
+                if category not in analyses:
+                    # Failed batch entries fall back to an interactive call
+                    analyses[category] = await analyze_requirement(client, customer_req)
         
-        worksheet = writer.sheets['ISO_Compliant_Requirements']
+            # Stage 2: improve atomic requirements, split compound ones
+            print("\nBatch 2/2: improving and splitting...")
+            requests = {}
+            atomic = [(category, customer_req) for category, customer_req in rows if not analyses[category][0]]
+            packs = plan_packs([customer_req for _, customer_req in atomic]) if PACK_IMPROVE else []
+            for number, pack in enumerate(packs):
+                pack_reqs = [atomic[position][1] for position in pack]
+                requests[f"PACK_{number+1:04d}"] = (
+                    PACKED_IMPROVE_PROMPT,
+                    pack_message(pack_reqs),
+                    lambda text, reqs=pack_reqs: format_packed(reqs, parse_json_response(text)),
+                    pack_budget(pack_reqs)
+                )
+            for category, customer_req in rows:
+                should_split, num_reqs, capabilities, _ = analyses[category]
+                if PACK_IMPROVE and not should_split:
+                    continue
+                if should_split:
+                    requests[category] = (
+                        SPLIT_REQUIREMENT_PROMPT,
+                        SPLIT_REQUIREMENT_MESSAGE.format(
+                            customer_req=customer_req,
+                            num_requirements=num_reqs,
+                            capabilities=", ".join(capabilities)
+                        ),
+                        lambda text, req=customer_req: format_split(req, parse_json_response(text)),
+                        output_budget("split", customer_req, num_reqs)
+                    )
+                else:
+                    requests[category] = (
+                        IMPROVE_REQUIREMENT_PROMPT,
+                        REQUIREMENT_MESSAGE.format(customer_req=customer_req),
+                        lambda text, req=customer_req: format_improvement(req, parse_json_response(text)),
+                        output_budget("improve", customer_req)
+                    )
+            transformed = await run_message_batch(client, requests)
+            if packs:
+                # Unpack keyed results; atomic rows a pack did not answer are packed again interactively
+                for number, pack in enumerate(packs):
+                    pack_reqs = [atomic[position][1] for position in pack]
+                    unpacked = unpack_improvements(pack_reqs, transformed.pop(f"PACK_{number+1:04d}", None) or {})
+                    for offset, result in unpacked.items():
+                        transformed[atomic[pack[offset]][0]] = result
+                retry = [(category, customer_req) for category, customer_req in atomic if category not in transformed]
+                if retry:
+                    print(f"   {len(retry)} packed requirements unanswered - retrying in interactive packs")
+                    for position_pack in plan_packs([customer_req for _, customer_req in retry]):
+                        pack_reqs = [retry[position][1] for position in position_pack]
+                        for position, result in zip(position_pack, await improve_packed(client, pack_reqs)):
+                            transformed[retry[position][0]] = result
+                print(f"Packed improve: {len(atomic)} requirements in {len(packs)} packs")
         
-        # Column widths - updated for new structure
-        column_widths = {
-            'A': 15,  # Category
-            'B': 60,  # Customer_Req
-            'C': 40,  # Ambiguities_Identified
-            'D': 50,  # Improvements_Made
-            'E': 40,  # Vague_Terms_Removed
-            'F': 40,  # Tolerances_Added
-            'G': 50,  # Consolidated_Requirement
-            'H': 70,  # Detailed_Requirement
-            'I': 70,  # Sub_Requirement_Text
-            'J': 20   # Verification_Method
-        }
+        # Finish rows concurrently: placeholder repair, rule checks and interactive fallbacks are API calls
+        semaphore = asyncio.Semaphore(max(1, MAX_CONCURRENCY))
         
-        for col, width in column_widths.items():
-            worksheet.column_dimensions[col].width = width
+        async def finish_row(category, customer_req):
+            nonlocal covered
+            async with semaphore:
+                results = transformed.get(category)
+                if results is None and category not in analyses:
+                    # Failed fused batch entry: run the interactive pipeline for this row (it restores placeholders itself)
+                    customer_req = originals[category]
+                    results = await process_requirement(client, {
+                        'Category': category, 'customer_req': customer_req, 'vague_findings': findings.get(category)
+                    }, 1, 1)
+                else:
+                    if results is None:
+                        should_split, num_reqs, capabilities, _ = analyses[category]
+                        if should_split:
+                            results = await split_requirement(client, customer_req, num_reqs, capabilities)
+                        else:
+                            results = await improve_requirement(client, customer_req)
+                    customer_req = originals[category]
+                    results = await restore_placeholders(client, customer_req, results, masked[category][1])
+                    if CHECK_RULES:
+                        await check_rules(client, customer_req, results)
+            if SCAN_VAGUE_TERMS:
+                record_vague_candidates(results, findings.get(category))
+            output_rows = build_output_rows(category, customer_req, results)
+            members = fan_out_results(category, customer_req, output_rows, duplicates, templates)
+            covered += len(members)
+            finished = []
+            for member_category, member_req, member_rows in members:
+                record_finished(journal_path, member_category, member_req, member_rows)
+                if output is not None:
+                    output.add(member_category, member_rows)
+                else:
+                    finished.extend(member_rows)
+            return finished
         
-        # Text wrapping
-        for row in worksheet.iter_rows(min_row=2, max_row=worksheet.max_row):
-            for cell in row:
-                cell.alignment = cell.alignment.copy(wrap_text=True)
+        # gather returns rows in input order for the in-memory result; output.add orders by itself
+        finished_rows = await asyncio.gather(*(finish_row(category, customer_req) for category, customer_req in rows))
+        all_results = [row for row_results in finished_rows for row in row_results]
+    finally:
+        await client.close()
+        print_run_summary(covered)
+        RESPONSE_CACHE.close()
+    
+    elapsed = time.time() - start_time
+    print(f"\n{'='*70}")
+    print(f"PROCESSING COMPLETE - Total time: {elapsed/60:.1f} minutes")
+    print(f"{'='*70}")
+    
+    if output is not None:
+        return None
+    return pd.DataFrame(all_results)
+
+def process_all_requirements_batch(df, journal_path=JOURNAL_FILE, output=None, duplicates=None, templates=None):
+    """Process all requirements through the Message Batches API"""
+    return asyncio.run(process_all_requirements_batch_async(df, journal_path, output, duplicates, templates))
+
+# ==================== SHARDED PROCESSING ====================
+# --shards N runs N worker processes, each on its own part of the workbook with its own API key
+# (SHARD_API_KEYS), rate limiter, journal, cassette and output. Shards fail independently; the
+# parent merges their rows back into OUTPUT_FILE in Category order.
+
+def shard_path(path, shard_index, shard_count):
+    """path with a .shard<i>of<n> suffix before its extension(s); None stays None"""
+    if not path:
+        return path
+    root, extension = os.path.splitext(path)
+    if extension == ".gz":
+        root, inner_extension = os.path.splitext(root)
+        extension = inner_extension + extension
+    return f"{root}.shard{shard_index + 1}of{shard_count}{extension}"
+
+def shard_of(customer_req, shard_count):
+    """Hash shard of a requirement; case, whitespace and placeholder names are ignored, so exact
+    duplicates and template variants land in the same shard and still share their calls"""
+    template, _ = canonicalize_placeholders(customer_req)
+    return zlib.crc32(normalize_requirement(template).encode("utf-8")) % shard_count
+
+def partition_rows(df, shard_count, strategy="range"):
+    """shard_count DataFrames: contiguous row ranges, or rows grouped by requirement hash"""
+    if strategy == "hash":
+        shard_numbers = np.array([shard_of(customer_req, shard_count) for customer_req in df['customer_req']])
+        return [df[shard_numbers == shard_index] for shard_index in range(shard_count)]
+    bounds = np.linspace(0, len(df), shard_count + 1).astype(int)
+    return [df.iloc[bounds[i]:bounds[i + 1]] for i in range(shard_count)]
+
+def shard_api_key(shard_index):
+    """(API key of a shard, the round-robin key list it was taken from)"""
+    keys = [key for key in SHARD_API_KEYS if key] or [API_KEY]
+    return keys[shard_index % len(keys)], keys
+
+def shard_settings():
+    """Configuration values a worker needs: it re-imports this module with the defaults"""
+    settings = {
+        name: value for name, value in globals().items()
+        if name.isupper() and isinstance(value, (str, int, float, bool, list, dict, type(None)))
+    }
+    # The cache this run uses (None when disabled), not the file configured at import time
+    settings["CACHE_FILE"] = RESPONSE_CACHE.path
+    return settings
+
+def run_shard(shard_index, shard_count, df_shard, args, settings, log_path):
+    """Worker process: one shard with its own API key, rate limiter, journal, cassette and output"""
+    global API_KEY, RATE_LIMITER, RESPONSE_CACHE, METRICS_FILE, PROMETHEUS_FILE, CASSETTE_REPORT_FILE, OUTPUT_FORMATS
+    globals().update(settings)
+    sys.stdout = sys.stderr = open(log_path, "w", buffering=1, encoding="utf-8")
+    
+    API_KEY, keys = shard_api_key(shard_index)
+    # Shards sharing a key share its organization's limits
+    sharing = sum(1 for i in range(shard_count) if keys[i % len(keys)] == API_KEY)
+    RATE_LIMITER = RateLimiter(RATE_LIMIT_RPM / sharing, RATE_LIMIT_INPUT_TPM / sharing, RATE_LIMIT_OUTPUT_TPM / sharing)
+    RESPONSE_CACHE = ResponseCache(CACHE_FILE, CACHE_MAX_AGE_DAYS, CACHE_MAX_SIZE_MB)
+    METRICS_FILE = shard_path(METRICS_FILE, shard_index, shard_count)
+    PROMETHEUS_FILE = shard_path(PROMETHEUS_FILE, shard_index, shard_count)
+    CASSETTE_REPORT_FILE = shard_path(CASSETTE_REPORT_FILE, shard_index, shard_count)
+    OUTPUT_FORMATS = ["csv"]  # Merged into OUTPUT_FILE by the parent
+    
+    print(f"Shard {shard_index + 1}/{shard_count}: {len(df_shard)} requirements")
+    run_pipeline(
+        df_shard, args,
+        shard_path(OUTPUT_FILE, shard_index, shard_count),
+        shard_path(JOURNAL_FILE, shard_index, shard_count),
+        shard_path(args.cassette_file, shard_index, shard_count),
+    )
+
+def count_lines(path):
+    if not path or not os.path.exists(path):
+        return 0
+    with open(path, "rb") as f:
+        return sum(1 for _ in f)
+
+def print_shard_progress(workers, shard_count):
+    for shard_index, (process, df_shard, _) in enumerate(workers):
+        finished = count_lines(shard_path(JOURNAL_FILE, shard_index, shard_count))
+        state = "running" if process.is_alive() else "done" if process.exitcode == 0 else f"FAILED (exit code {process.exitcode})"
+        print(f"   Shard {shard_index + 1}/{shard_count}: {finished}/{len(df_shard)} finished - {state}")
+
+def read_shard_rows(path):
+    """{Category: output rows} from a shard's CSV output"""
+    rows = {}
+    if os.path.exists(path):
+        with open(path, newline="", encoding="utf-8") as f:
+            for output_row in csv.DictReader(f):
+                rows.setdefault(output_row['Category'], []).append(output_row)
+    return rows
+
+def merge_shards(df_input, workers, shard_count):
+    """Write every shard's rows to OUTPUT_FILE in input order; returns (output rows, error rows)
+
+    Journaled rows come first, then the shard's own output (error rows included); rows of
+    a shard that died before writing them get an error row, so --resume retries just those.
+    """
+    output = open_output(df_input['Category'], OUTPUT_FILE, OUTPUT_FORMATS)
+    error_count = 0
+    try:
+        for shard_index, (process, df_shard, log_path) in enumerate(workers):
+            journal = load_journal(shard_path(JOURNAL_FILE, shard_index, shard_count))
+            shard_output = shard_path(OUTPUT_FILE, shard_index, shard_count)
+            written = read_shard_rows(f"{os.path.splitext(shard_output)[0]}.csv")
+            for _, row in df_shard.iterrows():
+                output_rows = (
+                    journal.get((row['Category'], requirement_hash(row['customer_req'])))
+                    or written.get(row['Category'])
+                    or [build_error_row(row['Category'], row['customer_req'],
+                                        f"shard {shard_index + 1} failed (exit code {process.exitcode}), see {log_path}")]
+                )
+                error_count += sum(1 for output_row in output_rows if str(output_row.get('Sub_Requirement_Text', '')).startswith("ERROR"))
+                output.add(row['Category'], output_rows)
+    finally:
+        output.close()
+    return output.row_count, error_count
+
+def process_sharded(df_input, args):
+    """Run the shards in worker processes, report their progress and merge their rows"""
+    shard_count = args.shards
+    shards = partition_rows(df_input, shard_count, args.shard_by)
+    context = multiprocessing.get_context("spawn")
+    settings = shard_settings()
+    workers = []
+    print(f"\nSHARDED MODE: {len(df_input)} requirements across {shard_count} worker processes (by {args.shard_by})")
+    for shard_index, df_shard in enumerate(shards):
+        log_path = shard_path(f"{os.path.splitext(OUTPUT_FILE)[0]}.log", shard_index, shard_count)
+        process = context.Process(
+            target=run_shard, args=(shard_index, shard_count, df_shard, args, settings, log_path), name=f"shard-{shard_index + 1}"
+        )
+        process.start()
+        workers.append((process, df_shard, log_path))
+        print(f"   Shard {shard_index + 1}/{shard_count}: {len(df_shard)} requirements, log {log_path}")
+    
+    while any(process.is_alive() for process, _, _ in workers):
+        for process, _, _ in workers:
+            process.join(timeout=SHARD_PROGRESS_SECONDS / len(workers))
+        print(f"\n[{datetime.now().strftime('%H:%M:%S')}] Shard progress:")
+        print_shard_progress(workers, shard_count)
+    
+    failed = [shard_index + 1 for shard_index, (process, _, _) in enumerate(workers) if process.exitcode != 0]
+    row_count, error_count = merge_shards(df_input, workers, shard_count)
+    if row_count and error_count == row_count:
+        print(f"\nERROR: Every one of the {row_count} merged rows in {OUTPUT_FILE} is an error row - see the shard logs")
+        sys.exit(1)
+    print(f"\nMerged {shard_count} shards into {OUTPUT_FILE}: {row_count} rows ({error_count} error rows)")
+    if failed:
+        print(f"WARNING: Shard(s) {', '.join(map(str, failed))} failed - rerun with --resume --shards {shard_count} "
+              f"--shard-by {args.shard_by} to retry only their unfinished rows")
+    return row_count
+
+# ==================== OUTPUT ====================
+
+# Exact output column order (A-L) and widths
+OUTPUT_COLUMNS = [
+    'Category',
+    'Customer_Req',
+    'Ambiguities_Identified',
+    'Improvements_Made',
+    'Vague_Terms_Removed',
+    'Tolerances_Added',
+    'Consolidated_Requirement',
+    'Detailed_Requirement',
+    'Sub_Requirement_Text',
+    'Verification_Method',
+    'Duplicate_Of',
+    'Vague_Term_Candidates'
+]
+
+COLUMN_WIDTHS = {
+    'A': 15,  # Category
+    'B': 60,  # Customer_Req
+    'C': 40,  # Ambiguities_Identified
+    'D': 50,  # Improvements_Made
+    'E': 40,  # Vague_Terms_Removed
+    'F': 40,  # Tolerances_Added
+    'G': 50,  # Consolidated_Requirement
+    'H': 70,  # Detailed_Requirement
+    'I': 70,  # Sub_Requirement_Text
+    'J': 20,  # Verification_Method
+    'K': 15,  # Duplicate_Of
+    'L': 30   # Vague_Term_Candidates
+}
+
+class ExcelSink:
+    """Write-only openpyxl workbook: rows go straight to disk, one shared wrap-text style"""
+
+    def __init__(self, filepath, sheet_name='ISO_Compliant_Requirements'):
+        self.filepath = filepath
+        self.workbook = Workbook(write_only=True)
+        self.workbook.add_named_style(NamedStyle(name="header", font=Font(bold=True)))
+        self.workbook.add_named_style(NamedStyle(name="wrapped", alignment=Alignment(wrap_text=True)))
+        self.worksheet = self.workbook.create_sheet(sheet_name)
+        # Column widths must be set before the first row in write-only mode
+        for col, width in COLUMN_WIDTHS.items():
+            self.worksheet.column_dimensions[col].width = width
+        self.worksheet.append([self._cell(column, "header") for column in OUTPUT_COLUMNS])
+
+    def _cell(self, value, style):
+        cell = WriteOnlyCell(self.worksheet, value=value)
+        cell.style = style
+        return cell
+
+    def write(self, output_row):
+        self.worksheet.append([self._cell(output_row.get(column, ''), "wrapped") for column in OUTPUT_COLUMNS])
+
+    def close(self):
+        self.workbook.save(self.filepath)
+
+class CsvSink:
+    """CSV file written row by row"""
+
+    def __init__(self, filepath):
+        self.file = open(filepath, "w", newline="", encoding="utf-8")
+        self.writer = csv.DictWriter(self.file, fieldnames=OUTPUT_COLUMNS, extrasaction="ignore")
+        self.writer.writeheader()
+
+    def write(self, output_row):
+        self.writer.writerow(output_row)
+
+    def close(self):
+        self.file.close()
+
+class ParquetSink:
+    """Parquet file written in row groups of `row_group_size` rows (requires pyarrow)"""
+
+    def __init__(self, filepath, row_group_size=1000):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("ERROR: Parquet output requires pyarrow (pip install pyarrow)")
+        self.pa = pa
+        self.schema = pa.schema([(column, pa.string()) for column in OUTPUT_COLUMNS])
+        self.writer = pq.ParquetWriter(filepath, self.schema)
+        self.row_group_size = row_group_size
+        self.buffer = []
+
+    def write(self, output_row):
+        self.buffer.append({column: str(output_row.get(column, '')) for column in OUTPUT_COLUMNS})
+        if len(self.buffer) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.writer.write_table(self.pa.Table.from_pylist(self.buffer, schema=self.schema))
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+OUTPUT_SINKS = {"xlsx": ExcelSink, "csv": CsvSink, "parquet": ParquetSink}
+
+class OrderedOutput:
+    """Streams output rows to the sinks in input (Category) order as requirements finish.
+
+    Requirements that finish early wait in a small buffer until every requirement
+    before them has been written, so memory stays bounded by the rows in flight.
+    """
+
+    def __init__(self, categories, sinks):
+        self.order = list(categories)
+        self.sinks = sinks
+        self.next_index = 0
+        self.waiting = {}
+        self.row_count = 0
+
+    def expect(self, category):
+        """Append a category to the write order (streamed input: categories arrive as rows are read)"""
+        self.order.append(category)
+    
+    def add(self, category, output_rows):
+        self.waiting[category] = output_rows
+        while self.next_index < len(self.order) and self.order[self.next_index] in self.waiting:
+            self._write(self.waiting.pop(self.order[self.next_index]))
+            self.next_index += 1
+
+    def _write(self, output_rows):
+        for output_row in output_rows:
+            for sink in self.sinks:
+                sink.write(output_row)
+            self.row_count += 1
+
+    def close(self):
+        # Anything still waiting (e.g. after an interrupted run) is written in input order
+        for category in self.order[self.next_index:]:
+            if category in self.waiting:
+                self._write(self.waiting.pop(category))
+        for sink in self.sinks:
+            sink.close()
+
+def open_output(categories, filepath, formats=OUTPUT_FORMATS):
+    """OrderedOutput writing to filepath (xlsx) and/or sibling .csv/.parquet files"""
+    base = os.path.splitext(filepath)[0]
+    sinks = []
+    for output_format in formats:
+        path = filepath if output_format == "xlsx" else f"{base}.{output_format}"
+        sinks.append(OUTPUT_SINKS[output_format](path))
+        print(f"   Writing {output_format}: {path}")
+    return OrderedOutput(categories, sinks)
+
+def export_to_excel(df, filepath):
+    """Export to Excel with formatting"""
+    sink = ExcelSink(filepath)
+    for output_row in df.to_dict('records'):
+        sink.write(output_row)
+    sink.close()
     
     print(f"\n Excel exported: {filepath}")
 
 # ==================== MAIN ====================
 
+def run_streaming_pipeline(filepath, args, output_file, journal_file, cassette_file):
+    """Journal and ordered output for rows streamed from filepath; returns (requirements read, output row count)"""
+    open_cassette(cassette_file, args.cassette)
+    if args.resume:
+        journal = load_journal(journal_file)
+    else:
+        journal = {}
+        start_journal(journal_file)
+    previous = load_previous_output(args.previous_output) if args.previous_output else None
+    output = open_output([], output_file, OUTPUT_FORMATS)
+    try:
+        read = asyncio.run(process_stream_async(iter_requirements(filepath), args.concurrency, journal_file, output, journal,
+                                                previous))
+    finally:
+        output.close()
+        if CASSETTE is not None:
+            CASSETTE.close()
+            print(CASSETTE.summary())
+    return read, output.row_count
+
+def run_pipeline(df_input, args, output_file, journal_file, cassette_file):
+    """Journal, duplicate/template grouping, processing and ordered output for df_input; returns the output row count"""
+    open_cassette(cassette_file, args.cassette)
+    if args.resume:
+        journal = load_journal(journal_file)
+    else:
+        journal = {}
+        start_journal(journal_file)
+    if args.previous_output:
+        carry_forward_unchanged(df_input, load_previous_output(args.previous_output), journal, journal_file)
+    df_pending = select_pending(df_input, journal)
+    if args.resume:
+        print(f"   Resuming: {len(df_input) - len(df_pending)} requirements from journal, {len(df_pending)} to process")
+    duplicates = {}
+    if args.dedupe and len(df_pending) > 0:
+        duplicate_of = find_duplicates(df_pending)
+        duplicates = group_duplicates(df_pending, duplicate_of)
+        df_pending = df_pending[~df_pending['Category'].isin(duplicate_of)]
+    templates = {}
+    if args.templates and len(df_pending) > 0:
+        df_pending, templates = group_templates(df_pending)
+    
+    output = open_output(df_input['Category'], output_file, OUTPUT_FORMATS)
+    try:
+        for _, row in df_input.iterrows():
+            journaled = journal.get((row['Category'], requirement_hash(row['customer_req'])))
+            if journaled:
+                output.add(row['Category'], journaled)
+        
+        if len(df_pending) > 0 and args.mode == "batch":
+            process_all_requirements_batch(df_pending, journal_file, output, duplicates, templates)
+        elif len(df_pending) > 0:
+            process_all_requirements(df_pending, args.concurrency, journal_file, output, duplicates, templates)
+    finally:
+        output.close()
+        if CASSETTE is not None:
+            CASSETTE.close()
+            print(CASSETTE.summary())
+    
+    if CASSETTE is not None and CASSETTE.mode != "record":
+        cassette_mismatch_report(df_pending, CASSETTE.misses, duplicates, templates, CASSETTE_REPORT_FILE)
+    return output.row_count
+
+def parse_args():
+    """Command line options (defaults come from the configuration section)"""
+    parser = argparse.ArgumentParser(description="Requirements Processor - 42 INCOSE rules + ISO 29148")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip requirements already recorded in the checkpoint journal")
+    parser.add_argument("--previous-output", default=PREVIOUS_OUTPUT_FILE,
+                        help="earlier output file; only new or changed requirements are processed (diff mode)")
+    parser.add_argument("--mode", choices=["interactive", "batch"], default=PROCESSING_MODE,
+                        help="interactive API calls or Message Batches API")
+    parser.add_argument("--concurrency", type=int, default=MAX_CONCURRENCY,
+                        help="requirements in flight at once (interactive mode)")
+    parser.add_argument("--fused", action="store_true", default=FUSED_STAGES,
+                        help="one fused analyze+transform call per requirement")
+    parser.add_argument("--fan-out", action="store_true", default=FAN_OUT_SPLITS,
+                        help="split large requirements with one concurrent call per capability")
+    parser.add_argument("--pack", action="store_true", default=PACK_IMPROVE,
+                        help="pack several atomic requirements into each improve call")
+    parser.add_argument("--preclassify", action="store_true", default=PRECLASSIFY_ATOMICITY,
+                        help="settle clear R18 split decisions locally instead of calling analyze")
+    parser.add_argument("--no-dedupe", dest="dedupe", action="store_false", default=DEDUPLICATE_REQUIREMENTS,
+                        help="send every requirement to the API, even exact or near duplicates")
+    parser.add_argument("--no-templates", dest="templates", action="store_false", default=SHARE_PLACEHOLDER_TEMPLATES,
+                        help="process rows that differ only in placeholder names separately")
+    parser.add_argument("--cassette", choices=["record", "replay", "replay_or_record"], default=CASSETTE_MODE,
+                        help="record API exchanges to CASSETTE_FILE, or replay them from it")
+    parser.add_argument("--cassette-file", default=CASSETTE_FILE)
+    parser.add_argument("--shards", type=int, default=SHARD_COUNT,
+                        help="worker processes, each with its own part of the workbook, API key and rate limiter")
+    parser.add_argument("--shard-by", choices=["range", "hash"], default=SHARD_STRATEGY,
+                        help="split rows into contiguous ranges, or by requirement hash (keeps duplicates together); "
+                             "--resume needs the same --shards and --shard-by")
+    parser.add_argument("--compare-with", metavar="REFERENCE_OUTPUT",
+                        help="after the run, list rows whose Sub_Requirement_Text differs from this earlier output file")
+    parser.add_argument("--stream-input", action="store_true", default=STREAM_INPUT,
+                        help="read and process rows lazily as they are read (interactive mode; no duplicate/template grouping)")
+    return parser.parse_args()
+
 def main():
     """Main execution"""
+    global FUSED_STAGES, PRECLASSIFY_ATOMICITY, PACK_IMPROVE, FAN_OUT_SPLITS
+    args = parse_args()
+    FUSED_STAGES = args.fused
+    PACK_IMPROVE = args.pack
+    FAN_OUT_SPLITS = args.fan_out
+    PRECLASSIFY_ATOMICITY = args.preclassify
+    
     print("=" * 80)
     print("REQUIREMENTS PROCESSOR v6 - COMPLETE 42 INCOSE RULES (UPDATED)")
     print("All 42 INCOSE Guide rules implemented")
@@ -777,26 +3846,39 @@ def main():
     print("=" * 80)
     
     try:
-        # 1. Load Excel
-        print("\n[1/3] Loading Excel file...")
-        df_input = load_excel(INPUT_FILE)
-        
-        # 2. Process all requirements
-        print("\n[2/3] Processing requirements with 42 INCOSE rules...")
-        df_output = process_all_requirements(df_input)
+        if args.stream_input and args.mode != "batch" and args.shards == 1:
+            # Rows are read and processed in one pass; the input is never held in memory
+            print("\n[1/1] Streaming and processing requirements with 42 INCOSE rules...")
+            input_count, row_count = run_streaming_pipeline(INPUT_FILE, args, OUTPUT_FILE, JOURNAL_FILE, args.cassette_file)
+        else:
+            if args.stream_input:
+                print("--stream-input applies to interactive single-process runs; loading the whole input")
+            # 1. Load Excel
+            print("\n[1/2] Loading Excel file...")
+            df_input = load_excel(INPUT_FILE)
+            input_count = len(df_input)
+            
+            # 2. Process all requirements (skipping those already journaled when resuming);
+            #    each one is written to the output as soon as every requirement before it is done
+            print("\n[2/2] Processing requirements with 42 INCOSE rules...")
+            if args.shards > 1:
+                row_count = process_sharded(df_input, args)
+            else:
+                row_count = run_pipeline(df_input, args, OUTPUT_FILE, JOURNAL_FILE, args.cassette_file)
         
-        # 3. Export results
-        print("\n[3/3] Exporting ISO-compliant requirements...")
-        export_to_excel(df_output, OUTPUT_FILE)
+        if args.compare_with:
+            first_format = OUTPUT_FORMATS[0]
+            output_path = OUTPUT_FILE if first_format == "xlsx" else f"{os.path.splitext(OUTPUT_FILE)[0]}.{first_format}"
+            compare_outputs(args.compare_with, output_path)
         
         # Summary
         print("\n" + "=" * 80)
         print("SUCCESSFULLY COMPLETED!")
         print("=" * 80)
-        print(f"Input:  {len(df_input)} original requirements")
-        print(f"Output: {len(df_output)} processed requirements")
+        print(f"Input:  {input_count} original requirements")
+        print(f"Output: {row_count} processed requirements")
         print(f"File:   {OUTPUT_FILE}")
-        print("\nOutput column structure (A-J):")
+        print("\nOutput column structure (A-L):")
         print("   A: Category (auto-generated REQ_001, REQ_002, ...)")
         print("   B: Customer_Req (from input column A)")
         print("   C: Ambiguities_Identified")
@@ -807,6 +3889,8 @@ def main():
         print("   H: Detailed_Requirement")
         print("   I: Sub_Requirement_Text")
         print("   J: Verification_Method")
+        print("   K: Duplicate_Of (representative Category for exact/near duplicates)")
+        print("   L: Vague_Term_Candidates (local scan of the input, for review)")
         print("\nAll 42 INCOSE Rules Applied:")
         print("   Structure & Format (R1-R6)")
         print("   Clarity & Precision (R7-R17)")
@@ -1,18 +1,30 @@
 import pandas as pd
-from anthropic import Anthropic
+from anthropic import AsyncAnthropic, DefaultAsyncHttpxClient
+import asyncio
+import json
 import os
 import time
 from datetime import datetime
 import re
+import requirements_neutralization as neutralization
+from requirements_neutralization import ResponseCache, CassetteTransport
 
 API_KEY = ""
 INPUT_FILE = "inpuc_vague_requirements_500.xlsx"
 OUTPUT_FILE = f"output_vague_requirements_500.xlsx"
 MODEL = "claude-sonnet"
-MAX_TOKENS = 20000
+API_BASE_URL = None  # e.g. the mock_llm_server.py endpoint for offline runs
+MAX_TOKENS = 20000  # Ceiling for the per-stage budgets below
+OUTPUT_TOKENS = {"analyze": 600, "improve": 1200, "split": 1200}  # split: per sub-requirement
+MAX_CONTINUATIONS = 3
 MAX_RETRIES = 3
-COMPLETE_INCOSE_RULES = """
-
+MAX_CONCURRENCY = 8
+CACHE_FILE = "response_cache.sqlite"
+CASSETTE_MODE = None  # "record", "replay" or "replay_or_record" (see requirements_neutralization.py)
+CASSETTE_FILE = "requirements_cassette.jsonl.gz"
+# Per-call metrics, recorded and exported like requirements_neutralization.py's (None = don't write)
+METRICS_FILE = "requirements_processing_metrics.json"
+PROMETHEUS_FILE = "requirements_processing_metrics.prom"
 INCOSE_RULES = """
 R1 – Structured Statements
 - Use consistent pattern: [WHEN condition], [ENTITY] shall [ACTION] [OBJECT] [PERFORMANCE ± tolerance]
@@ -143,21 +155,22 @@ Quality Characteristics:
 ALL placeholders in format [PLACEHOLDER_NAME] from original requirement MUST be preserved exactly in transformed requirement.
 """
 
+# Rules + stage instructions go out as cached system blocks; only the user message varies per row
 PROMPTS = {
     "analyze": """Analyze if requirement must SPLIT (R18).
-REQ: {req}
-{rules}
-JSON only: {{"should_split": bool, "num": 1-10, "capabilities": [...], "placeholders": [...]}}""",
+JSON only: {"should_split": bool, "num": 1-10, "capabilities": [...], "placeholders": [...]}""",
     "improve": """Transform to INCOSE compliance.
-REQ: {req}
-{rules}
-JSON only: {{"type": "Functional|Performance|Interface|Safety|Security", "requirement": "...", "verification": "Test|Inspection|Analysis|Demonstration", "placeholders": [...], "rules": [...], "vague_removed": ["old → new"], "tolerances": ["metric: val ± tol"], "summary": "..."}}""",
-    "split": """Split into {num} atomic requirements.
-REQ: {req}
-CAPABILITIES: {caps}
-{rules}
-JSON array only: [{{"id": "1", "type": "...", "requirement": "...", "verification": "...", "placeholders": [...], "rules": [...], "vague_removed": [...], "tolerances": [...], "summary": "..."}}]"""
+JSON only: {"type": "Functional|Performance|Interface|Safety|Security", "requirement": "...", "verification": "Test|Inspection|Analysis|Demonstration", "placeholders": [...], "rules": [...], "vague_removed": ["old → new"], "tolerances": ["metric: val ± tol"], "summary": "..."}""",
+    "split": """Split into the requested number of atomic requirements.
+JSON array only: [{"id": "1", "type": "...", "requirement": "...", "verification": "...", "placeholders": [...], "rules": [...], "vague_removed": [...], "tolerances": [...], "summary": "..."}]"""
+}
+MESSAGES = {
+    "analyze": "REQ: {req}",
+    "improve": "REQ: {req}",
+    "split": "Split into {num} atomic requirements.\nREQ: {req}\nCAPABILITIES: {caps}"
 }
+usage = {"input_tokens": 0, "output_tokens": 0, "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0}
+
 def extract_placeholders(text):
     return re.findall(r'\[([^\]]+)\]', text or "")
 
@@ -168,87 +181,174 @@ def parse_json(text):
         text = text.split("```")[1].split("```")[0]
     return json.loads(text.strip())
 
-def call_api(client, prompt):
+cache = ResponseCache(CACHE_FILE)
+
+def system_blocks(stage):
+    return [{"type": "text", "text": INCOSE_RULES, "cache_control": {"type": "ephemeral"}},
+            {"type": "text", "text": PROMPTS[stage], "cache_control": {"type": "ephemeral"}}]
+
+def budget(stage, **fields):
+    return min(MAX_TOKENS, OUTPUT_TOKENS[stage] * fields.get("num", 1) + len(fields.get("req", "")) // 2)
+
+async def create(client, stage, prompt, max_tokens, prefill=None, tally=None):
+    # The shared limiter is looked up on the module so a rebound or reconfigured one is used;
+    # the cached rules are not reserved, output is reserved at max_tokens
+    limiter = neutralization.RATE_LIMITER
+    input_tokens = neutralization.estimate_tokens(prompt) + neutralization.estimate_tokens(prefill or "")
+    messages = [{"role": "user", "content": prompt}] + ([{"role": "assistant", "content": prefill}] if prefill else [])
+    queued = time.perf_counter()
+    await limiter.acquire(input_tokens, max_tokens)
+    if tally is not None:
+        tally["queue_seconds"] += time.perf_counter() - queued
+    try:
+        raw = await client.messages.with_raw_response.create(
+            model=MODEL, max_tokens=max_tokens, system=system_blocks(stage), messages=messages)
+        limiter.update_from_headers(raw.headers)
+        resp = await raw.parse()
+    except Exception:
+        limiter.settle(input_tokens, 0, max_tokens, 0)
+        raise
+    limiter.settle(input_tokens, resp.usage.input_tokens + (getattr(resp.usage, "cache_creation_input_tokens", None) or 0),
+                   max_tokens, resp.usage.output_tokens)
+    for k in usage:
+        usage[k] += getattr(resp.usage, k, None) or 0
+        if tally is not None:
+            tally[k] += getattr(resp.usage, k, None) or 0
+    return resp
+
+async def call_api(client, stage, **fields):
+    prompt = MESSAGES[stage].format(**fields)
+    # The rules prefix and the stage budget are part of the key: editing INCOSE_RULES or
+    # OUTPUT_TOKENS must not return stale answers
+    key = ResponseCache.make_key(MODEL, [INCOSE_RULES, PROMPTS[stage], prompt], budget(stage, **fields))
+    cached = cache.get(key)
+    if cached is not None:
+        neutralization.record_call(PROMPTS[stage], "cache", stage=stage)
+        return parse_json(cached)
+    # Metrics cover the whole call: every attempt's tokens, rate-limiter waits and backoff
+    started = time.perf_counter()
+    tally = {**dict.fromkeys(usage, 0), "queue_seconds": 0.0}
+    stop_reason, continuations = None, 0
     for attempt in range(MAX_RETRIES):
         try:
-            resp = client.messages.create(
-                model=MODEL, max_tokens=MAX_TOKENS,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            return parse_json(resp.content[0].text)
+            max_tokens = budget(stage, **fields)
+            resp = await create(client, stage, prompt, max_tokens, tally=tally)
+            text = resp.content[0].text
+            # Cut off at max_tokens: continue from what arrived instead of starting over
+            for _ in range(MAX_CONTINUATIONS):
+                if resp.stop_reason != "max_tokens":
+                    break
+                max_tokens = min(MAX_TOKENS, 2 * max_tokens)
+                text = text.rstrip()
+                resp = await create(client, stage, prompt, max_tokens, prefill=text, tally=tally)
+                text += resp.content[0].text
+                continuations += 1
+            stop_reason = resp.stop_reason
+            result = parse_json(text)
+            cache.put(key, text)
+            neutralization.record_call(PROMPTS[stage], "interactive", tally, time.perf_counter() - started, retries=attempt,
+                                       stop_reason=stop_reason, continuations=continuations, stage=stage)
+            return result
         except Exception as e:
+            headers = getattr(getattr(e, 'response', None), 'headers', None)
+            neutralization.RATE_LIMITER.update_from_headers(headers)
             if attempt < MAX_RETRIES - 1:
-                time.sleep(2)
+                await asyncio.sleep(neutralization.RATE_LIMITER.backoff_delay(attempt, neutralization.parse_retry_after(headers)))
             else:
+                neutralization.record_call(PROMPTS[stage], "interactive", tally, time.perf_counter() - started, retries=attempt,
+                                           stop_reason=stop_reason, continuations=continuations, parsed=False, stage=stage)
                 raise
 
 def fmt(items):
     return "; ".join(str(i) for i in items) if isinstance(items, list) and items else ""
 
-def process(client, req, idx, total):
+async def process(client, req, idx, total):
     print(f"[{idx}/{total}] {req[:50]}...")
     try:
-        analysis = call_api(client, PROMPTS["analyze"].format(req=req, rules=INCOSE_RULES))
+        analysis = await call_api(client, "analyze", req=req)
         should_split = analysis.get("should_split", False)
         num = analysis.get("num", 1)
         caps = analysis.get("capabilities", [])
     except:
         should_split, num, caps = False, 1, []
-    time.sleep(0.5)
     try:
         if should_split and num > 1:
             print(f"  → Split: {num}")
-            results = call_api(client, PROMPTS["split"].format(
-                req=req, num=num, caps=", ".join(caps), rules=INCOSE_RULES
-            ))
+            results = await call_api(client, "split", req=req, num=num, caps=", ".join(caps))
         else:
             print(f"  → Improve")
-            results = [call_api(client, PROMPTS["improve"].format(req=req, rules=INCOSE_RULES))]
+            results = [await call_api(client, "improve", req=req)]
     except Exception as e:
         results = [{"type": "ERROR", "requirement": str(e), "verification": "N/A"}]
     return results
 
+def rows_for(cat, req, results):
+    consolidated = results[0].get('requirement', '') if len(results) == 1 else f"System shall meet {len(results)} requirements."
+    detailed = consolidated if len(results) == 1 else "\n".join(f"{i+1}. {r.get('requirement', '')}" for i, r in enumerate(results))
+    return [{
+        'Category': cat,
+        'Customer_Req': req,
+        'Ambiguities_Identified': r.get('summary', ''),
+        'Improvements_Made': fmt(r.get('rules', [])),
+        'Vague_Terms_Removed': fmt(r.get('vague_removed', [])),
+        'Tolerances_Added': fmt(r.get('tolerances', [])),
+        'Consolidated_Requirement': consolidated if i == 0 else '',
+        'Detailed_Requirement': detailed if i == 0 else '',
+        'Sub_Requirement_Text': r.get('requirement', ''),
+        'Verification_Method': r.get('verification', '')
+    } for i, r in enumerate(results)]
+
+async def run_all(df, start):
+    cassette = CassetteTransport(CASSETTE_FILE, CASSETTE_MODE) if CASSETTE_MODE else None
+    # Retries are paced by the shared limiter
+    client = AsyncAnthropic(api_key=API_KEY or "cassette-replay", base_url=API_BASE_URL, max_retries=0,
+                            http_client=DefaultAsyncHttpxClient(transport=cassette) if cassette else None)
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    done = 0
+    async def one(idx, req):
+        nonlocal done
+        cat = f'REQ_{idx+1:03d}'
+        async with sem:
+            try:
+                rows = rows_for(cat, req, await process(client, req, idx + 1, len(df)))
+            except Exception as e:
+                rows = [{
+                    'Category': cat, 'Customer_Req': req, 'Sub_Requirement_Text': f'ERROR: {e}',
+                    'Ambiguities_Identified': '', 'Improvements_Made': '', 'Vague_Terms_Removed': '',
+                    'Tolerances_Added': '', 'Consolidated_Requirement': '', 'Detailed_Requirement': '',
+                    'Verification_Method': ''
+                }]
+        done += 1
+        if done % 10 == 0:
+            elapsed = time.time() - start
+            print(f"  {done}/{len(df)} - ~{(elapsed/done)*(len(df)-done)/60:.1f}m left")
+        return rows
+    try:
+        per_row = await asyncio.gather(*(one(idx, row['customer_req']) for idx, row in df.iterrows()))
+    finally:
+        await client.close()
+        print(cache.summary())
+        print(f"Tokens: {usage['input_tokens']} input, {usage['output_tokens']} output, "
+              f"{usage['cache_read_input_tokens']} cache read, {usage['cache_creation_input_tokens']} cache write")
+        neutralization.write_metrics(done, METRICS_FILE, PROMETHEUS_FILE, MODEL)
+        cache.close()
+        if cassette:
+            cassette.close()
+            print(cassette.summary())
+            missed = [f'REQ_{idx+1:03d}' for idx, row in df.iterrows()
+                      if any(f"REQ: {row['customer_req']}\n" in m["message"] + "\n" for m in cassette.misses)]
+            if missed:
+                print(f"Need fresh calls: {', '.join(missed)}")
+    return [r for rows in per_row for r in rows]
+
 def main():
-    if not API_KEY:
+    if not API_KEY and CASSETTE_MODE != "replay":
         raise ValueError("Set API_KEY")
-    client = Anthropic(api_key=API_KEY)
     df = pd.read_excel(INPUT_FILE)
     df['customer_req'] = df.iloc[:, 0]
     df = df[df['customer_req'].notna()]
-    all_results = []
     start = time.time()
-    for idx, row in df.iterrows():
-        req = row['customer_req']
-        cat = f'REQ_{idx+1:03d}'
-        try:
-            results = process(client, req, idx + 1, len(df))
-            consolidated = results[0].get('requirement', '') if len(results) == 1 else f"System shall meet {len(results)} requirements."
-            detailed = consolidated if len(results) == 1 else "\n".join(f"{i+1}. {r.get('requirement', '')}" for i, r in enumerate(results))
-            
-            for i, r in enumerate(results):
-                all_results.append({
-                    'Category': cat,
-                    'Customer_Req': req,
-                    'Ambiguities_Identified': r.get('summary', ''),
-                    'Improvements_Made': fmt(r.get('rules', [])),
-                    'Vague_Terms_Removed': fmt(r.get('vague_removed', [])),
-                    'Tolerances_Added': fmt(r.get('tolerances', [])),
-                    'Consolidated_Requirement': consolidated if i == 0 else '',
-                    'Detailed_Requirement': detailed if i == 0 else '',
-                    'Sub_Requirement_Text': r.get('requirement', ''),
-                    'Verification_Method': r.get('verification', '')
-                })
-            time.sleep(0.5)
-            if (idx + 1) % 10 == 0:
-                elapsed = time.time() - start
-                print(f"  {idx+1}/{len(df)} - ~{(elapsed/(idx+1))*(len(df)-idx-1)/60:.1f}m left")         
-        except Exception as e:
-            all_results.append({
-                'Category': cat, 'Customer_Req': req, 'Sub_Requirement_Text': f'ERROR: {e}',
-                'Ambiguities_Identified': '', 'Improvements_Made': '', 'Vague_Terms_Removed': '',
-                'Tolerances_Added': '', 'Consolidated_Requirement': '', 'Detailed_Requirement': '',
-                'Verification_Method': ''
-            })
+    all_results = asyncio.run(run_all(df, start))
     df_out = pd.DataFrame(all_results)[[
         'Category', 'Customer_Req', 'Ambiguities_Identified', 'Improvements_Made',
         'Vague_Terms_Removed', 'Tolerances_Added', 'Consolidated_Requirement',
@@ -0,0 +1,64 @@
+"""Shared test setup: the scripts are imported from the repository root"""
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+REQUIREMENTS = [
+    "The [UNIT] shall log [EVENT].",
+    "The display shall show the speed.",
+    "The pump shall start within 2 s.",
+]
+
+@pytest.fixture(autouse=True)
+def response_cache(monkeypatch, tmp_path):
+    """Every test gets an empty response cache of its own instead of the configured file"""
+    import requirements_neutralization
+    cache = requirements_neutralization.ResponseCache(str(tmp_path / "response_cache.sqlite"))
+    monkeypatch.setattr(requirements_neutralization, "RESPONSE_CACHE", cache)
+    yield cache
+    cache.close()
+
+class DummyClient:
+    async def close(self):
+        pass
+
+@pytest.fixture
+def pipeline(monkeypatch, tmp_path):
+    """main() without API calls: process_requirement returns each text as its own requirement
+
+    pipeline(*flags, requirements=REQUIREMENTS) runs main() and returns the output workbook;
+    pipeline.processed lists the texts sent for processing, texts in pipeline.failing raise.
+    """
+    import requirements_neutralization as rn
+    input_file = tmp_path / "input.xlsx"
+    monkeypatch.setattr(rn, "INPUT_FILE", str(input_file))
+    monkeypatch.setattr(rn, "OUTPUT_FILE", str(tmp_path / "output.xlsx"))
+    monkeypatch.setattr(rn, "JOURNAL_FILE", str(tmp_path / "journal.jsonl"))
+    monkeypatch.setattr(rn, "init_claude_client", DummyClient)
+    processed, failing = [], set()
+    
+    async def process_requirement(client, row, *args, **kwargs):
+        processed.append(row['customer_req'])
+        if row['customer_req'] in failing:
+            raise RuntimeError("529 overloaded")
+        return [{
+            "requirement_type": "Functional", "requirement_text": row['customer_req'],
+            "verification_method": "Test", "placeholders": "", "incose_rules": "",
+            "vague_terms_removed": [], "tolerances_added": [], "improvements": "",
+        }]
+    
+    monkeypatch.setattr(rn, "process_requirement", process_requirement)
+    
+    def run(*flags, requirements=REQUIREMENTS):
+        pd.DataFrame({'Requirement': requirements}).to_excel(input_file, index=False)
+        processed.clear()
+        monkeypatch.setattr(sys, "argv", ["requirements_neutralization.py", *flags])
+        rn.main()
+        return pd.read_excel(tmp_path / "output.xlsx")
+    
+    run.processed, run.failing = processed, failing
+    return run
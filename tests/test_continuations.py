@@ -0,0 +1,89 @@
+"""Per-stage output budgets and continuing responses cut off at max_tokens"""
+import asyncio
+import json
+from types import SimpleNamespace
+
+import requirements_neutralization as rn
+import requirements_processing as rp
+
+INSTRUCTIONS = "Return the requirement as JSON."
+
+class ChunkedMessages:
+    """messages.with_raw_response stand-in answering with `chunks` in turn, each but the last cut off"""
+
+    def __init__(self, chunks):
+        self.with_raw_response = self
+        self.chunks = list(chunks)
+        self.requests = []
+
+    async def create(self, **params):
+        self.requests.append(params)
+        text = self.chunks.pop(0)
+        message = SimpleNamespace(
+            content=[SimpleNamespace(type="text", text=text)],
+            stop_reason="max_tokens" if self.chunks else "end_turn",
+            usage=SimpleNamespace(input_tokens=10, output_tokens=len(text), cache_creation_input_tokens=0, cache_read_input_tokens=0),
+        )
+        
+        async def parse():
+            return message
+        
+        return SimpleNamespace(headers={}, parse=parse)
+
+def chunked_client(chunks):
+    return SimpleNamespace(messages=ChunkedMessages(chunks))
+
+def test_budget_grows_with_the_requirement_and_split_count():
+    short, long = "The pump shall start.", "The pump shall start. " * 40
+    assert rn.output_budget("analyze", short) < rn.output_budget("analyze", long)
+    assert rn.output_budget("split", short, 3) > 2 * rn.output_budget("improve", short)
+    assert rn.output_budget("split", long, 10_000) == rn.MAX_TOKENS
+
+def test_cut_off_response_is_continued_from_a_prefill(monkeypatch):
+    monkeypatch.setattr(rn, "RATE_LIMITER", rn.RateLimiter(600, 10**6, 10**6))
+    answer = json.dumps({"requirement_text": "The [UNIT] shall log [EVENT] within 2 s.", "verification_method": "Test"})
+    client = chunked_client([answer[20:50], answer[50:]])
+    tally = {**dict.fromkeys(rn.TOKEN_USAGE, 0), "queue_seconds": 0.0}
+    text, stop_reason, used = asyncio.run(rn.continue_truncated(client, INSTRUCTIONS, "REQ", answer[:20] + " ", 400, tally))
+    assert json.loads(text) == json.loads(answer)
+    assert (stop_reason, used) == ("end_turn", 2)
+    requests = client.messages.requests
+    # Each continuation gets twice the room, and the prefill carries no trailing whitespace
+    assert [request["max_tokens"] for request in requests] == [800, 1600]
+    assert requests[0]["messages"][-1] == {"role": "assistant", "content": answer[:20]}
+    assert requests[1]["messages"][-1] == {"role": "assistant", "content": answer[:50].rstrip()}
+    assert tally["output_tokens"] == len(answer) - 20
+
+def test_continuations_stop_at_the_limit(monkeypatch):
+    monkeypatch.setattr(rn, "RATE_LIMITER", rn.RateLimiter(600, 10**6, 10**6))
+    client = chunked_client(["a"] * (rn.MAX_CONTINUATIONS + 2))
+    tally = {**dict.fromkeys(rn.TOKEN_USAGE, 0), "queue_seconds": 0.0}
+    text, stop_reason, used = asyncio.run(rn.continue_truncated(client, INSTRUCTIONS, "REQ", "[", 400, tally))
+    assert (text, stop_reason, used) == ("[" + "a" * rn.MAX_CONTINUATIONS, "max_tokens", rn.MAX_CONTINUATIONS)
+
+def test_processing_script_joins_continuations(monkeypatch):
+    monkeypatch.setattr(rn, "RATE_LIMITER", rn.RateLimiter(600, 10**6, 10**6))
+    monkeypatch.setattr(rp, "cache", rn.ResponseCache(None))
+    answer = json.dumps({"requirement_text": "The [UNIT] shall log [EVENT].", "verification_method": "Test"})
+    client = chunked_client([answer[:25], answer[25:]])
+    assert asyncio.run(rp.call_api(client, "improve", req="The unit shall log events.")) == json.loads(answer)
+    first, second = client.messages.requests
+    assert first["max_tokens"] == rp.budget("improve", req="The unit shall log events.")
+    assert second["max_tokens"] == 2 * first["max_tokens"]
+    assert second["messages"][-1] == {"role": "assistant", "content": answer[:25].rstrip()}
+
+def test_cache_key_includes_the_call_budget():
+    assert rn.response_cache_key(INSTRUCTIONS, "REQ", 600) != rn.response_cache_key(INSTRUCTIONS, "REQ", 1200)
+
+def test_processing_cache_misses_after_a_budget_change(monkeypatch, response_cache):
+    monkeypatch.setattr(rn, "RATE_LIMITER", rn.RateLimiter(600, 10**6, 10**6))
+    monkeypatch.setattr(rp, "cache", response_cache)
+    answer = json.dumps({"requirement_text": "The [UNIT] shall log [EVENT].", "verification_method": "Test"})
+    client = chunked_client([answer])
+    asyncio.run(rp.call_api(client, "improve", req="The unit shall log events."))
+    asyncio.run(rp.call_api(client, "improve", req="The unit shall log events."))
+    assert len(client.messages.requests) == 1
+    monkeypatch.setitem(rp.OUTPUT_TOKENS, "improve", 2 * rp.OUTPUT_TOKENS["improve"])
+    client.messages.chunks = [answer]
+    asyncio.run(rp.call_api(client, "improve", req="The unit shall log events."))
+    assert len(client.messages.requests) == 2
@@ -0,0 +1,24 @@
+"""Diff mode: matching requirements against an earlier output file"""
+import pandas as pd
+
+from requirements_neutralization import OUTPUT_COLUMNS, carry_forward, load_previous_output
+
+def write_previous(path, customer_req):
+    row = {column: '' for column in OUTPUT_COLUMNS}
+    row.update({
+        'Category': 'REQ_001',
+        'Customer_Req': customer_req,
+        'Sub_Requirement_Text': 'The [System_A] shall log [EVENT].',
+        'Verification_Method': 'Test',
+    })
+    pd.DataFrame([row], columns=OUTPUT_COLUMNS).to_csv(path, index=False)
+    return load_previous_output(str(path))
+
+def test_case_and_whitespace_changes_are_carried_forward(tmp_path):
+    previous = write_previous(tmp_path / "previous.csv", "The [System_A] shall log [EVENT].")
+    rows = carry_forward(previous, 'REQ_002', "the  [System_A] SHALL log [EVENT].", {})
+    assert [row['Category'] for row in rows] == ['REQ_002']
+
+def test_renamed_placeholder_is_processed_again(tmp_path):
+    previous = write_previous(tmp_path / "previous.csv", "The [System_A] shall log [EVENT].")
+    assert carry_forward(previous, 'REQ_001', "The [SYSTEM_A] shall log [EVENT].", {}) is None
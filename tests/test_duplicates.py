@@ -0,0 +1,41 @@
+"""Exact and near-duplicate clustering (R30) before dispatch"""
+import pandas as pd
+
+import requirements_neutralization as rn
+
+TEXT = ("When the vehicle is stationary, the control unit shall record every alarm event "
+        "together with its source and severity in the maintenance log within 2 s.")
+
+def duplicates_of(texts):
+    df = pd.DataFrame({'Category': [f"REQ_{i+1:03d}" for i in range(len(texts))], 'customer_req': texts})
+    return rn.find_duplicates(df)
+
+def test_exact_duplicates_ignore_case_and_whitespace():
+    assert duplicates_of([
+        "The pump shall start within 2 s.",
+        "The display shall show the speed.",
+        "the  pump shall START within 2 s.",
+    ]) == {"REQ_003": "REQ_001"}
+
+def test_near_duplicates_point_at_the_first_row():
+    assert duplicates_of([
+        "The display shall show the speed.",
+        TEXT,
+        TEXT.replace("record", "records"),
+        TEXT.replace("alarm", "alarms"),
+    ]) == {"REQ_003": "REQ_002", "REQ_004": "REQ_002"}
+
+def test_different_numbers_or_placeholders_are_never_merged():
+    assert duplicates_of([
+        "The [UNIT] shall record every alarm event in the maintenance log within 2 s.",
+        "The [UNIT] shall record every alarm event in the maintenance log within 5 s.",
+        "The [Unit] shall record every alarm event in the maintenance log within 2 s.",
+    ]) == {}
+
+def test_duplicates_reuse_the_representative_rows(pipeline):
+    output = pipeline(requirements=[TEXT, "The display shall show the speed.", TEXT.replace("record", "records")])
+    assert pipeline.processed == [TEXT, "The display shall show the speed."]
+    assert list(output['Category']) == ["REQ_001", "REQ_002", "REQ_003"]
+    assert list(output['Customer_Req'])[2] == TEXT.replace("record", "records")
+    assert list(output['Sub_Requirement_Text'])[2] == TEXT
+    assert list(output['Duplicate_Of'].fillna('')) == ['', '', "REQ_001"]
@@ -0,0 +1,41 @@
+"""Fan-out splits: one improve-style call per capability"""
+import asyncio
+
+import requirements_neutralization as rn
+
+REQUIREMENT = "The [UNIT] shall log [EVENT]; alert the operator; and archive records."
+CAPABILITIES = ["log [EVENT]", "alert the operator", "archive records"]
+
+def fake_call_claude(failures):
+    """call_claude stand-in: a capability named in `failures` fails that many more times"""
+    calls = []
+    
+    async def call_claude(client, instructions, message, parse_response, *args, **kwargs):
+        capability = message.split("CAPABILITY:\n")[1].split("\n")[0]
+        calls.append(capability)
+        if failures.get(capability, 0) > 0:
+            failures[capability] -= 1
+            raise RuntimeError(f"529 overloaded: {capability}")
+        return [{"requirement_type": "Functional", "requirement_text": f"The [UNIT] shall {capability}."}]
+    
+    return call_claude, calls
+
+def run_fan_out(monkeypatch, failures):
+    call_claude, calls = fake_call_claude(failures)
+    monkeypatch.setattr(rn, "call_claude", call_claude)
+    return asyncio.run(rn.fan_out_split(None, REQUIREMENT, CAPABILITIES)), calls
+
+def test_failed_capability_is_retried_alone(monkeypatch):
+    results, calls = run_fan_out(monkeypatch, {"alert the operator": 1})
+    assert [req["requirement_text"] for req in results] == [
+        "The [UNIT] shall log [EVENT].", "The [UNIT] shall alert the operator.", "The [UNIT] shall archive records.",
+    ]
+    assert calls.count("log [EVENT]") == 1 and calls.count("alert the operator") == 2
+
+def test_capability_that_keeps_failing_keeps_its_siblings(monkeypatch):
+    results, _ = run_fan_out(monkeypatch, {"archive records": 2})
+    assert [req["requirement_type"] for req in results] == ["Functional", "Functional", "ERROR"]
+
+def test_every_capability_failing_falls_back_to_one_split(monkeypatch):
+    results, _ = run_fan_out(monkeypatch, dict.fromkeys(CAPABILITIES, 1))
+    assert results is None
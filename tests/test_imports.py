@@ -0,0 +1,19 @@
+"""The scripts import without the optional packages they only need for some modes"""
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def import_without(module, blocked):
+    """Import `module` in a fresh interpreter where importing `blocked` fails"""
+    code = f"import sys; sys.modules[{blocked!r}] = None; import {module}"
+    return subprocess.run([sys.executable, "-c", code], cwd=REPO_DIR, capture_output=True, text=True)
+
+def test_neutralization_imports_without_httpx():
+    result = import_without("requirements_neutralization", "httpx")
+    assert result.returncode == 0, result.stderr
+
+def test_processing_imports_without_httpx():
+    result = import_without("requirements_processing", "httpx")
+    assert result.returncode == 0, result.stderr
@@ -0,0 +1,60 @@
+"""Lazy input readers and --stream-input"""
+import importlib.util
+import json
+
+import pandas as pd
+import pytest
+
+import requirements_neutralization as rn
+
+VALUES = ["The [UNIT] shall log [EVENT].", None, "The pump shall start within 2 s."]
+
+def write_input(path, values):
+    extension = path.suffix
+    frame = pd.DataFrame({'Requirement': values})
+    if extension == ".xlsx":
+        frame.to_excel(path, index=False)
+    elif extension == ".csv":
+        frame.to_csv(path, index=False)
+    elif extension == ".parquet":
+        frame.to_parquet(path, index=False)
+    else:
+        path.write_text("".join(json.dumps({'Requirement': value}) + "\n" for value in values), encoding="utf-8")
+
+FORMATS = [".xlsx", ".csv", ".jsonl"] + ([".parquet"] if importlib.util.find_spec("pyarrow") else [])
+
+@pytest.mark.parametrize("extension", FORMATS)
+def test_every_format_reads_the_same_requirements(tmp_path, extension):
+    path = tmp_path / f"input{extension}"
+    write_input(path, VALUES)
+    assert list(rn.iter_input_values(str(path))) == VALUES
+    # The empty row keeps its number, so REQ_002 stays unused
+    assert list(rn.iter_requirements(str(path))) == [("REQ_001", VALUES[0]), ("REQ_003", VALUES[2])]
+
+def test_rows_are_read_on_demand(tmp_path):
+    path = tmp_path / "input.jsonl"
+    path.write_text(json.dumps({'Requirement': VALUES[0]}) + "\n{not json\n", encoding="utf-8")
+    rows = rn.iter_requirements(str(path))
+    assert next(rows) == ("REQ_001", VALUES[0])
+    with pytest.raises(json.JSONDecodeError):
+        next(rows)
+
+def test_unsupported_input_type_is_rejected(tmp_path):
+    with pytest.raises(ValueError, match="Unsupported input file type"):
+        list(rn.iter_input_values(str(tmp_path / "input.txt")))
+
+def test_streamed_run_matches_a_loaded_run(pipeline):
+    requirements = ["The [UNIT] shall log [EVENT].", "", "The display shall show the speed.", "The pump shall start."]
+    loaded = pipeline(requirements=requirements)
+    streamed = pipeline("--stream-input", requirements=requirements)
+    assert list(streamed['Category']) == ["REQ_001", "REQ_003", "REQ_004"]
+    assert streamed.equals(loaded)
+
+def test_streamed_resume_processes_only_unfinished_rows(pipeline, monkeypatch):
+    monkeypatch.setattr(rn, "INPUT_CHUNK_ROWS", 1)
+    pipeline.failing.add("The display shall show the speed.")
+    pipeline("--stream-input")
+    pipeline.failing.clear()
+    resumed = pipeline("--stream-input", "--resume")
+    assert pipeline.processed == ["The display shall show the speed."]
+    assert list(resumed['Category']) == ["REQ_001", "REQ_002", "REQ_003"]
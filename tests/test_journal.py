@@ -0,0 +1,59 @@
+"""Checkpoint journal: torn-line recovery and --resume"""
+import pandas as pd
+
+import requirements_neutralization as rn
+
+REQUIREMENTS = [
+    "The [UNIT] shall log [EVENT].",
+    "The display shall show the speed.",
+    "The pump shall start within 2 s.",
+]
+
+def output_rows(category, customer_req):
+    return [{
+        'Category': category, 'Customer_Req': customer_req, 'Ambiguities_Identified': '',
+        'Improvements_Made': '', 'Vague_Terms_Removed': '', 'Tolerances_Added': '',
+        'Consolidated_Requirement': customer_req, 'Detailed_Requirement': customer_req,
+        'Sub_Requirement_Text': customer_req, 'Verification_Method': 'Test',
+    }]
+
+def test_torn_last_line_is_cut_off(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    rn.record_finished(path, "REQ_001", REQUIREMENTS[0], output_rows("REQ_001", REQUIREMENTS[0]))
+    rn.record_finished(path, "REQ_002", REQUIREMENTS[1], output_rows("REQ_002", REQUIREMENTS[1]))
+    intact = open(path, "rb").read()
+    with open(path, "ab") as f:
+        f.write(b'{"category": "REQ_003", "req_hash": "ab')
+    journal = rn.load_journal(path)
+    assert sorted(category for category, _ in journal) == ["REQ_001", "REQ_002"]
+    # The torn record is gone, so the next append starts on a clean line
+    assert open(path, "rb").read() == intact
+    rn.record_finished(path, "REQ_003", REQUIREMENTS[2], output_rows("REQ_003", REQUIREMENTS[2]))
+    assert len(rn.load_journal(path)) == 3
+
+def test_error_rows_are_not_journaled(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    rn.record_finished(path, "REQ_001", REQUIREMENTS[0], [rn.build_error_row("REQ_001", REQUIREMENTS[0], "boom")])
+    assert rn.load_journal(path) == {}
+
+def test_changed_text_is_processed_again(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    rn.record_finished(path, "REQ_001", REQUIREMENTS[0], output_rows("REQ_001", REQUIREMENTS[0]))
+    df = pd.DataFrame({'Category': ["REQ_001", "REQ_002"], 'customer_req': [REQUIREMENTS[0] + " ", "changed"]})
+    pending = rn.select_pending(df, rn.load_journal(path))
+    assert list(pending['Category']) == ["REQ_002"]
+
+def test_resume_processes_only_unfinished_rows(pipeline):
+    pipeline.failing.add(REQUIREMENTS[1])
+    first = pipeline()
+    assert str(first['Sub_Requirement_Text'][1]).startswith("ERROR:")
+    pipeline.failing.clear()
+    resumed = pipeline("--resume")
+    assert pipeline.processed == [REQUIREMENTS[1]]
+    assert list(resumed['Category']) == ["REQ_001", "REQ_002", "REQ_003"]
+    assert list(resumed['Sub_Requirement_Text']) == REQUIREMENTS
+
+def test_fresh_run_starts_a_new_journal(pipeline):
+    pipeline()
+    pipeline()
+    assert pipeline.processed == REQUIREMENTS
@@ -0,0 +1,46 @@
+"""Per-call metrics of the processing script, recorded through the shared helpers"""
+import asyncio
+import json
+from types import SimpleNamespace
+
+import requirements_neutralization as rn
+import requirements_processing as rp
+
+ANSWER = json.dumps({"requirement_text": "The [UNIT] shall log [EVENT].", "verification_method": "Test"})
+
+def client_answering(*chunks):
+    """Client whose responses are `chunks` in turn, each but the last cut off at max_tokens"""
+    pending = list(chunks)
+    
+    async def create(**params):
+        text = pending.pop(0)
+        message = SimpleNamespace(
+            content=[SimpleNamespace(type="text", text=text)], stop_reason="max_tokens" if pending else "end_turn",
+            usage=SimpleNamespace(input_tokens=100, output_tokens=10, cache_creation_input_tokens=0, cache_read_input_tokens=50),
+        )
+        
+        async def parse():
+            return message
+        
+        return SimpleNamespace(headers={}, parse=parse)
+    
+    return SimpleNamespace(messages=SimpleNamespace(with_raw_response=SimpleNamespace(create=create)))
+
+def test_processing_calls_are_recorded(monkeypatch, response_cache, tmp_path):
+    monkeypatch.setattr(rn, "RATE_LIMITER", rn.RateLimiter(600, 10**6, 10**6))
+    monkeypatch.setattr(rn, "CALL_METRICS", [])
+    monkeypatch.setattr(rp, "cache", response_cache)
+    client = client_answering(ANSWER[:20], ANSWER[20:])
+    for _ in range(2):
+        asyncio.run(rp.call_api(client, "improve", req="The unit shall log events."))
+    api_call, cache_hit = rn.CALL_METRICS
+    assert (api_call["stage"], api_call["source"], api_call["continuations"]) == ("improve", "interactive", 1)
+    assert (api_call["input_tokens"], api_call["output_tokens"], api_call["cache_read_input_tokens"]) == (200, 20, 100)
+    assert api_call["stop_reason"] == "end_turn" and api_call["cost_usd"] > 0
+    assert (cache_hit["stage"], cache_hit["source"]) == ("improve", "cache")
+    
+    rn.write_metrics(1, str(tmp_path / "metrics.json"), str(tmp_path / "metrics.prom"), rp.MODEL)
+    exported = json.loads((tmp_path / "metrics.json").read_text(encoding="utf-8"))
+    assert exported["model"] == rp.MODEL
+    assert exported["stages"]["improve"]["calls"] == 1 and exported["stages"]["improve"]["cache_hits"] == 1
+    assert 'requirements_api_calls_total{stage="improve",source="api"} 1' in (tmp_path / "metrics.prom").read_text(encoding="utf-8")
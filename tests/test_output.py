@@ -0,0 +1,55 @@
+"""Streaming output: rows reach the sinks in input order whatever order requirements finish in"""
+import importlib.util
+
+import pandas as pd
+
+import requirements_neutralization as rn
+
+class ListSink:
+    def __init__(self):
+        self.rows = []
+        self.closed = False
+
+    def write(self, output_row):
+        self.rows.append(output_row)
+
+    def close(self):
+        self.closed = True
+
+def rows_for(category, count=1):
+    return [
+        {**dict.fromkeys(rn.OUTPUT_COLUMNS, ''), 'Category': category, 'Sub_Requirement_Text': f"{category}.{i}"}
+        for i in range(count)
+    ]
+
+def test_rows_are_written_in_input_order():
+    sink = ListSink()
+    output = rn.OrderedOutput(["REQ_001", "REQ_002", "REQ_003"], [sink])
+    output.add("REQ_003", rows_for("REQ_003"))
+    output.add("REQ_002", rows_for("REQ_002", 2))
+    assert sink.rows == []  # Both wait for REQ_001
+    output.add("REQ_001", rows_for("REQ_001"))
+    assert [row['Sub_Requirement_Text'] for row in sink.rows] == ["REQ_001.0", "REQ_002.0", "REQ_002.1", "REQ_003.0"]
+    assert output.row_count == 4 and not output.waiting
+
+def test_close_flushes_rows_after_a_gap():
+    sink = ListSink()
+    output = rn.OrderedOutput(["REQ_001", "REQ_002", "REQ_003"], [sink])
+    output.add("REQ_003", rows_for("REQ_003"))
+    output.add("REQ_001", rows_for("REQ_001"))
+    output.close()
+    assert [row['Category'] for row in sink.rows] == ["REQ_001", "REQ_003"]
+    assert sink.closed
+
+def test_every_format_gets_the_same_rows(tmp_path):
+    formats = ["xlsx", "csv"] + (["parquet"] if importlib.util.find_spec("pyarrow") else [])
+    output = rn.open_output(["REQ_001", "REQ_002"], str(tmp_path / "out.xlsx"), formats)
+    output.add("REQ_002", rows_for("REQ_002", 2))
+    output.add("REQ_001", rows_for("REQ_001"))
+    output.close()
+    frames = [pd.read_excel(tmp_path / "out.xlsx"), pd.read_csv(tmp_path / "out.csv")]
+    if "parquet" in formats:
+        frames.append(pd.read_parquet(tmp_path / "out.parquet"))
+    for frame in frames:
+        assert list(frame.columns) == rn.OUTPUT_COLUMNS
+        assert list(frame['Sub_Requirement_Text']) == ["REQ_001.0", "REQ_002.0", "REQ_002.1"]
@@ -0,0 +1,60 @@
+"""Packed improve calls: several atomic requirements per call, bisected when a pack fails"""
+import asyncio
+import json
+import re
+
+import requirements_neutralization as rn
+
+REQUIREMENTS = [f"The pump {i} shall start within {i} s." for i in range(1, 6)]
+
+def improvement(customer_req, **extra):
+    return {**extra, "requirement_type": "Functional", "improved_requirement": customer_req,
+            "verification_method": "Test"}
+
+def fake_call_claude(max_pack=None, skip_keys=()):
+    """call_claude stand-in answering packs of at most `max_pack` requirements, leaving out `skip_keys` once"""
+    packs = []
+    skipped = set()
+    
+    async def call_claude(client, instructions, message, parse_response, *args, **kwargs):
+        keys = re.findall(r'^KEY: (R\d+)$', message, re.MULTILINE)
+        reqs = re.findall(r'^ORIGINAL REQUIREMENT:\n(.*)$', message, re.MULTILINE)
+        packs.append(reqs)
+        if instructions != rn.PACKED_IMPROVE_PROMPT:
+            return parse_response(json.dumps(improvement(reqs[0])))
+        if max_pack and len(keys) > max_pack:
+            raise ValueError("Unterminated string: response cut off")
+        answered = []
+        for key, req in zip(keys, reqs):
+            if req in skip_keys and req not in skipped:
+                skipped.add(req)
+                continue
+            answered.append(improvement(req, key=key))
+        return parse_response(json.dumps(answered))
+    
+    return call_claude, packs
+
+def improve(monkeypatch, **fake):
+    call_claude, packs = fake_call_claude(**fake)
+    monkeypatch.setattr(rn, "call_claude", call_claude)
+    results = asyncio.run(rn.improve_packed(None, REQUIREMENTS))
+    return [result[0]['requirement_text'] for result in results], packs
+
+def test_one_call_answers_the_whole_pack(monkeypatch):
+    texts, packs = improve(monkeypatch)
+    assert texts == REQUIREMENTS
+    assert packs == [REQUIREMENTS]
+
+def test_failed_pack_is_bisected_until_the_halves_fit(monkeypatch):
+    texts, packs = improve(monkeypatch, max_pack=2)
+    assert texts == REQUIREMENTS
+    assert sorted(map(len, packs)) == [1, 2, 2, 3, 5]  # 5 → 2 + 3, 3 → 1 + 2
+
+def test_keys_missing_from_the_answer_are_retried(monkeypatch):
+    texts, packs = improve(monkeypatch, skip_keys={REQUIREMENTS[1], REQUIREMENTS[3]})
+    assert texts == REQUIREMENTS
+    assert packs[1] == [REQUIREMENTS[1], REQUIREMENTS[3]]
+
+def test_packs_respect_the_input_token_budget(monkeypatch):
+    monkeypatch.setattr(rn, "PACK_MAX_INPUT_TOKENS", 2 * rn.estimate_tokens(REQUIREMENTS[0]))
+    assert rn.plan_packs(REQUIREMENTS) == [[0, 1], [2, 3], [4]]
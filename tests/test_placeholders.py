@@ -0,0 +1,82 @@
+"""[P n] placeholder masking and the repair of lost or altered placeholders"""
+import asyncio
+
+import requirements_neutralization as rn
+
+REQ = "The [CTRL_UNIT] shall send [STATUS_MSG] to [HMI] every 2 s and the [CTRL_UNIT] shall log it."
+
+def requirement(text):
+    return {"requirement_type": "Functional", "requirement_text": text, "verification_method": "Test"}
+
+def fake_repair(monkeypatch, repaired_text):
+    monkeypatch.setattr(rn, "PLACEHOLDER_STATS", dict.fromkeys(rn.PLACEHOLDER_STATS, 0))
+    messages = []
+    
+    async def call_claude(client, instructions, message, parse_response, **kwargs):
+        messages.append(message)
+        return parse_response(f'{{"requirement_text": "{repaired_text}"}}')
+    
+    monkeypatch.setattr(rn, "call_claude", call_claude)
+    return messages
+
+def test_mask_and_unmask_round_trip():
+    masked, names = rn.mask_placeholders(REQ)
+    assert masked == "The [P1] shall send [P2] to [P3] every 2 s and the [P1] shall log it."
+    assert names == ["CTRL_UNIT", "STATUS_MSG", "HMI"]
+    answer = [{**requirement(masked), "placeholders_used": ["[P1]", "[ P2 ]"], "reasoning": None}]
+    unmasked = rn.unmask_requirements(answer, names)
+    assert unmasked[0]["requirement_text"] == REQ
+    assert unmasked[0]["placeholders_used"] == ["[CTRL_UNIT]", "[STATUS_MSG]"]
+    assert unmasked[0]["reasoning"] is None
+
+def test_out_of_range_token_is_left_for_the_repair():
+    assert rn.unmask_value("The [P1] shall send [P4].", ["UNIT"]) == "The [UNIT] shall send [P4]."
+    assert rn.placeholder_problems("The [UNIT] shall send data.", [requirement("The [UNIT] shall send [P4].")]) == {
+        0: ([], ["[P4]"])
+    }
+
+def test_lost_placeholder_is_charged_to_the_split_requirement_it_belongs_to():
+    requirements = [
+        requirement("The [CTRL_UNIT] shall send the status message to [HMI] every 2 s."),
+        requirement("The [CTRL_UNIT] shall log the status message."),
+    ]
+    assert rn.placeholder_problems(REQ, requirements) == {0: (["STATUS_MSG"], [])}
+    # A look-alike placeholder marks the owner and counts as altered
+    requirements[1]["requirement_text"] = "The [CTRL_UNIT] shall log the [STATUS_MSGS]."
+    assert rn.placeholder_problems(REQ, requirements) == {1: (["STATUS_MSG"], ["[STATUS_MSGS]"])}
+
+def test_restore_unmasks_without_a_repair_when_the_split_keeps_every_placeholder(monkeypatch):
+    messages = fake_repair(monkeypatch, "unused")
+    masked, names = rn.mask_placeholders(REQ)
+    requirements = [
+        requirement("The [P1] shall send the [P2] to [P3] every 2 s."),
+        requirement("The [P1] shall log the message."),
+    ]
+    asyncio.run(rn.restore_placeholders(None, REQ, requirements, names))
+    assert [req["requirement_text"] for req in requirements] == [
+        "The [CTRL_UNIT] shall send the [STATUS_MSG] to [HMI] every 2 s.",
+        "The [CTRL_UNIT] shall log the message.",
+    ]
+    assert messages == []
+
+def test_restore_repairs_a_requirement_that_lost_a_placeholder(monkeypatch):
+    messages = fake_repair(monkeypatch, "The [CTRL_UNIT] shall send [STATUS_MSG] to [HMI] every 2 s.")
+    requirements = [requirement("The [P1] shall send the status message to [P3] every 2 s.")]
+    asyncio.run(rn.restore_placeholders(None, "The [CTRL_UNIT] shall send [STATUS_MSG] to [HMI] every 2 s.",
+                                        requirements, ["CTRL_UNIT", "STATUS_MSG", "HMI"]))
+    assert requirements[0]["requirement_text"] == "The [CTRL_UNIT] shall send [STATUS_MSG] to [HMI] every 2 s."
+    assert len(messages) == 1 and "[STATUS_MSG]" in messages[0]
+    assert rn.PLACEHOLDER_STATS["lost"] == 1 and rn.PLACEHOLDER_STATS["repaired"] == 1
+
+def test_failed_repair_keeps_the_generated_text(monkeypatch):
+    fake_repair(monkeypatch, "The [CTRL_UNIT] shall send the status message.")
+    requirements = [requirement("The [CTRL_UNIT] shall send the status message.")]
+    asyncio.run(rn.restore_placeholders(None, "The [CTRL_UNIT] shall send [STATUS_MSG].", requirements))
+    assert requirements[0]["requirement_text"] == "The [CTRL_UNIT] shall send the status message."
+    assert rn.PLACEHOLDER_STATS["unrepaired"] == 1
+
+def test_missing_placeholders_lists_names_while_the_check_stays_boolean():
+    generated = "The [CTRL_UNIT] shall send the message to [HMI]."
+    assert rn.missing_placeholders(REQ, generated) == ["STATUS_MSG"]
+    assert rn.verify_placeholders_preserved(REQ, generated) is False
+    assert rn.verify_placeholders_preserved(REQ, REQ) is True
@@ -0,0 +1,46 @@
+"""Rate-limiter reservations around API calls"""
+import asyncio
+
+import pytest
+
+import requirements_neutralization as rn
+
+class FailingMessages:
+    """messages stand-in whose create() and stream() fail like a 429"""
+
+    def __init__(self):
+        self.with_raw_response = self
+
+    async def create(self, **params):
+        raise RuntimeError("429 rate_limit_error")
+
+    def stream(self, **params):
+        raise RuntimeError("429 rate_limit_error")
+
+class FailingClient:
+    messages = FailingMessages()
+
+def test_settle_charges_actual_usage():
+    limiter = rn.RateLimiter(60, 6000, 6000)
+    asyncio.run(limiter.acquire(1000, 2000))
+    limiter.settle(1000, 400, 2000, 500)
+    assert limiter.buckets["input-tokens"].available == pytest.approx(5600, abs=10)
+    assert limiter.buckets["output-tokens"].available == pytest.approx(5500, abs=10)
+
+def test_failed_request_hands_back_its_reservation(monkeypatch):
+    limiter = rn.RateLimiter(60, 60000, 60000)
+    monkeypatch.setattr(rn, "RATE_LIMITER", limiter)
+    with pytest.raises(RuntimeError):
+        asyncio.run(rn.call_claude(FailingClient(), rn.IMPROVE_REQUIREMENT_PROMPT, "REQ: " + "x" * 4000, lambda text: text, max_retries=1))
+    assert limiter.buckets["input-tokens"].available > 59000
+    assert limiter.buckets["output-tokens"].available > 59000
+
+def test_processing_script_uses_the_current_shared_limiter(monkeypatch):
+    import requirements_processing as rp
+    limiter = rn.RateLimiter(60, 60000, 60000)
+    monkeypatch.setattr(rn, "RATE_LIMITER", limiter)
+    with pytest.raises(RuntimeError):
+        asyncio.run(rp.create(FailingClient(), "improve", "REQ: " + "x" * 4000, 20000))
+    # The rebound limiter took the request and got its token reservation back
+    assert limiter.buckets["requests"].available < 60
+    assert limiter.buckets["input-tokens"].available > 59000
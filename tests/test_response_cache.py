@@ -0,0 +1,46 @@
+"""Response cache: round trip, and a failing cache file falling back to the API"""
+import asyncio
+import json
+from types import SimpleNamespace
+
+import requirements_neutralization as rn
+import requirements_processing as rp
+
+def test_round_trip(tmp_path):
+    cache = rn.ResponseCache(str(tmp_path / "cache.sqlite"))
+    key = rn.ResponseCache.make_key(rn.MODEL, ["instructions", "REQ"], 1000)
+    assert cache.get(key) is None
+    cache.put(key, '{"ok": true}')
+    assert cache.get(key) == '{"ok": true}'
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.close()
+
+def test_unreadable_cache_file_is_disabled_with_one_warning(tmp_path, capsys):
+    path = tmp_path / "cache.sqlite"
+    path.write_bytes(b"not a database " * 100)
+    cache = rn.ResponseCache(str(path))
+    assert cache.get("key") is None
+    cache.put("key", "text")
+    assert cache.get("key") is None
+    cache.close()
+    assert cache.path is None
+    assert capsys.readouterr().out.count("WARNING: Response cache") == 1
+
+def test_call_goes_to_the_api_when_the_cache_fails(monkeypatch, tmp_path):
+    monkeypatch.setattr(rn, "RATE_LIMITER", rn.RateLimiter(600, 10**6, 10**6))
+    monkeypatch.setattr(rp, "cache", rn.ResponseCache(str(tmp_path / "missing" / "cache.sqlite")))
+    answer = json.dumps({"requirement_text": "The [UNIT] shall log [EVENT].", "verification_method": "Test"})
+    message = SimpleNamespace(
+        content=[SimpleNamespace(type="text", text=answer)], stop_reason="end_turn",
+        usage=SimpleNamespace(input_tokens=10, output_tokens=20, cache_creation_input_tokens=0, cache_read_input_tokens=0),
+    )
+    
+    async def create(**params):
+        async def parse():
+            return message
+        return SimpleNamespace(headers={}, parse=parse)
+    
+    raw = SimpleNamespace(create=create)
+    client = SimpleNamespace(messages=SimpleNamespace(with_raw_response=raw))
+    assert asyncio.run(rp.call_api(client, "improve", req="The unit shall log events.")) == json.loads(answer)
+    assert rp.cache.path is None
@@ -0,0 +1,33 @@
+"""Local rule checks on generated requirement_text"""
+from requirements_neutralization import rule_findings
+
+def rule_ids(requirement_text):
+    return [rule_id for rule_id, _, _ in rule_findings(requirement_text)]
+
+def test_units_are_not_oblique_symbols():
+    assert "R17" not in rule_ids("The vehicle shall travel at 100 km/h.")
+
+def test_tolerances_are_not_oblique_symbols():
+    assert "R17" not in rule_ids("The pump shall deliver 5.0 +0.5/-0.3 L/min.")
+
+def test_rates_with_tolerance_are_not_oblique_symbols():
+    assert "R17" not in rule_ids("The server shall handle 1000 ± 50 requests/second.")
+
+def test_ratios_are_not_oblique_symbols():
+    assert "R17" not in rule_ids("The mixer shall keep a 20/30 ratio.")
+
+def test_alternatives_are_oblique_symbols():
+    findings = rule_findings("The operator and/or maintainer shall acknowledge the alarm.")
+    assert ("R17", "oblique symbol", "and/or") in findings
+
+def test_alternatives_next_to_a_quantity_are_oblique_symbols():
+    findings = rule_findings("The [Pump] shall deliver 5 L/min to the read/write port.")
+    assert [text for rule_id, _, text in findings if rule_id == "R17"] == ["read/write"]
+
+def test_alternatives_after_a_count_are_oblique_symbols():
+    findings = rule_findings("The [System] shall notify 3 users/admins.")
+    assert [text for rule_id, _, text in findings if rule_id == "R17"] == ["users/admins"]
+
+def test_only_units_follow_a_slash_in_a_quantity():
+    assert "R17" not in rule_ids("The tank shall fill at 20 m³/h and log 5 GB/day.")
+    assert "R17" in rule_ids("The controller shall log 2 errors/warnings.")
@@ -0,0 +1,99 @@
+"""Sharded mode: partitioning and merging shard output back in input order"""
+import csv
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+import requirements_neutralization as rn
+
+def input_frame(count):
+    return pd.DataFrame({
+        'Category': [f"REQ_{i:03d}" for i in range(1, count + 1)],
+        'customer_req': [f"The [UNIT] shall log event {i}." for i in range(1, count + 1)],
+    })
+
+def output_row(category, customer_req):
+    return {
+        'Category': category, 'Customer_Req': customer_req, 'Ambiguities_Identified': '',
+        'Improvements_Made': '', 'Vague_Terms_Removed': '', 'Tolerances_Added': '',
+        'Consolidated_Requirement': customer_req, 'Detailed_Requirement': customer_req,
+        'Sub_Requirement_Text': customer_req, 'Verification_Method': 'Test', 'Duplicate_Of': '',
+    }
+
+def write_shard_csv(path, rows):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=rn.OUTPUT_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+def test_shard_path_keeps_compound_extensions():
+    assert rn.shard_path("out/run.xlsx", 0, 4) == "out/run.shard1of4.xlsx"
+    assert rn.shard_path("run.cassette.jsonl.gz", 2, 3) == "run.cassette.shard3of3.jsonl.gz"
+    assert rn.shard_path(None, 0, 2) is None
+
+def test_range_shards_cover_every_row_once():
+    df = input_frame(7)
+    shards = rn.partition_rows(df, 3)
+    assert [len(shard) for shard in shards] == [2, 2, 3]
+    assert pd.concat(shards)['Category'].tolist() == df['Category'].tolist()
+
+def test_hash_shards_keep_template_variants_together():
+    df = pd.DataFrame({
+        'Category': ["REQ_001", "REQ_002", "REQ_003"],
+        'customer_req': ["The [PUMP] shall start.", "the  [VALVE] shall start.", "The [PUMP] shall stop."],
+    })
+    shards = rn.partition_rows(df, 4, "hash")
+    holding = [index for index, shard in enumerate(shards) if "REQ_001" in shard['Category'].tolist()]
+    assert "REQ_002" in shards[holding[0]]['Category'].tolist()
+    assert sum(len(shard) for shard in shards) == 3
+
+def test_merge_writes_input_order_and_marks_a_dead_shard(monkeypatch, tmp_path):
+    output_file = str(tmp_path / "merged.xlsx")
+    journal_file = str(tmp_path / "journal.jsonl")
+    monkeypatch.setattr(rn, "OUTPUT_FILE", output_file)
+    monkeypatch.setattr(rn, "JOURNAL_FILE", journal_file)
+    monkeypatch.setattr(rn, "OUTPUT_FORMATS", ["csv"])
+    df = input_frame(5)
+    shards = rn.partition_rows(df, 2)
+    rows = {row['Category']: output_row(row['Category'], row['customer_req']) for _, row in df.iterrows()}
+    # Shard 1 finished: one row only in its journal, the other only in its CSV output
+    rn.record_finished(rn.shard_path(journal_file, 0, 2), "REQ_001", df['customer_req'][0], [rows["REQ_001"]])
+    write_shard_csv(str(tmp_path / "merged.shard1of2.csv"), [rows["REQ_002"]])
+    # Shard 2 died after writing one of its three rows
+    write_shard_csv(str(tmp_path / "merged.shard2of2.csv"), [rows["REQ_004"]])
+    workers = [
+        (SimpleNamespace(exitcode=0), shards[0], "shard1.log"),
+        (SimpleNamespace(exitcode=1), shards[1], "shard2.log"),
+    ]
+    assert rn.merge_shards(df, workers, 2) == (5, 2)
+    merged = pd.read_csv(str(tmp_path / "merged.csv"), keep_default_na=False)
+    assert merged['Category'].tolist() == df['Category'].tolist()
+    assert merged['Consolidated_Requirement'][3] == df['customer_req'][3]
+    for index in (2, 4):
+        assert merged['Consolidated_Requirement'][index] == "ERROR: shard 2 failed (exit code 1), see shard2.log"
+
+class DeadProcess:
+    """multiprocessing.Process stand-in for a shard that exits at once without output"""
+    exitcode = 1
+
+    def __init__(self, target, args, name):
+        pass
+
+    def start(self):
+        pass
+
+    def is_alive(self):
+        return False
+
+def test_merge_of_only_error_rows_exits_non_zero(monkeypatch, tmp_path):
+    monkeypatch.setattr(rn, "OUTPUT_FILE", str(tmp_path / "merged.xlsx"))
+    monkeypatch.setattr(rn, "JOURNAL_FILE", str(tmp_path / "journal.jsonl"))
+    monkeypatch.setattr(rn, "OUTPUT_FORMATS", ["csv"])
+    monkeypatch.setattr(rn.multiprocessing, "get_context", lambda method: SimpleNamespace(Process=DeadProcess))
+    with pytest.raises(SystemExit) as exit_info:
+        rn.process_sharded(input_frame(3), SimpleNamespace(shards=2, shard_by="range"))
+    assert exit_info.value.code == 1
+
+def test_shards_use_the_cache_of_the_run(response_cache):
+    assert rn.shard_settings()["CACHE_FILE"] == response_cache.path
@@ -0,0 +1,34 @@
+"""StreamingJSONScanner: structural checks and array elements across arbitrary chunk boundaries"""
+import json
+
+import pytest
+
+from requirements_neutralization import MalformedResponse, StreamingJSONScanner
+
+RESPONSE = 'Here it is:\n```json\n' + json.dumps({"requirements": [
+    {"requirement_text": "The [UNIT] shall log [EVENT] {within} 2 s.", "verification_method": "Test"},
+    {"requirement_text": 'The [UNIT] shall show "ready\\" [brackets] ]}', "verification_method": "Inspection"},
+    {"requirement_text": "The [UNIT] shall archive records.", "verification_method": "Analysis"},
+]}) + '\n```'
+
+def scan(text, size):
+    items = []
+    scanner = StreamingJSONScanner(lambda number, item: items.append(item))
+    for start in range(0, len(text), size):
+        scanner.feed(text[start:start + size])
+    return scanner, items
+
+@pytest.mark.parametrize("size", [1, 2, 7, 64, len(RESPONSE)])
+def test_elements_are_the_same_for_any_chunk_size(size):
+    scanner, items = scan(RESPONSE, size)
+    assert scanner.finished
+    assert items == json.loads(RESPONSE.split("```json\n")[1].split("\n```")[0])["requirements"]
+    assert scanner.text == RESPONSE and scanner.received == len(RESPONSE)
+
+def test_unbalanced_bracket_is_malformed():
+    with pytest.raises(MalformedResponse):
+        scan('[{"requirement_text": "x"]', 3)
+
+def test_long_preamble_is_malformed():
+    with pytest.raises(MalformedResponse):
+        scan("x" * (StreamingJSONScanner.PREAMBLE_LIMIT + 10) + "[]", 50)
@@ -0,0 +1,38 @@
+"""Rows that differ only in placeholder names share one [SLOT_n] template"""
+import pandas as pd
+
+import requirements_neutralization as rn
+
+def test_placeholders_become_numbered_slots():
+    template, names = rn.canonicalize_placeholders("The [SYSTEM_A] shall send [MSG] to [SYSTEM_B] and [MSG] back.")
+    assert template == "The [SLOT_1] shall send [SLOT_2] to [SLOT_3] and [SLOT_2] back."
+    assert names == ["SYSTEM_A", "MSG", "SYSTEM_B"]
+
+def test_slots_are_filled_back_with_each_rows_names():
+    assert rn.fill_slots("The [SLOT_1] shall log [SLOT_2] within [SLOT_3].", ["PUMP", "EVENT"]) == (
+        "The [PUMP] shall log [EVENT] within [SLOT_3]."
+    )
+
+def test_only_shared_templates_are_canonicalized():
+    df = pd.DataFrame({
+        'Category': ["REQ_001", "REQ_002", "REQ_003"],
+        'customer_req': ["The [PUMP_A] shall start.", "The [VALVE] shall close.", "The [PUMP_B] shall start."],
+    })
+    pending, templates = rn.group_templates(df)
+    assert list(pending['Category']) == ["REQ_001", "REQ_002"]
+    assert list(pending['customer_req']) == ["The [SLOT_1] shall start.", "The [VALVE] shall close."]
+    assert [category for category, _, _ in templates["REQ_001"]] == ["REQ_001", "REQ_003"]
+
+def test_template_result_is_fanned_back_to_every_row(pipeline):
+    output = pipeline(requirements=["The [PUMP_A] shall start [FLOW].", "The display shall show the speed.",
+                                    "The [PUMP_B] shall start [FLOW]."])
+    assert pipeline.processed == ["The [SLOT_1] shall start [SLOT_2].", "The display shall show the speed."]
+    assert list(output['Category']) == ["REQ_001", "REQ_002", "REQ_003"]
+    assert list(output['Customer_Req'])[2] == "The [PUMP_B] shall start [FLOW]."
+    assert list(output['Sub_Requirement_Text']) == [
+        "The [PUMP_A] shall start [FLOW].", "The display shall show the speed.", "The [PUMP_B] shall start [FLOW].",
+    ]
+
+def test_no_templates_flag_sends_every_row(pipeline):
+    pipeline("--no-templates", requirements=["The [PUMP_A] shall start.", "The [PUMP_B] shall start."])
+    assert pipeline.processed == ["The [PUMP_A] shall start.", "The [PUMP_B] shall start."]
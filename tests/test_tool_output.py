@@ -0,0 +1,75 @@
+"""Tool-schema output and the narrow repair of missing required fields"""
+import asyncio
+import json
+
+import pytest
+
+import requirements_neutralization as rn
+
+IMPROVED = {
+    "requirement_type": "Functional",
+    "improved_requirement": "The [SYSTEM] shall log each [EVENT] within 2 s.",
+    "verification_method": "Test",
+    "vague_terms_removed": [],
+    "tolerances_added": ["within 2 s"],
+}
+
+def split_answer(*records):
+    return {"requirements": [dict(record) for record in records]}
+
+def sub_requirement(sub_id, **overrides):
+    record = {
+        "sub_id": sub_id, "requirement_type": "Functional", "requirement_text": f"Requirement {sub_id}.",
+        "verification_method": "Test", "vague_terms_removed": [], "tolerances_added": [],
+    }
+    record.update(overrides)
+    return {field: value for field, value in record.items() if value is not None}
+
+def fake_repair(monkeypatch, records):
+    calls = []
+    
+    async def call_claude(client, instructions, message, parse_response, **kwargs):
+        calls.append((instructions, message))
+        return records
+    
+    monkeypatch.setattr(rn, "call_claude", call_claude)
+    return calls
+
+def test_incomplete_records_lists_missing_and_mistyped_fields():
+    schema = rn.OUTPUT_TOOLS[rn.IMPROVE_REQUIREMENT_PROMPT][0]["input_schema"]
+    assert rn.incomplete_records(dict(IMPROVED), schema) == []
+    answer = {**IMPROVED, "verification_method": "", "tolerances_added": "within 2 s"}
+    assert rn.incomplete_records(answer, schema) == [(answer, ["verification_method", "tolerances_added"])]
+
+def test_incomplete_records_checks_objects_inside_arrays():
+    schema = rn.OUTPUT_TOOLS[rn.SPLIT_REQUIREMENT_PROMPT][0]["input_schema"]
+    answer = split_answer(sub_requirement("1"), sub_requirement("2", verification_method=None))
+    assert [missing for _, missing in rn.incomplete_records(answer, schema)] == [["verification_method"]]
+
+def test_complete_answer_is_unwrapped_without_a_repair_call(monkeypatch):
+    calls = fake_repair(monkeypatch, [])
+    answer = split_answer(sub_requirement("1"), sub_requirement("2"))
+    text = asyncio.run(rn.complete_tool_answer(None, rn.SPLIT_REQUIREMENT_PROMPT, "REQ", json.dumps(answer)))
+    assert json.loads(text) == answer["requirements"]
+    assert calls == []
+
+def test_only_the_missing_fields_are_requested_and_merged(monkeypatch):
+    calls = fake_repair(monkeypatch, [{"record": 1, "fields": {"verification_method": "Inspection"}}])
+    answer = split_answer(sub_requirement("1"), sub_requirement("2", verification_method=None))
+    text = asyncio.run(rn.complete_tool_answer(None, rn.SPLIT_REQUIREMENT_PROMPT, "REQ", json.dumps(answer)))
+    assert [record["verification_method"] for record in json.loads(text)] == ["Test", "Inspection"]
+    (instructions, message), = calls
+    assert instructions == rn.REPAIR_FIELDS_PROMPT
+    assert "record 1: verification_method" in message
+
+def test_answer_still_incomplete_after_repair_is_rejected(monkeypatch):
+    fake_repair(monkeypatch, [{"record": 1, "fields": {}}])
+    answer = {**IMPROVED, "verification_method": None}
+    with pytest.raises(ValueError, match="verification_method"):
+        asyncio.run(rn.complete_tool_answer(None, rn.IMPROVE_REQUIREMENT_PROMPT, "REQ", json.dumps(answer)))
+
+def test_stage_tool_is_forced_while_every_tool_is_sent(monkeypatch):
+    monkeypatch.setattr(rn, "USE_TOOL_OUTPUT", True)
+    params = rn.build_message_params(rn.IMPROVE_REQUIREMENT_PROMPT, "REQ")
+    assert params["tool_choice"] == {"type": "tool", "name": "record_improved_requirement"}
+    assert len(params["tools"]) == len(rn.OUTPUT_TOOLS)
@@ -0,0 +1,17 @@
+"""Local vague-term scan of the input column"""
+import pandas as pd
+
+from requirements_neutralization import scan_vague_terms
+
+def findings(text):
+    return scan_vague_terms(pd.Series([text])).iloc[0]
+
+def test_ordinary_words_are_not_vague_terms():
+    assert findings("The system shall log events as well as alarms.") == []
+    assert findings("The operator shall clear the alarm list.") == []
+    assert findings("The valve shall close at high pressure over a secure channel.") == []
+
+def test_subjective_terms_are_vague_terms():
+    assert findings("The screen shall be easy to read and fast to load, etc.") == [
+        ("R7", "easy"), ("R7", "fast"), ("R9", "etc."),
+    ]